@@ -53,6 +53,7 @@ setup(
     tests_require=TESTS_REQUIRE,
     install_requires=[
         'setuptools',
+        'BTrees',
         'gevent',
         'isodate',
         'nti.app.invitations',
@@ -70,6 +71,7 @@ setup(
         'nti.store',
         'nti.traversal',
         'nti.zodb',
+        'persistent',
         'pyramid',
         'requests',
         'simplejson',
@@ -81,6 +83,7 @@ setup(
         'zope.container',
         'zope.event',
         'zope.file',
+        'zope.generations',
         'zope.i18nmessageid',
         'zope.interface',
         'zope.intid',
@@ -28,6 +28,9 @@ PURCHASABLES = 'purchasables'
 
 DEFAULT_STRIPE_KEY_ALIAS = u'default'
 
+#: Purchase context key of the site a purchase was made in
+SITE_CONTEXT_KEY = 'Site'
+
 # Stripe Connect OAuth Redirect for Authorization
 STRIPE_CONNECT_AUTH = 'stripe_connect_oauth1'
 
@@ -31,6 +31,9 @@ from nti.store.payments.stripe.interfaces import IStripeConnectKeyContainer
 
 logger = __import__('logging').getLogger(__name__)
 
+#: Purchasable ACEs by (provider class, public flag); they only depend on them
+_purchasable_aces = {}
+
 
 @component.adapter(IPurchasable)
 @interface.implementer(IACLProvider)
@@ -39,15 +42,24 @@ class PurchasableACLProvider(object):
     def __init__(self, context):
         self.context = context
 
-    @Lazy
-    def __acl__(self):
-        aces = [ace_allowing(ROLE_ADMIN, ALL_PERMISSIONS, type(self)),
-                ace_allowing(ROLE_CONTENT_ADMIN, ALL_PERMISSIONS, type(self))]
-        if self.context.isPublic():
-            aces.append(ace_allowing(EVERYONE_USER_NAME, ACT_READ, type(self)))
+    @classmethod
+    def _make_acl(cls, public):
+        aces = [ace_allowing(ROLE_ADMIN, ALL_PERMISSIONS, cls),
+                ace_allowing(ROLE_CONTENT_ADMIN, ALL_PERMISSIONS, cls)]
+        if public:
+            aces.append(ace_allowing(EVERYONE_USER_NAME, ACT_READ, cls))
         result = acl_from_aces(aces)
         return result
 
+    @Lazy
+    def __acl__(self):
+        key = (type(self), bool(self.context.isPublic()))
+        aces = _purchasable_aces.get(key)
+        if aces is None:
+            aces = _purchasable_aces[key] = tuple(self._make_acl(key[1]))
+        # callers get their own ACL
+        return acl_from_aces(list(aces))
+
 
 @component.adapter(IStripeConnectKeyContainer)
 @interface.implementer(IACLProvider)
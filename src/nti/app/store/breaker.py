@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Circuit breakers around Stripe calls.
+
+There is a breaker per Stripe operation and connect key. Each call runs
+within the latency budget of its operation; calls that time out or fail
+because Stripe is unavailable are counted as failures. Calls of
+operations that change Stripe state (e.g. refunds) are never interrupted,
+since Stripe may have applied them already, and rely on the HTTP client
+timeouts instead. Once a breaker
+sees enough consecutive failures it opens and calls fail fast until its
+reset timeout elapses. A single probe call is then let through
+(half-open): the breaker closes if it succeeds and opens again otherwise.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import hashlib
+import threading
+
+import gevent
+
+import requests
+import stripe
+
+#: Breaker states
+CLOSED = u'closed'
+OPEN = u'open'
+HALF_OPEN = u'half-open'
+
+#: Breaker operations
+ACCOUNT = u'account'
+REFUND = u'refund'
+LIST_COUPONS = u'list_coupons'
+CREATE_TOKEN = u'create_token'
+VALIDATE_COUPON = u'validate_coupon'
+
+#: Consecutive failures that open a breaker
+DEFAULT_FAILURE_THRESHOLD = 5
+
+#: Seconds a breaker stays open before a probe call is let through
+DEFAULT_RESET_TIMEOUT = 30
+
+#: Default seconds a call may take
+DEFAULT_LATENCY_BUDGET = 10
+
+#: Seconds a call of each operation may take
+LATENCY_BUDGETS = {
+    ACCOUNT: 5,
+    LIST_COUPONS: 30,
+    CREATE_TOKEN: 10,
+    VALIDATE_COUPON: 3,
+}
+
+#: Operations that change Stripe state, which have no latency budget
+MUTATIONS = (REFUND,)
+
+#: Errors that denote Stripe is unavailable
+OUTAGE_ERRORS = (requests.RequestException,
+                 stripe.error.APIError,
+                 stripe.error.RateLimitError,
+                 stripe.error.APIConnectionError)
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """
+    Raised when a call is rejected by an open breaker.
+    """
+
+    def __init__(self, operation, retry_after):
+        super(CircuitOpen, self).__init__(operation, retry_after)
+        self.operation = operation
+        self.retry_after = retry_after
+
+
+class LatencyBudgetExceeded(Exception):
+    """
+    Raised when a call takes longer than its latency budget.
+    """
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, operation, key=None,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 budget=None):
+        self.key = key
+        self.operation = operation
+        self.reset_timeout = reset_timeout
+        self.failure_threshold = failure_threshold
+        if not budget and operation not in MUTATIONS:
+            budget = LATENCY_BUDGETS.get(operation, DEFAULT_LATENCY_BUDGET)
+        self.budget = budget
+        self.failures = 0
+        self.openedTime = None
+        self.lastFailure = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.openedTime is None:
+            return CLOSED
+        if time.time() - self.openedTime < self.reset_timeout:
+            return OPEN
+        return HALF_OPEN
+
+    @property
+    def retry_after(self):
+        if self.openedTime is None:
+            return 0
+        remaining = self.reset_timeout - (time.time() - self.openedTime)
+        return max(int(remaining), 1)
+
+    def allow(self):
+        """
+        Return whether a call can be made. Only one probe call is let
+        through while the breaker is half-open.
+        """
+        with self._lock:
+            state = self.state
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.openedTime is not None:
+                logger.info("Closing %s circuit breaker", self.operation)
+            self.failures = 0
+            self.openedTime = None
+            self._probing = False
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self.failures += 1
+            self.lastFailure = repr(error) if error is not None else None
+            if     self._probing \
+                or self.failures >= self.failure_threshold:
+                if self.openedTime is None or self._probing:
+                    logger.warning("Opening %s circuit breaker (%s)",
+                                   self.operation, self.lastFailure)
+                self.openedTime = time.time()
+            self._probing = False
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call the specified function within the latency budget of the
+        breaker operation, if any. Raises :class:`CircuitOpen` if the
+        breaker does not let the call through.
+        """
+        if not self.allow():
+            raise CircuitOpen(self.operation, self.retry_after)
+        # a timeout with no seconds never expires
+        timeout = gevent.Timeout(self.budget,
+                                 LatencyBudgetExceeded(self.operation))
+        timeout.start()
+        try:
+            result = func(*args, **kwargs)
+        except (LatencyBudgetExceeded,) + OUTAGE_ERRORS as e:
+            self.record_failure(e)
+            raise
+        except BaseException:
+            # not an outage (e.g. a card error) or the greenlet was
+            # killed; the breaker is left as is and another probe let
+            # through
+            with self._lock:
+                self._probing = False
+            raise
+        finally:
+            timeout.cancel()
+        self.record_success()
+        return result
+
+    def __repr__(self):
+        return "<CircuitBreaker %s %s>" % (self.operation, self.state)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def _key_hash(key):
+    if not key:
+        return None
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+
+def get_breaker(operation, key=None):
+    """
+    Return the breaker of the specified operation and connect key.
+    """
+    name = (operation, _key_hash(key))
+    with _breakers_lock:
+        result = _breakers.get(name)
+        if result is None:
+            result = _breakers[name] = CircuitBreaker(operation, name[1])
+    return result
+
+
+def get_breakers():
+    with _breakers_lock:
+        return list(_breakers.values())
+
+
+def call_with_breaker(operation, key, func, *args, **kwargs):
+    """
+    Call the specified function through the breaker of the given
+    operation and connect key.
+    """
+    breaker = get_breaker(operation, key)
+    return breaker.call(func, *args, **kwargs)
+
+
+def reset_breakers():
+    with _breakers_lock:
+        _breakers.clear()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(reset_breakers)
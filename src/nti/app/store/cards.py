@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local validation of payment cards.
+
+Card numbers, CVCs and expiry dates are checked before a token is
+requested from the payment processor, so malformed cards fail without
+a round trip.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import re
+from datetime import date
+
+from nti.app.store import MessageFactory as _
+
+#: Card brands, as named by Stripe
+JCB = u'JCB'
+VISA = u'Visa'
+DISCOVER = u'Discover'
+UNIONPAY = u'UnionPay'
+MASTERCARD = u'MasterCard'
+DINERS_CLUB = u'Diners Club'
+AMERICAN_EXPRESS = u'American Express'
+
+#: (brand, number prefix pattern, number lengths, CVC length)
+BRANDS = (
+    (VISA, re.compile(r'^4'), (13, 16, 19), 3),
+    (MASTERCARD,
+     re.compile(r'^(5[1-5]|222[1-9]|22[3-9]|2[3-6]|27[01]|2720)'), (16,), 3),
+    (AMERICAN_EXPRESS, re.compile(r'^3[47]'), (15,), 4),
+    (DISCOVER, re.compile(r'^(6011|64[4-9]|65)'), (16, 17, 18, 19), 3),
+    (DINERS_CLUB, re.compile(r'^(30[0-5]|3095|36|3[89])'), (14, 15, 16, 17, 18, 19), 3),
+    (JCB, re.compile(r'^(352[89]|35[3-8])'), (16, 17, 18, 19), 3),
+    (UNIONPAY, re.compile(r'^62'), (16, 17, 18, 19), 3),
+)
+
+#: Number lengths of unknown brands
+DEFAULT_LENGTHS = tuple(range(12, 20))
+
+#: CVC lengths of unknown brands
+DEFAULT_CVC_LENGTHS = (3, 4)
+
+#: Expiry formats: MMYY, MYY, MM/YY, M/YY, MM/YYYY and M/YYYY
+EXPIRY_PATTERN = re.compile(r'^(?:(\d{1,2})\s*[/\-]\s*(\d{2}|\d{4})|(\d{1,2})(\d{2}))$')
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class InvalidCard(ValueError):
+    """
+    Raised when a card is not valid. Its ``errors`` are a list of
+    ``(field, message, code)`` tuples.
+    """
+
+    def __init__(self, errors):
+        super(InvalidCard, self).__init__(errors)
+        self.errors = errors
+
+
+def clean_number(number):
+    """
+    Return the specified card number without spaces and dashes.
+    """
+    return re.sub(r'[\s\-]', u'', number or u'')
+
+
+def luhn_check(number):
+    """
+    Return whether the specified card number passes the Luhn checksum.
+    """
+    if not number or not number.isdigit():
+        return False
+    total = 0
+    for idx, digit in enumerate(reversed(number)):
+        value = int(digit)
+        if idx % 2:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return total % 10 == 0
+
+
+def detect_brand(number):
+    """
+    Return the brand of the specified card number or ``None`` if unknown.
+    """
+    for brand, pattern, unused_lengths, unused_cvc in BRANDS:
+        if pattern.match(number or u''):
+            return brand
+    return None
+
+
+def _brand_spec(brand):
+    for spec in BRANDS:
+        if spec[0] == brand:
+            return spec
+    return None
+
+
+def parse_expiry(expiry):
+    """
+    Return the ``(month, year)`` of the specified expiry date, with a four
+    digit year, or ``None`` if it cannot be parsed.
+    """
+    match = EXPIRY_PATTERN.match((expiry or u'').strip())
+    if match is None:
+        return None
+    month, year = match.group(1, 2) if match.group(1) else match.group(3, 4)
+    month, year = int(month), int(year)
+    if year < 100:
+        year += 2000
+    if month < 1 or month > 12:
+        return None
+    return month, year
+
+
+def is_expired(month, year, today=None):
+    # cards are valid through the end of their expiry month
+    today = today or date.today()
+    return (year, month) < (today.year, today.month)
+
+
+def validate_card(number, cvc, expiry, today=None):
+    """
+    Validate the specified card and return a dictionary with its cleaned
+    ``number``, ``cvc``, ``exp_month``, ``exp_year`` and ``brand``.
+    Raises :class:`InvalidCard` with the errors of every invalid field.
+    """
+    errors = []
+    number = clean_number(number)
+    brand = detect_brand(number)
+    spec = _brand_spec(brand)
+    lengths = spec[2] if spec else DEFAULT_LENGTHS
+    if not number.isdigit() or len(number) not in lengths:
+        errors.append(('number', _(u"Invalid card number."), u'InvalidNumber'))
+    elif not luhn_check(number):
+        errors.append(('number', _(u"Invalid card number."), u'IncorrectNumber'))
+
+    cvc = (cvc or u'').strip()
+    cvc_lengths = (spec[3],) if spec else DEFAULT_CVC_LENGTHS
+    if not cvc.isdigit() or len(cvc) not in cvc_lengths:
+        errors.append(('cvc', _(u"Invalid security code."), u'InvalidCVC'))
+
+    parsed = parse_expiry(expiry)
+    if parsed is None:
+        errors.append(('expiry', _(u"Invalid expiration date."), u'InvalidExpiry'))
+    elif is_expired(parsed[0], parsed[1], today):
+        errors.append(('expiry', _(u"Card has expired."), u'ExpiredCard'))
+
+    if errors:
+        raise InvalidCard(errors)
+    return {
+        'cvc': cvc,
+        'brand': brand,
+        'number': number,
+        'exp_month': u'%02d' % parsed[0],
+        'exp_year': u'%d' % parsed[1],
+    }
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Purchase state and charge indexes of the purchase catalog.
+
+The indexes are installed in the purchase catalog by the store
+generations and when the catalog is rebuilt. Until then, pending purchase
+lookups fall back to walking the purchase history.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from weakref import WeakKeyDictionary
+
+import transaction
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from zope.location import locate
+
+from nti.store.index import IX_ITEMS
+from nti.store.index import IX_CREATOR
+from nti.store.index import get_purchase_catalog
+
+from nti.store.interfaces import PA_STATE_PENDING
+from nti.store.interfaces import PA_STATE_STARTED
+
+from nti.store.interfaces import IPurchaseAttempt
+from nti.store.interfaces import IGiftPurchaseAttempt
+
+from nti.store.payments.stripe.interfaces import IStripePurchaseAttempt
+
+from nti.store.store import get_gift_registry
+from nti.store.store import get_purchase_history
+from nti.store.store import get_pending_purchases as store_get_pending_purchases
+from nti.store.store import get_gift_pending_purchases as store_get_gift_pending_purchases
+
+from nti.zope_catalog.index import AttributeValueIndex as ValueIndex
+
+#: Purchase state index name
+IX_STATE = 'state'
+
+#: Purchase charge index name
+IX_CHARGE = 'chargeID'
+
+#: States of pending purchases
+PENDING_STATES = (PA_STATE_PENDING, PA_STATE_STARTED)
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class ValidatingPurchaseState(object):
+
+    __slots__ = ('State',)
+
+    def __init__(self, obj, unused_default=None):
+        if IPurchaseAttempt.providedBy(obj):
+            self.State = obj.State
+
+    def __reduce__(self):
+        raise TypeError()
+
+
+class PurchaseStateIndex(ValueIndex):
+    default_field_name = 'State'
+    default_interface = ValidatingPurchaseState
+
+
+class ValidatingPurchaseChargeID(object):
+
+    __slots__ = ('ChargeID',)
+
+    def __init__(self, obj, unused_default=None):
+        if IPurchaseAttempt.providedBy(obj):
+            stripe_purchase = IStripePurchaseAttempt(obj, None)
+            self.ChargeID = getattr(stripe_purchase, 'ChargeID', None)
+
+    def __reduce__(self):
+        raise TypeError()
+
+
+class PurchaseChargeIndex(ValueIndex):
+    default_field_name = 'ChargeID'
+    default_interface = ValidatingPurchaseChargeID
+
+
+def _get_index(name, catalog=None):
+    catalog = get_purchase_catalog() if catalog is None else catalog
+    try:
+        return catalog[name] if name in catalog else None
+    except (TypeError, KeyError):  # pragma: no cover
+        return None
+
+
+def _install_index(name, factory, catalog=None):
+    catalog = get_purchase_catalog() if catalog is None else catalog
+    result = _get_index(name, catalog)
+    if result is None:
+        intids = component.getUtility(IIntIds)
+        result = factory(family=intids.family)
+        locate(result, catalog, name)
+        catalog[name] = result
+    return result
+
+
+def get_purchase_state_index(catalog=None):
+    return _get_index(IX_STATE, catalog)
+
+
+def get_purchase_charge_index(catalog=None):
+    return _get_index(IX_CHARGE, catalog)
+
+
+def install_purchase_state_index(catalog=None):
+    """
+    Add the purchase state index to the purchase catalog. The caller is
+    responsible for indexing the existing purchases.
+    """
+    return _install_index(IX_STATE, PurchaseStateIndex, catalog)
+
+
+def install_purchase_charge_index(catalog=None):
+    """
+    Add the purchase charge index to the purchase catalog. The caller is
+    responsible for indexing the existing purchases.
+    """
+    return _install_index(IX_CHARGE, PurchaseChargeIndex, catalog)
+
+
+def _reindex(purchase):
+    intids = component.queryUtility(IIntIds)
+    doc_id = intids.queryId(purchase) if intids is not None else None
+    if doc_id is None:
+        return
+    for index in (get_purchase_state_index(), get_purchase_charge_index()):
+        if index is not None:
+            index.index_doc(doc_id, purchase)
+
+
+#: transaction -> {id: purchase} to reindex before it commits
+_pending_reindex = WeakKeyDictionary()
+
+
+def _reindex_all(txn):
+    purchases = _pending_reindex.pop(txn, None) or {}
+    for purchase in purchases.values():
+        _reindex(purchase)
+
+
+def queue_purchase_reindex(purchase):
+    """
+    Reindex the state and charge of the specified purchase when the
+    current transaction commits, once all the state transition handlers
+    ran. A single hook reindexes all the purchases of a transaction.
+    """
+    txn = transaction.get()
+    purchases = _pending_reindex.get(txn)
+    if purchases is None:
+        purchases = _pending_reindex[txn] = {}
+        txn.addBeforeCommitHook(_reindex_all, (txn,))
+    purchases[id(purchase)] = purchase
+
+
+def index_purchases(index, users_folder):
+    """
+    Index the purchases of every user of the specified users folder and
+    of the gift registry in the given index. Return the number of
+    purchases indexed.
+    """
+    def _purchases():
+        for user in users_folder.values():
+            for attempt in get_purchase_history(user, False) or ():
+                yield attempt
+        for container in get_gift_registry().values():
+            for obj in container.values():
+                yield obj
+    count = 0
+    intids = component.getUtility(IIntIds)
+    for obj in _purchases():
+        doc_id = intids.queryId(obj)
+        if doc_id is not None:
+            index.index_doc(doc_id, obj)
+            count += 1
+    return count
+
+
+def find_pending_purchases(creator, items=None, gift=False):
+    """
+    Return the pending purchases of the specified creator, optionally
+    limited to those of the given items, or ``None`` if the purchase
+    state index is not installed.
+    """
+    catalog = get_purchase_catalog()
+    if get_purchase_state_index(catalog) is None or not creator:
+        return None
+    creators = {creator, creator.lower()}
+    query = {
+        IX_STATE: {'any_of': PENDING_STATES},
+        IX_CREATOR: {'any_of': tuple(creators)},
+    }
+    if items:
+        query[IX_ITEMS] = {'any_of': tuple(items)}
+    result = []
+    intids = component.getUtility(IIntIds)
+    for doc_id in catalog.apply(query) or ():
+        obj = intids.queryObject(doc_id)
+        if      IPurchaseAttempt.providedBy(obj) \
+            and obj.is_pending() \
+            and IGiftPurchaseAttempt.providedBy(obj) == bool(gift):
+            result.append(obj)
+    return result
+
+
+def get_pending_purchases(username, items=None):
+    """
+    Return the pending purchases of the specified user.
+    """
+    result = find_pending_purchases(username, items)
+    if result is None:
+        result = store_get_pending_purchases(username, items)
+    return result
+
+
+def get_gift_pending_purchases(creator):
+    """
+    Return the pending gift purchases of the specified creator.
+    """
+    result = find_pending_purchases(creator, gift=True)
+    if result is None:
+        result = store_get_gift_pending_purchases(creator)
+    return result
+
+
+def find_purchases_by_charge(charge_id):
+    """
+    Return the purchases of the specified charge, or ``None`` if the
+    purchase charge index is not installed.
+    """
+    catalog = get_purchase_catalog()
+    if get_purchase_charge_index(catalog) is None or not charge_id:
+        return None
+    result = []
+    intids = component.getUtility(IIntIds)
+    query = {IX_CHARGE: {'any_of': (charge_id,)}}
+    for doc_id in catalog.apply(query) or ():
+        obj = intids.queryObject(doc_id)
+        if IPurchaseAttempt.providedBy(obj):
+            result.append(obj)
+    return result
+
+
+def find_all_pending_purchases():
+    """
+    Return all the pending purchases, or ``None`` if the purchase state
+    index is not installed.
+    """
+    catalog = get_purchase_catalog()
+    if get_purchase_state_index(catalog) is None:
+        return None
+    result = []
+    intids = component.getUtility(IIntIds)
+    query = {IX_STATE: {'any_of': PENDING_STATES}}
+    for doc_id in catalog.apply(query) or ():
+        obj = intids.queryObject(doc_id)
+        if IPurchaseAttempt.providedBy(obj) and obj.is_pending():
+            result.append(obj)
+    return result
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Connect key resolution.
+
+Connect keys are looked up through the site manager chain once per
+request, site and provider. Connect keys are persistent, so they are
+never kept past the request. The resolved keys are dropped when a key
+is added to or removed from a connect key container.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope import component
+
+from nti.app.store.utils import get_request_cache
+
+from nti.site.site import getSite
+
+from nti.store.payments.stripe.interfaces import IStripeConnectKey
+
+#: Request cache names of resolved (and externalized) connect keys
+CONNECT_KEYS_CACHE = 'connect_keys'
+EXTERNAL_CONNECT_KEYS_CACHE = 'stripe_connect_keys'
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def resolve_connect_key(provider, key_interface=IStripeConnectKey, request=None):
+    """
+    Return the connect key of the specified provider in the current site.
+    """
+    cache = get_request_cache(CONNECT_KEYS_CACHE, request)
+    key = (getattr(getSite(), '__name__', None), key_interface, provider)
+    try:
+        result = cache[key]
+    except KeyError:
+        result = component.queryUtility(key_interface, provider or u'')
+        cache[key] = result
+    return result
+
+
+def invalidate_connect_keys(request=None):
+    """
+    Drop the connect keys resolved by the specified (or current) request.
+    """
+    for name in (CONNECT_KEYS_CACHE, EXTERNAL_CONNECT_KEYS_CACHE):
+        get_request_cache(name, request).clear()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local mirror of the Stripe coupons of each connect key.
+
+Each mirror keeps positive (coupon exists, with its validity) and
+negative (no such coupon) entries. It is refreshed in bulk from Stripe in
+a background greenlet, through the coupon listing circuit breaker, when
+it becomes stale. Coupons that are not known locally are validated
+remotely and the answers, valid or not, are kept for a short time.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import hashlib
+import threading
+
+import gevent
+
+import stripe
+
+from nti.app.store.breaker import LIST_COUPONS
+
+from nti.app.store.breaker import call_with_breaker
+
+#: Seconds after which a mirror is refreshed from Stripe
+REFRESH_INTERVAL = 900
+
+#: Seconds a negative (no such coupon) entry is kept
+NEGATIVE_TTL = 300
+
+#: Seconds a remotely validated coupon is kept
+REMOTE_TTL = 300
+
+#: Max number of negative entries per mirror
+MAX_NEGATIVE_ENTRIES = 1000
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _redeem_by(coupon):
+    return getattr(coupon, 'redeem_by', None)
+
+
+def _is_valid(coupon):
+    redeem_by = _redeem_by(coupon)
+    return  getattr(coupon, 'valid', True) is not False \
+        and (not redeem_by or redeem_by > time.time())
+
+
+class CouponMirror(object):
+    """
+    The coupons of a connect key.
+    """
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.lastSynchronized = 0
+        self._lock = threading.RLock()
+        self._refreshing = False
+        self._positive = {}
+        self._negative = {}
+
+    @property
+    def stale(self):
+        return time.time() - self.lastSynchronized >= REFRESH_INTERVAL
+
+    def record(self, code, coupon=None, valid=None, ttl=None):
+        """
+        Record the specified coupon. A ``None`` coupon with no validity
+        records a negative entry. Positive entries with a time-to-live (in
+        seconds) expire; the others are kept until the next refresh.
+        """
+        with self._lock:
+            if coupon is None and valid is None:
+                self._positive.pop(code, None)
+                if len(self._negative) >= MAX_NEGATIVE_ENTRIES:
+                    self._negative.clear()
+                self._negative[code] = time.time() + NEGATIVE_TTL
+            else:
+                self._negative.pop(code, None)
+                if valid is None:
+                    valid = _is_valid(coupon)
+                expires = time.time() + ttl if ttl else None
+                self._positive[code] = (bool(valid), _redeem_by(coupon), expires)
+
+    def lookup(self, code):
+        """
+        Return ``True`` if the coupon is known to be valid, ``False`` if it
+        is known to be invalid or not to exist and ``None`` if unknown.
+        """
+        with self._lock:
+            now = time.time()
+            entry = self._positive.get(code)
+            if entry is not None:
+                valid, redeem_by, expires = entry
+                if expires is None or expires > now:
+                    return valid and (not redeem_by or redeem_by > now)
+                del self._positive[code]
+                return None
+            expires = self._negative.get(code)
+            if expires is not None:
+                if expires > time.time():
+                    return False
+                del self._negative[code]
+        return None
+
+    def is_missing(self, code):
+        with self._lock:
+            return code not in self._positive \
+               and self._negative.get(code, 0) > time.time()
+
+    def _list_coupons(self):
+        result = {}
+        coupons = stripe.Coupon.list(api_key=self.api_key, limit=100)
+        for coupon in coupons.auto_paging_iter():
+            result[coupon.id] = (_is_valid(coupon), _redeem_by(coupon), None)
+        return result
+
+    def refresh(self):
+        """
+        Replace the positive entries with the coupons of the connect key.
+        """
+        positive = call_with_breaker(LIST_COUPONS, self.api_key,
+                                     self._list_coupons)
+        with self._lock:
+            self._positive = positive
+            for code in positive:
+                self._negative.pop(code, None)
+            self.lastSynchronized = time.time()
+        return len(positive)
+
+    def _safe_refresh(self):
+        try:
+            self.refresh()
+        except Exception:  # pylint: disable=broad-except
+            # try again later
+            self.lastSynchronized = time.time()
+            logger.exception("Cannot refresh stripe coupons")
+        finally:
+            self._refreshing = False
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return None
+            self._refreshing = True
+        return gevent.spawn(self._safe_refresh)
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def _mirror_key(api_key):
+    return hashlib.sha1(api_key.encode('utf-8')).hexdigest()
+
+
+def get_coupon_mirror(api_key):
+    """
+    Return the coupon mirror of the specified connect key. A background
+    refresh is started when the mirror is stale.
+    """
+    key = _mirror_key(api_key)
+    with _mirrors_lock:
+        result = _mirrors.get(key)
+        if result is None:
+            result = _mirrors[key] = CouponMirror(api_key)
+    if result.stale:
+        result.refresh_in_background()
+    return result
+
+
+def validate_coupon(code, api_key, remote):
+    """
+    Return whether the specified coupon is valid, answering from the local
+    mirror when possible. On a miss the ``remote(code, api_key)`` validator
+    is called and its answer recorded for a short time.
+    """
+    mirror = get_coupon_mirror(api_key)
+    result = mirror.lookup(code)
+    if result is None:
+        result = bool(remote(code, api_key))
+        mirror.record(code, valid=result,
+                      ttl=REMOTE_TTL if result else NEGATIVE_TTL)
+    return result
+
+
+def record_missing_coupon(code, api_key):
+    get_coupon_mirror(api_key).record(code)
+
+
+def is_missing_coupon(code, api_key):
+    """
+    Return whether the specified coupon is known not to exist.
+    """
+    return get_coupon_mirror(api_key).is_missing(code)
+
+
+def clear_coupon_mirrors():
+    with _mirrors_lock:
+        _mirrors.clear()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(clear_coupon_mirrors)
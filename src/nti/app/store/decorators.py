@@ -8,6 +8,12 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import copy
+
+from pyramid.threadlocal import get_current_request
+
+from requests.structures import CaseInsensitiveDict
+
 from six.moves import urllib_parse
 
 from ZODB.interfaces import IConnection
@@ -27,8 +33,16 @@ from nti.app.store import STORE
 from nti.app.store import STRIPE
 from nti.app.store import PURCHASABLES
 
+from nti.app.store.cache import LRUCache
+
+from nti.app.store.connect_keys import resolve_connect_key
+from nti.app.store.connect_keys import EXTERNAL_CONNECT_KEYS_CACHE
+
 from nti.app.store.interfaces import IStripeIntegration
 
+from nti.app.store.utils import get_request_cache
+from nti.app.store.utils import is_field_requested
+
 from nti.appserver.pyramid_authorization import has_permission
 
 from nti.appserver.workspaces.interfaces import ICatalogWorkspaceLinkProvider
@@ -51,19 +65,19 @@ from nti.links.links import Link
 
 from nti.ntiids.ntiids import find_object_with_ntiid
 
+from nti.site.site import getSite
+
 from nti.store.interfaces import IPurchasable
 from nti.store.interfaces import IPurchaseItem
 
 from nti.store.payments.stripe.authorization import ACT_LINK_STRIPE
 from nti.store.payments.stripe.authorization import ACT_VIEW_STRIPE_ACCOUNT
 
-from nti.store.payments.stripe.interfaces import IStripeConnectKey
-
 from nti.store.payments.stripe.storage import get_stripe_key_container
 
+from nti.store.purchase_history import get_purchase_history
+
 from nti.store.store import get_purchasable
-from nti.store.store import is_item_activated
-from nti.store.store import has_history_by_item
 
 ITEMS = StandardExternalFields.ITEMS
 LINKS = StandardExternalFields.LINKS
@@ -71,6 +85,14 @@ LINKS = StandardExternalFields.LINKS
 logger = __import__('logging').getLogger(__name__)
 
 
+def get_ds_store_path(request):
+    try:
+        ds2 = request.path_info_peek()
+    except AttributeError:  # in unit test we see this
+        ds2 = "dataserver2"
+    return '/%s/%s/' % (ds2, STORE)
+
+
 @interface.implementer(IExternalObjectDecorator)
 class _BaseRequestAwareDecorator(AbstractAuthenticatedRequestAwareDecorator):
 
@@ -79,34 +101,77 @@ class _BaseRequestAwareDecorator(AbstractAuthenticatedRequestAwareDecorator):
 
     @property
     def ds_store_path(self):
-        request = self.request
-        try:
-            ds2 = request.path_info_peek()
-        except AttributeError:  # in unit test we see this
-            ds2 = "dataserver2"
-        ds_store_path = '/%s/%s/' % (ds2, STORE)
-        return ds_store_path
+        return get_ds_store_path(self.request)
+
+
+def get_user_purchase_state(username, request=None):
+    """
+    Return the sets of activated and purchased (history) items of the
+    specified user. The purchase history is read once per request and
+    both sets are computed from its attempts.
+    """
+    cache = get_request_cache('purchase_state', request)
+    if username not in cache:
+        activated = set()
+        history_items = set()
+        for purchase in get_purchase_history(username) or ():
+            items = purchase.Items or ()
+            history_items.update(items)
+            # items are activated by successful purchases and deactivated
+            # when they are refunded
+            if purchase.has_succeeded():
+                activated.update(items)
+        cache[username] = (activated, history_items)
+    return cache[username]
+
+
+def has_edit_permission(purchasable, request):
+    """
+    Return whether the remote user can edit the specified purchasable.
+    Decisions are cached per request by the state the ACL of purchasables
+    depends on: their type, parent (site) and public flag.
+    """
+    cache = get_request_cache('purchasable_edit_permission', request)
+    parent = getattr(purchasable, '__parent__', None)
+    key = (type(purchasable), id(parent), bool(purchasable.isPublic()))
+    if key not in cache:
+        cache[key] = bool(has_permission(ACT_CONTENT_EDIT, purchasable, request))
+    return cache[key]
+
+
+def decorate_user_fields(purchasable, external, request, username=None):
+    """
+    Add the fields of the external form of the specified purchasable that
+    depend on the remote user: the ``Activated`` flag and history link.
+    """
+    username = username or getattr(request, 'authenticated_userid', None)
+    if not username:
+        return external
+    activated, history = get_user_purchase_state(username, request)
+    if is_field_requested('Activated', request):
+        external['Activated'] = purchasable.NTIID in activated
+    if      purchasable.Amount \
+        and purchasable.NTIID in history \
+        and is_field_requested(LINKS, request):
+        history_href = get_ds_store_path(request) + '@@get_purchase_history'
+        quoted = urllib_parse.quote(purchasable.NTIID)
+        link = Link(history_href,
+                    rel="history",
+                    method='GET',
+                    params={'ntiid': quoted})
+        interface.alsoProvides(link, ILocation)
+        external.setdefault(LINKS, []).append(link)
+    return external
 
 
 @component.adapter(IPurchasable)
 class _PurchasableDecorator(_BaseRequestAwareDecorator):
 
-    def set_links(self, original, external, username=None):
+    def set_links(self, original, external):
         links = external.setdefault(LINKS, [])
         ds_store_path = self.ds_store_path
 
         if original.Amount:
-            # insert history link
-            if username and has_history_by_item(username, original.NTIID):
-                history_href = ds_store_path + '@@get_purchase_history'
-                quoted = urllib_parse.quote(original.NTIID)
-                link = Link(history_href,
-                            rel="history",
-                            method='GET',
-                            params={'ntiid': quoted})
-                interface.alsoProvides(link, ILocation)
-                links.append(link)
-
             # insert price link
             for name in ('price', 'price_purchasable'):
                 price_href = ds_store_path + '@@price_purchasable'
@@ -120,26 +185,46 @@ class _PurchasableDecorator(_BaseRequestAwareDecorator):
             interface.alsoProvides(link, ILocation)
             links.append(link)
 
-    def add_activation(self, username, original, external):
-        activated = is_item_activated(username, original.NTIID)
-        external['Activated'] = activated
-
     def _do_decorate_external(self, original, external):
         if self._is_authenticated:
-            username = self.remoteUser.username
-            self.add_activation(username, original, external)
-        else:
-            username = None
-        self.set_links(original, external, username)
+            decorate_user_fields(original, external, self.request,
+                                 self.remoteUser.username)
+        if is_field_requested(LINKS, self.request):
+            self.set_links(original, external)
+
+
+#: Externalized connect keys by (site, provider, lastModified)
+_connect_key_cache = LRUCache(maxsize=100)
+
+
+def get_external_connect_key(provider, request=None):
+    """
+    Return the specified stripe connect key and its external form. The key
+    is externalized once per site and key modification.
+    """
+    cache = get_request_cache(EXTERNAL_CONNECT_KEYS_CACHE, request)
+    if provider not in cache:
+        external = None
+        connect_key = resolve_connect_key(provider, request=request)
+        if connect_key is not None:
+            key = (getattr(getSite(), '__name__', None),
+                   provider,
+                   getattr(connect_key, 'lastModified', 0))
+            external = _connect_key_cache.get(key)
+            if external is None:
+                external = to_external_object(connect_key)
+                _connect_key_cache.set(key, external)
+        cache[provider] = (connect_key, external)
+    return cache[provider]
 
 
 @component.adapter(IPurchasable)
 class _StripePurchasableDecorator(_BaseRequestAwareDecorator):
 
-    def set_links(self, original, external):
+    def _make_links(self, provider, giftable):
+        result = []
         stripe_path = '%s/%s/' % (self.ds_store_path, STRIPE)
-        links = external.setdefault(LINKS, [])
-        quoted = urllib_parse.quote(original.Provider)
+        quoted = urllib_parse.quote(provider)
         # set common links
         for name, rel, meth in (
                 ('create_token', 'create_stripe_token', 'POST'),
@@ -152,26 +237,37 @@ class _StripePurchasableDecorator(_BaseRequestAwareDecorator):
                         method=meth,
                         params=params)
             interface.alsoProvides(link, ILocation)
-            links.append(link)
+            result.append(link)
         # set links authenticated users
         if self._is_authenticated:
             href = stripe_path + '@@post_payment'
             link = Link(href, rel="post_stripe_payment", method='POST')
             interface.alsoProvides(link, ILocation)
-            links.append(link)
+            result.append(link)
         # set links giftable objects
-        if original.Giftable:
+        if giftable:
             href = stripe_path + '@@gift_payment'
             link = Link(href, rel="gift_stripe_payment", method='POST')
             interface.alsoProvides(link, ILocation)
-            links.append(link)
+            result.append(link)
+        return tuple(result)
+
+    def set_links(self, original, external):
+        # links only depend on the provider and giftable flag
+        cache = get_request_cache('stripe_purchasable_links', self.request)
+        key = (original.Provider, bool(original.Giftable))
+        if key not in cache:
+            cache[key] = self._make_links(*key)
+        external.setdefault(LINKS, []).extend(cache[key])
 
     def _do_decorate_external(self, original, external):
         keyname = original.Provider
-        result = component.queryUtility(IStripeConnectKey, keyname)
-        if result is not None and original.Amount:
-            self.set_links(original, external)
-            external['StripeConnectKey'] = to_external_object(result)
+        connect_key, ext_key = get_external_connect_key(keyname, self.request)
+        if connect_key is not None and original.Amount:
+            if is_field_requested(LINKS, self.request):
+                self.set_links(original, external)
+            if is_field_requested('StripeConnectKey', self.request):
+                external['StripeConnectKey'] = copy.copy(ext_key)
 
 
 @component.adapter(IPurchasable)
@@ -192,7 +288,8 @@ class _PurchasableEditionLinksDecorator(_BaseRequestAwareDecorator):
     def _predicate(self, context, unused_result):
         return (    self._acl_decoration
                 and self._is_authenticated
-                and has_permission(ACT_CONTENT_EDIT, context, self.request))
+                and is_field_requested(LINKS, self.request)
+                and has_edit_permission(context, self.request))
 
     def _do_decorate_external(self, context, result):
         _links = []
@@ -216,18 +313,83 @@ class _PurchasableEditionLinksDecorator(_BaseRequestAwareDecorator):
             result.setdefault(LINKS, []).append(link)
 
 
+#: Purchase item expansion modes
+SHALLOW_EXPANSION = 'shallow'
+FULL_EXPANSION = 'full'
+
+#: Item summaries by ntiid
+_item_summary_cache = LRUCache(maxsize=1000)
+
+
+def invalidate_item_summary(ntiid):
+    _item_summary_cache.pop(ntiid)
+
+
+def get_item_summary(ntiid, item, request=None):
+    """
+    Return a summary (NTIID, Title, MimeType and href) of the specified
+    purchase item. The request independent fields are cached until the
+    item is modified; the href is computed for the given request.
+    """
+    last_modified, summary = _item_summary_cache.get(ntiid, (None, None))
+    if summary is None or last_modified != getattr(item, 'lastModified', 0):
+        title = getattr(item, 'title', None) or getattr(item, 'Title', None)
+        mime_type = getattr(item, 'mimeType', None) \
+                 or getattr(item, 'mime_type', None)
+        summary = {
+            'NTIID': ntiid,
+            'Title': title,
+            'MimeType': mime_type,
+        }
+        _item_summary_cache.set(ntiid,
+                                (getattr(item, 'lastModified', 0), summary))
+    try:
+        ds2 = request.path_info_peek()
+    except AttributeError:
+        ds2 = "dataserver2"
+    result = dict(summary)
+    result['href'] = '/%s/Objects/%s' % (ds2, urllib_parse.quote(ntiid))
+    return result
+
+
+def get_expansion(request=None):
+    """
+    Return the purchase item expansion mode requested by the client.
+    """
+    params = getattr(request, 'params', None) or {}
+    result = CaseInsensitiveDict(params).get('expand')
+    return SHALLOW_EXPANSION if result == SHALLOW_EXPANSION else FULL_EXPANSION
+
+
 @component.adapter(IPurchaseItem)
 @interface.implementer(IExternalObjectDecorator)
 class _PurchaseItemDecorator(Singleton):
 
+    def _expand(self, ntiid, expansion, request):
+        cache = get_request_cache('purchase_items_' + expansion, request)
+        if ntiid not in cache:
+            item = find_object_with_ntiid(ntiid)
+            if item is None:
+                result = None
+            elif expansion == SHALLOW_EXPANSION:
+                result = get_item_summary(ntiid, item, request)
+            else:
+                result = to_external_object(item)
+            cache[ntiid] = result
+        return cache[ntiid]
+
     def decorateExternalObject(self, original, external):
+        request = get_current_request()
+        # purchase items are either purchasables or in purchase orders
+        if not is_field_requested((ITEMS, 'Order'), request):
+            return
         purchasable = get_purchasable(original.NTIID)
         if purchasable:
+            expansion = get_expansion(request)
             external[ITEMS] = items = []
-            for item in purchasable.Items:
-                item = find_object_with_ntiid(item)
+            for ntiid in purchasable.Items:
+                item = self._expand(ntiid, expansion, request)
                 if item is not None:
-                    item = to_external_object(item)
                     items.append(item)
 
 
@@ -260,8 +422,8 @@ class _AbstractStripeIntegrationDecorator(AbstractAuthenticatedRequestAwareDecor
 
     @Lazy
     def _stripe_connect_key(self):
-        return component.queryUtility(IStripeConnectKey,
-                                      name=DEFAULT_STRIPE_KEY_ALIAS)
+        return resolve_connect_key(DEFAULT_STRIPE_KEY_ALIAS,
+                                   request=self.request)
 
     @Lazy
     def _stripe_key_container(self):
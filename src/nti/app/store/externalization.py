@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cached external forms of purchasables.
+
+The undecorated external form of a purchasable only depends on the
+purchasable itself. It is built once per site and purchasable
+modification; the decorators, which add request and user specific data,
+run on a copy of it for each request.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import copy
+
+from pyramid.threadlocal import get_current_request
+
+from nti.app.store.cache import LRUCache
+
+from nti.app.store.utils import filter_fields
+
+from nti.externalization.externalization import to_external_object
+from nti.externalization.externalization import decorate_external_mapping
+
+from nti.site.site import getSite
+
+logger = __import__('logging').getLogger(__name__)
+
+#: Undecorated external purchasables by (site, ntiid, lastModified)
+_purchasable_cache = LRUCache(maxsize=2000)
+
+#: External purchasable vendor info by (site, ntiid, lastModified)
+_vendor_info_cache = LRUCache(maxsize=2000)
+
+
+def invalidate_external_purchasable(ntiid):
+    _purchasable_cache.invalidate(lambda x: x[1] == ntiid)
+    _vendor_info_cache.invalidate(lambda x: x[1] == ntiid)
+
+
+def externalize_purchasable(purchasable, request=None):
+    """
+    Return the external form of the specified purchasable decorated for
+    the given (or current) request.
+    """
+    request = request if request is not None else get_current_request()
+    key = (getattr(getSite(), '__name__', None),
+           purchasable.NTIID,
+           getattr(purchasable, 'lastModified', 0))
+    external = _purchasable_cache.get(key)
+    if external is None:
+        external = to_external_object(purchasable, decorate=False)
+        _purchasable_cache.set(key, external)
+    # decorators may change nested values
+    result = copy.deepcopy(external)
+    decorate_external_mapping(purchasable, result, request=request)
+    return filter_fields(result, request)
+
+
+def externalize_vendor_info(purchasable):
+    """
+    Return (a copy of) the external form of the vendor info of the
+    specified purchasable or ``None`` if it has none.
+    """
+    if not purchasable.VendorInfo:
+        return None
+    key = (getattr(getSite(), '__name__', None),
+           purchasable.NTIID,
+           getattr(purchasable, 'lastModified', 0))
+    external = _vendor_info_cache.get(key)
+    if external is None:
+        external = to_external_object(purchasable.VendorInfo)
+        _vendor_info_cache.set(key, external)
+    # callers may store it in persistent purchase contexts
+    return copy.deepcopy(external)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Install the purchase charge index and index the existing purchases.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+generation = 3
+
+from zope import component
+
+from zope.component.hooks import setHooks
+from zope.component.hooks import site as current_site
+
+from nti.app.store.catalog import index_purchases
+from nti.app.store.catalog import get_purchase_charge_index
+from nti.app.store.catalog import install_purchase_charge_index
+
+from nti.app.store.generations.evolve1 import MockDataserver
+
+from nti.dataserver.interfaces import IDataserver
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def do_evolve(context, generation=generation):
+    setHooks()
+    conn = context.connection
+    root = conn.root()
+    ds_folder = root['nti.dataserver']
+
+    mock_ds = MockDataserver()
+    mock_ds.root = ds_folder
+    component.provideUtility(mock_ds, IDataserver)
+
+    count = 0
+    with current_site(ds_folder):
+        assert component.getSiteManager() == ds_folder.getSiteManager(), \
+               "Hooks not installed?"
+        if get_purchase_charge_index() is None:
+            index = install_purchase_charge_index()
+            count = index_purchases(index, ds_folder['users'])
+
+    component.getGlobalSiteManager().unregisterUtility(mock_ds, IDataserver)
+    logger.info('Evolution %s done. %s purchase(s) indexed',
+                generation, count)
+
+
+def evolve(context):
+    """
+    Evolve to generation 3 by installing the purchase charge index.
+    """
+    do_evolve(context, generation)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+generation = 3
+
+from zope import interface
+
+from zope.generations.generations import SchemaManager as BaseSchemaManager
+
+from zope.generations.interfaces import IInstallableSchemaManager
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(IInstallableSchemaManager)
+class _StoreSchemaManager(BaseSchemaManager):
+    """
+    A schema manager that we can register as a utility in ZCML.
+    """
+
+    def __init__(self):
+        super(_StoreSchemaManager, self).__init__(
+            generation=generation,
+            minimum_generation=generation,
+            package_name='nti.app.store.generations')
+
+    def install(self, context):
+        evolve(context)
+
+
+def evolve(context):
+    from nti.app.store.generations import evolve1
+    from nti.app.store.generations import evolve2
+    from nti.app.store.generations import evolve3
+    evolve1.do_evolve(context, generation)
+    evolve2.do_evolve(context, generation)
+    evolve3.do_evolve(context, generation)
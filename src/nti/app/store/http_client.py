@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pooled, keep-alive HTTP sessions for Stripe traffic.
+
+One :class:`requests.Session` is kept per connect key and endpoint, so
+TLS connections are reused across requests and the number of sockets
+opened by a worker is bounded. Calls made through the Stripe SDK are
+routed through the same sessions once :func:`install_stripe_http_client`
+has been called (at application startup).
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+import requests
+import stripe
+
+from requests.adapters import HTTPAdapter
+
+from six.moves import urllib_parse
+
+from zope import component
+from zope import interface
+
+from nti.app.store.interfaces import IHTTPSessionPool
+
+#: Default max number of keep-alive connections per session
+DEFAULT_POOL_SIZE = 10
+
+#: Default max number of sessions
+DEFAULT_MAX_SESSIONS = 100
+
+#: Default seconds to wait for a connection
+DEFAULT_CONNECT_TIMEOUT = 3.05
+
+#: Default seconds to wait for a response
+DEFAULT_READ_TIMEOUT = 30
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _key_hash(key):
+    if not key:
+        return None
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+
+def _endpoint(url):
+    parts = urllib_parse.urlsplit(url)
+    return '%s://%s' % (parts.scheme, parts.netloc.lower())
+
+
+@interface.implementer(IHTTPSessionPool)
+class HTTPSessionPool(object):
+
+    def __init__(self,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 max_sessions=DEFAULT_MAX_SESSIONS,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 timeouts=None):
+        self.pool_size = pool_size
+        self.max_sessions = max_sessions
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # endpoint -> (connect timeout, read timeout)
+        self.timeouts = dict(timeouts or {})
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _new_session(self):
+        result = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size)
+        result.mount('https://', adapter)
+        result.mount('http://', adapter)
+        return result
+
+    def session(self, url, key=None):
+        """
+        Return the session of the specified connect key and the endpoint
+        of the given URL.
+        """
+        name = (_key_hash(key), _endpoint(url))
+        evicted = None
+        with self._lock:
+            result = self._sessions.pop(name, None)
+            if result is None:
+                result = self._new_session()
+                if len(self._sessions) >= self.max_sessions:
+                    evicted = self._sessions.popitem(last=False)[1]
+            self._sessions[name] = result
+        if evicted is not None:
+            evicted.close()
+        return result
+
+    def timeout(self, url):
+        return self.timeouts.get(_endpoint(url)) \
+            or (self.connect_timeout, self.read_timeout)
+
+    def request(self, method, url, key=None, timeout=None, **kwargs):
+        timeout = self.timeout(url) if timeout is None else timeout
+        session = self.session(url, key)
+        return session.request(method, url, timeout=timeout, **kwargs)
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+def get_http_session_pool():
+    return component.getUtility(IHTTPSessionPool)
+
+
+def http_request(method, url, key=None, timeout=None, **kwargs):
+    """
+    Make an HTTP request with the session of the specified connect key
+    (or of the platform if no key is given) and the endpoint of the URL.
+    """
+    return get_http_session_pool().request(method, url,
+                                           key=key,
+                                           timeout=timeout,
+                                           **kwargs)
+
+
+class StripeHTTPClient(stripe.http_client.HTTPClient):
+    """
+    A Stripe SDK HTTP client that uses the pooled session of the connect
+    key (from the request authorization) and the API endpoint.
+    """
+
+    name = 'requests'
+
+    def _api_key(self, headers):
+        auth = (headers or {}).get('Authorization') or ''
+        return auth.split(' ', 1)[-1] or None
+
+    def request(self, method, url, headers, post_data=None):
+        try:
+            result = http_request(method, url,
+                                  key=self._api_key(headers),
+                                  headers=headers,
+                                  data=post_data)
+        except requests.RequestException as e:
+            logger.warning("Error communicating with Stripe (%s)", e)
+            raise stripe.error.APIConnectionError(
+                "Unexpected error communicating with Stripe (%s)" % (e,))
+        return result.content, result.status_code, result.headers
+
+    def close(self):
+        pass
+
+
+def install_stripe_http_client():
+    stripe.default_http_client = StripeHTTPClient()
+
+
+def _on_application_created(unused_event=None):
+    install_stripe_http_client()
+
+
+def uninstall_stripe_http_client():
+    if isinstance(stripe.default_http_client, StripeHTTPClient):
+        stripe.default_http_client = None
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(uninstall_stripe_http_client)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Idempotency keys of purchase requests.
+
+Clients may send an ``Idempotency-Key`` header with payment requests. The
+purchase attempt created by the first request is recorded under the key
+(scoped to the purchase creator) along with a fingerprint of the request
+payload, so a retried request returns the original attempt.
+
+Keys are stored per site and spread over several trees, and expired keys
+are purged in their own transaction after the payment one commits, so
+concurrent purchases do not conflict over them.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import zlib
+import time
+import hashlib
+
+from functools import partial
+
+import simplejson as json
+
+import transaction
+
+from BTrees.OOBTree import OOBTree
+
+from persistent import Persistent
+
+from zope import component
+
+from zope.component.hooks import getSite
+
+from zope.container.contained import Contained
+
+from nti.app.store.utils import get_site_annotation
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+#: Idempotency key request header
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+
+#: Max length of an idempotency key
+MAX_KEY_LENGTH = 255
+
+#: Seconds an idempotency key is kept
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+#: Max number of expired keys removed on each registration
+MAX_PURGE = 100
+
+#: Number of key trees of a store
+STORE_SHARDS = 16
+
+#: Annotation key of the idempotency key store
+IDEMPOTENCY_STORE_KEY = 'nti.app.store.idempotency.IdempotencyKeyStore'
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class IdempotencyKeyStore(Persistent, Contained):
+
+    def __init__(self, shards=STORE_SHARDS):
+        # key -> (purchase id, fingerprint, expiration)
+        self.keys = tuple(OOBTree() for _ in range(shards))
+        # (expiration, key) -> None
+        self.expirations = tuple(OOBTree() for _ in range(shards))
+
+    def _shard(self, key):
+        return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % len(self.keys)
+
+    def __len__(self):
+        return sum(len(x) for x in self.keys)
+
+    def get(self, key, now=None):
+        """
+        Return the (purchase id, fingerprint) of the specified key.
+        """
+        now = time.time() if now is None else now
+        entry = self.keys[self._shard(key)].get(key)
+        if entry is None or entry[2] <= now:
+            return None
+        return entry[:2]
+
+    def add(self, key, purchase_id, fingerprint, ttl=IDEMPOTENCY_KEY_TTL):
+        self.remove(key)
+        idx = self._shard(key)
+        expiration = time.time() + ttl
+        self.keys[idx][key] = (purchase_id, fingerprint, expiration)
+        self.expirations[idx][(expiration, key)] = None
+
+    def remove(self, key):
+        idx = self._shard(key)
+        entry = self.keys[idx].pop(key, None)
+        if entry is not None:
+            self.expirations[idx].pop((entry[2], key), None)
+        return entry
+
+    def purge(self, now=None, limit=MAX_PURGE, key=None):
+        """
+        Remove the expired keys, only those of the shard of the specified
+        key if given.
+        """
+        now = time.time() if now is None else now
+        expired = []
+        shards = range(len(self.keys)) if key is None else (self._shard(key),)
+        for idx in shards:
+            for expiration, name in self.expirations[idx].keys():
+                if expiration > now or len(expired) >= limit:
+                    break
+                expired.append(name)
+        for name in expired:
+            self.remove(name)
+        return len(expired)
+
+
+def get_idempotency_store(create=True, site=None):
+    """
+    Return the idempotency key store of the given (or current) site.
+    """
+    factory = IdempotencyKeyStore if create else None
+    return get_site_annotation(IDEMPOTENCY_STORE_KEY, factory, site)
+
+
+def _purge(key):
+    store = get_idempotency_store(False)
+    if store is not None:
+        store.purge(key=key)
+
+
+def queue_idempotency_purge(key):
+    """
+    Purge the expired keys stored along with the specified key in a new
+    transaction once the current one commits.
+    """
+    site_name = getattr(getSite(), '__name__', None)
+
+    def hook(success):
+        if not success:
+            return
+        runner = component.getUtility(IDataserverTransactionRunner)
+        try:
+            runner(partial(_purge, key),
+                   site_names=(site_name,) if site_name else ())
+        except Exception:  # pylint: disable=broad-except
+            # purged with a later key
+            logger.exception("Cannot purge idempotency keys")
+    transaction.get().addAfterCommitHook(hook)
+
+
+def get_idempotency_key(request):
+    """
+    Return the idempotency key sent with the specified request.
+    """
+    result = request.headers.get(IDEMPOTENCY_KEY_HEADER) or u''
+    return result.strip() or None
+
+
+def scoped_key(owner, key):
+    return u'%s\n%s' % ((owner or u'').lower(), key)
+
+
+def fingerprint(values):
+    """
+    Return a fingerprint of the specified request payload.
+    """
+    data = json.dumps(dict(values or {}), sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Site-scoped purchasable index.
+
+Each site keeps (in its annotations) an index of the purchasables
+registered in its site manager, with sets of the NTIIDs of public and
+giftable purchasables and a map from NTIID to purchasable. Site indexes
+are created by the purchasable subscribers and the generation evolve
+steps, never while reading. Purchasables registered in non-persistent
+registries (the global registry and the ZCML site base components) are
+kept in transient indexes built on first use.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import six
+import time
+
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from BTrees.OOBTree import difference
+from BTrees.OOBTree import intersection
+
+from persistent import Persistent
+
+from zope import component
+
+from zope.component.hooks import getSite
+
+from zope.component.interfaces import ISite
+
+from zope.container.contained import Contained
+
+from nti.app.store.utils import get_request_cache
+from nti.app.store.utils import get_site_annotation
+
+from nti.store.interfaces import IPurchasable
+
+from nti.traversal.traversal import find_interface
+
+#: Annotation key of the site purchasable index
+PURCHASABLE_INDEX_KEY = 'nti.app.store.index.PurchasableIndex'
+
+logger = __import__('logging').getLogger(__name__)
+
+
+#: Boolean purchasable attributes kept as NTIID sets
+IX_SETS = ('public', 'giftable', 'redeemable')
+
+#: Purchasable attributes kept as value to NTIID set maps
+IX_VALUES = ('provider', 'currency')
+
+#: Precomputed purchasable sort keys
+SORT_KEYS = ('title', 'amount', 'provider', 'currency',
+             'createdTime', 'lastModified')
+
+
+def _document(purchasable):
+    title = getattr(purchasable, 'Title', None) or u''
+    return {
+        'public': bool(purchasable.isPublic()),
+        'giftable': bool(purchasable.Giftable),
+        'redeemable': bool(purchasable.Redeemable),
+        'provider': purchasable.Provider,
+        'currency': purchasable.Currency,
+        'title': title.lower(),
+        'amount': purchasable.Amount or 0,
+        'createdTime': getattr(purchasable, 'createdTime', None) or 0,
+        'lastModified': getattr(purchasable, 'lastModified', None) or 0,
+    }
+
+
+class PurchasableIndex(Persistent, Contained):
+
+    #: Catalog generation, bumped on every change to the index
+    generation = 0
+
+    lastModified = 0
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.purchasables = OOBTree()
+        self.documents = OOBTree()
+        self.sets = OOBTree()
+        for name in IX_SETS:
+            self.sets[name] = OOTreeSet()
+        self.values = OOBTree()
+        for name in IX_VALUES:
+            self.values[name] = OOBTree()
+        self.bump()
+
+    def bump(self):
+        self.generation += 1
+        self.lastModified = time.time()
+
+    def documents_last_modified(self):
+        """
+        Return the last time any of the indexed purchasables was modified.
+        """
+        return max([x['lastModified'] for x in self.documents.values()] or [0])
+
+    def __len__(self):
+        return len(self.purchasables)
+
+    def __contains__(self, ntiid):
+        return ntiid in self.purchasables
+
+    def get(self, ntiid, default=None):
+        return self.purchasables.get(ntiid, default)
+
+    def sort_key(self, ntiid, name):
+        return self.documents[ntiid][name]
+
+    def _unindex_document(self, ntiid):
+        document = self.documents.pop(ntiid, None) or {}
+        for name in IX_SETS:
+            tree = self.sets[name]
+            if ntiid in tree:
+                tree.remove(ntiid)
+        for name in IX_VALUES:
+            value = document.get(name)
+            trees = self.values[name]
+            tree = trees.get(value) if value is not None else None
+            if tree is not None and ntiid in tree:
+                tree.remove(ntiid)
+                if not tree:
+                    del trees[value]
+
+    def index(self, purchasable):
+        ntiid = purchasable.NTIID
+        document = _document(purchasable)
+        self._unindex_document(ntiid)
+        self.purchasables[ntiid] = purchasable
+        self.documents[ntiid] = document
+        for name in IX_SETS:
+            if document[name]:
+                self.sets[name].add(ntiid)
+        for name in IX_VALUES:
+            value = document[name]
+            if value is not None:
+                trees = self.values[name]
+                if value not in trees:
+                    trees[value] = OOTreeSet()
+                trees[value].add(ntiid)
+        self.bump()
+
+    def unindex(self, ntiid):
+        ntiid = getattr(ntiid, 'NTIID', ntiid)
+        self._unindex_document(ntiid)
+        self.purchasables.pop(ntiid, None)
+        self.bump()
+
+    def _all(self):
+        return OOTreeSet(self.purchasables.keys())
+
+    def apply(self, ntiids=None, **criteria):
+        """
+        Return the NTIIDs of the indexed purchasables that match the
+        specified criteria. Boolean criteria are named after ``IX_SETS``,
+        value criteria after ``IX_VALUES`` and accept a value or a
+        sequence of values. A criterion set to ``None`` is ignored.
+        """
+        result = None
+        if ntiids is not None:
+            result = OOTreeSet(x for x in ntiids if x in self.purchasables)
+        for name in IX_SETS:
+            value = criteria.get(name)
+            if value is None:
+                continue
+            tree = self.sets[name]
+            if value:
+                result = tree if result is None else intersection(tree, result)
+            else:
+                result = difference(self._all() if result is None else result,
+                                    tree)
+        for name in IX_VALUES:
+            value = criteria.get(name)
+            if value is None:
+                continue
+            if isinstance(value, six.string_types):
+                value = (value,)
+            matched = OOTreeSet()
+            for tree in (self.values[name].get(x) for x in value):
+                matched.update(tree or ())
+            result = matched if result is None else intersection(matched, result)
+        if result is None:
+            result = self.purchasables.keys()
+        return result or ()
+
+
+def _index_registry(index, registry):
+    for registration in registry.registeredUtilities():
+        if registration.provided.isOrExtends(IPurchasable):
+            index.index(registration.component)
+    return index
+
+
+#: id of non-persistent registry -> (registry, transient index)
+_registry_indexes = {}
+
+
+def get_registry_purchasable_index(registry):
+    """
+    Return a transient index of the purchasables registered in the
+    specified registry.
+    """
+    if getattr(registry, '_p_jar', None) is not None:
+        # persistent registries are never cached past the request
+        cache = get_request_cache('purchasable_indexes')
+        key = registry._p_oid
+    else:
+        cache = _registry_indexes
+        key = id(registry)
+    entry = cache.get(key)
+    if entry is None or entry[0] is not registry:
+        index = _index_registry(PurchasableIndex(), registry)
+        # rebuilt per request or worker, so it is stamped from its
+        # purchasables rather than the time it was built
+        index.lastModified = index.documents_last_modified()
+        entry = cache[key] = (registry, index)
+    return entry[1]
+
+
+def get_global_purchasable_index():
+    return get_registry_purchasable_index(component.getGlobalSiteManager())
+
+
+def reset_global_purchasable_index():
+    _registry_indexes.clear()
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(reset_global_purchasable_index)
+
+
+def _new_site_index(site):
+    index = PurchasableIndex()
+    _index_registry(index, site.getSiteManager())
+    return index
+
+
+def get_purchasable_index(site=None, create=False):
+    """
+    Return the purchasable index of the given (or current) site. When the
+    index does not exist yet and ``create`` is set, it is built from the
+    purchasables registered in the site and stored in the site.
+    """
+    site = getSite() if site is None else site
+    if not ISite.providedBy(site):
+        return get_global_purchasable_index()
+    factory = (lambda: _new_site_index(site)) if create else None
+    return get_site_annotation(PURCHASABLE_INDEX_KEY, factory, site)
+
+
+def install_purchasable_index(site):
+    """
+    Create the purchasable index of the specified site if it does not
+    exist yet.
+    """
+    return get_purchasable_index(site, create=True)
+
+
+def rebuild_purchasable_index(site=None):
+    """
+    Rebuild the purchasable index of the given (or current) site from the
+    purchasables registered in it.
+    """
+    site = getSite() if site is None else site
+    if not ISite.providedBy(site):
+        reset_global_purchasable_index()
+        return get_global_purchasable_index()
+    index = get_purchasable_index(site, create=True)
+    index.reset()
+    return _index_registry(index, site.getSiteManager())
+
+
+def get_purchasable_site(purchasable):
+    """
+    Return the site the specified purchasable belongs to.
+    """
+    result = find_interface(purchasable, ISite, strict=False)
+    return getSite() if result is None else result
+
+
+def get_purchasable_indexes(site=None):
+    """
+    Return the purchasable indexes visible from the given (or current)
+    site, following the lookup order of its site manager bases and
+    ending with the global index. Registries that are not owned by a
+    site (e.g. ZCML site base components) and sites whose index is not
+    installed yet get transient indexes.
+    """
+    site = getSite() if site is None else site
+    result = []
+    seen = set()
+    gsm = component.getGlobalSiteManager()
+    queue = [site.getSiteManager()] if ISite.providedBy(site) else []
+    while queue:
+        registry = queue.pop(0)
+        if id(registry) in seen or registry is gsm:
+            continue
+        seen.add(id(registry))
+        owner = getattr(registry, '__parent__', None)
+        index = None
+        if ISite.providedBy(owner):
+            index = get_purchasable_index(owner)
+        if index is None:
+            index = get_registry_purchasable_index(registry)
+        result.append(index)
+        queue.extend(getattr(registry, '__bases__', None) or ())
+    result.append(get_global_purchasable_index())
+    return result
+
+
+def bump_purchasable_index(site=None):
+    """
+    Mark the purchasable index of the given (or current) site as changed
+    (e.g. when a connect key that purchasables are decorated with is
+    added or removed).
+    """
+    site = getSite() if site is None else site
+    if ISite.providedBy(site):
+        get_purchasable_index(site, create=True).bump()
+
+
+def index_purchasable(purchasable, site=None):
+    site = get_purchasable_site(purchasable) if site is None else site
+    index = get_purchasable_index(site, create=True)
+    if index is not None:
+        index.index(purchasable)
+
+
+def unindex_purchasable(purchasable, site=None):
+    site = get_purchasable_site(purchasable) if site is None else site
+    index = get_purchasable_index(site)
+    if index is not None:
+        index.unindex(purchasable)
+
+
+def query_purchasables(ntiids=None, sort_on=None, reverse=False, **criteria):
+    """
+    Return the ``(ntiid, index)`` pairs of the purchasables visible from
+    the current site matching the specified criteria, optionally sorted
+    on one of the precomputed ``SORT_KEYS``. Purchasables in nearer sites
+    shadow those with the same NTIID in parent sites.
+    """
+    result = []
+    visited = []
+    for index in get_purchasable_indexes():
+        for ntiid in index.apply(ntiids, **criteria):
+            if not any(ntiid in x for x in visited):
+                result.append((ntiid, index))
+        visited.append(index)
+    if sort_on:
+        result.sort(key=lambda x: (x[1].sort_key(x[0], sort_on), x[0]),
+                    reverse=reverse)
+    return result
+
+
+def get_indexed_purchasables(ntiids=None, **criteria):
+    """
+    Return the purchasables visible from the current site matching the
+    specified criteria.
+    """
+    return [index.get(ntiid)
+            for ntiid, index in query_purchasables(ntiids, **criteria)]
+
+
+def get_catalog_generation(site=None):
+    """
+    Return a tuple with the (generation, size) of each purchasable index
+    visible from the given (or current) site and the last time any of
+    them was modified.
+    """
+    indexes = get_purchasable_indexes(site)
+    generations = tuple((x.generation, len(x)) for x in indexes)
+    last_modified = max([x.lastModified for x in indexes[:-1]] or [0])
+    return generations, last_modified
@@ -64,3 +64,107 @@ class ISiteLicenseStorePolicy(interface.Interface):
         Returns a bool whether or not coupons can be used. This includes
         purchase time.
         """
+
+
+class IPurchaseProcessingPool(interface.Interface):
+    """
+    A utility that runs the (post-commit) processing of purchases with
+    bounded concurrency and a bounded queue.
+    """
+
+    size = interface.Attribute("Max number of purchases processed at once")
+
+    max_queue = interface.Attribute("Max number of purchases waiting")
+
+    queued = interface.Attribute("Number of purchases waiting")
+
+    workers = interface.Attribute("Number of worker greenlets")
+
+    in_flight = interface.Attribute("Number of purchases being processed")
+
+    def accepting():
+        """
+        Return whether the pool can accept more work.
+        """
+
+    def submit(func, spawn=None):
+        """
+        Queue the specified callable to run in the pool with the current
+        request and site. Worker greenlets are started with the given
+        spawn function. Raises
+        :class:`nti.app.store.processing.ProcessingPoolFull` when the
+        queue is full.
+        """
+
+
+class IHTTPSessionPool(interface.Interface):
+    """
+    A utility that keeps a pooled, keep-alive HTTP session per connect
+    key and endpoint.
+    """
+
+    pool_size = interface.Attribute("Max number of connections per session")
+
+    max_sessions = interface.Attribute("Max number of sessions")
+
+    connect_timeout = interface.Attribute("Default connect timeout (secs)")
+
+    read_timeout = interface.Attribute("Default read timeout (secs)")
+
+    timeouts = interface.Attribute("(connect, read) timeouts by endpoint")
+
+    def session(url, key=None):
+        """
+        Return the session of the specified connect key and URL endpoint.
+        """
+
+    def request(method, url, key=None, timeout=None, **kwargs):
+        """
+        Make a request with the session of the specified connect key and
+        URL endpoint. The endpoint timeouts are used if none is given.
+        """
+
+    def close():
+        """
+        Close all sessions.
+        """
+
+
+class IStripeWebhookSecret(interface.Interface):
+    """
+    The signing secret of the Stripe webhook endpoint.
+    """
+
+    Secret = interface.Attribute("Endpoint signing secret")
+
+    Tolerance = interface.Attribute("Max age (secs) of a signed event")
+
+
+class IPurchaseSyncRegistry(interface.Interface):
+    """
+    A registry of the in-flight purchase syncs.
+    """
+
+    cooldown = interface.Attribute("Secs a purchase cannot be claimed after its sync")
+
+    def is_claimed(purchase_id):
+        """
+        Return whether the specified purchase is being synced or cooling
+        down.
+        """
+
+    def claim(purchase_id):
+        """
+        Claim the sync of the specified purchase. Return ``False`` if it
+        is being synced or cooling down.
+        """
+
+    def release(purchase_id):
+        """
+        Release the sync of the specified purchase, which then cools down.
+        """
+
+    def clear():
+        """
+        Remove all entries.
+        """
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Durable journal of the purchases to be processed.
+
+A job is recorded in the same transaction that creates a purchase attempt
+and removed once the purchase has been processed. Jobs are spread over
+several trees so that concurrent purchases do not conflict.
+
+Processing a job first checks that the job is still owned by the caller,
+renews its lease and clears its (single use) card token, so a token is
+only kept until the purchase is attempted. Jobs of purchases that were
+never attempted after their lease expires (e.g. the worker that was to
+process them was recycled) are replayed by the worker holding the
+drainer lease; purchases that were started are left to the sync sweeper.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import uuid
+import zlib
+
+import gevent
+
+from BTrees.OOBTree import OOBTree
+
+from persistent import Persistent
+
+from zope import component
+
+from zope.container.contained import Contained
+
+from nti.app.store.lease import acquire_lease
+
+from nti.app.store.processing import ProcessingPoolFull
+
+from nti.app.store.processing import get_processing_pool
+
+from nti.app.store.utils import make_site_request
+from nti.app.store.utils import get_site_annotation
+
+from nti.dataserver.interfaces import IDataserver
+from nti.dataserver.interfaces import IShardLayout
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+from nti.store.interfaces import PA_STATE_PENDING
+
+from nti.store.interfaces import IPaymentProcessor
+
+from nti.store.payments.stripe.interfaces import IStripeConnectKey
+
+from nti.store.store import get_purchase_attempt
+
+#: Annotation key of the purchase job journal
+PURCHASE_JOURNAL_KEY = 'nti.app.store.journal.PurchaseJobJournal'
+
+#: Annotation key of the journal drainer lease
+DRAINER_LEASE_KEY = 'nti.app.store.journal.DrainerLease'
+
+#: Number of job trees of a journal
+JOURNAL_SHARDS = 32
+
+#: Seconds a job is owned by the worker that claimed it
+JOB_LEASE = 300
+
+#: Seconds between journal drains
+DRAIN_INTERVAL = 120
+
+#: Seconds the drainer lease is held without being renewed
+DRAINER_LEASE = 3 * DRAIN_INTERVAL
+
+#: Seconds after startup before the journal is first drained
+STARTUP_DELAY = 30
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class PurchaseJob(Persistent, Contained):
+
+    # the request that recorded the job owns it until a replay claims it
+    owner = None
+
+    def __init__(self, purchase_id, username, processor, site_name=None,
+                 provider=None, token=None, expected_amount=None):
+        self.purchase_id = purchase_id
+        self.username = username
+        self.processor = processor
+        self.site_name = site_name
+        self.provider = provider
+        self.token = token
+        self.expected_amount = expected_amount
+        self.createdTime = self.claimedTime = time.time()
+
+    @property
+    def expired(self):
+        return time.time() - self.claimedTime >= JOB_LEASE
+
+
+class PurchaseJobJournal(Persistent, Contained):
+
+    def __init__(self, shards=JOURNAL_SHARDS):
+        self.shards = tuple(OOBTree() for _ in range(shards))
+
+    def _shard(self, purchase_id):
+        key = zlib.crc32(purchase_id.encode('utf-8')) & 0xffffffff
+        return self.shards[key % len(self.shards)]
+
+    def __len__(self):
+        return sum(len(x) for x in self.shards)
+
+    def __contains__(self, purchase_id):
+        return purchase_id in self._shard(purchase_id)
+
+    def get(self, purchase_id):
+        return self._shard(purchase_id).get(purchase_id)
+
+    def add(self, job):
+        self._shard(job.purchase_id)[job.purchase_id] = job
+        job.__parent__ = self
+        job.__name__ = job.purchase_id
+        return job
+
+    def remove(self, purchase_id):
+        job = self._shard(purchase_id).pop(purchase_id, None)
+        if job is not None:
+            job.token = None
+        return job
+
+    def expired(self):
+        return [x for shard in self.shards for x in shard.values() if x.expired]
+
+
+def get_purchase_journal(create=True):
+    """
+    Return the purchase job journal, which lives in the dataserver folder.
+    """
+    dataserver = component.getUtility(IDataserver)
+    folder = IShardLayout(dataserver).dataserver_folder
+    factory = PurchaseJobJournal if create else None
+    return get_site_annotation(PURCHASE_JOURNAL_KEY, factory, folder)
+
+
+def record_purchase_job(purchase_id, username, processor, site_name=None,
+                        provider=None, token=None, expected_amount=None):
+    """
+    Record a purchase to be processed in the current transaction.
+    """
+    job = PurchaseJob(purchase_id, username, processor,
+                      site_name=site_name,
+                      provider=provider,
+                      token=token,
+                      expected_amount=expected_amount)
+    return get_purchase_journal().add(job)
+
+
+def _run(func, site_name=None):
+    runner = component.getUtility(IDataserverTransactionRunner)
+    return runner(func, site_names=(site_name,) if site_name else ())
+
+
+def start_purchase_job(purchase_id, owner=None):
+    """
+    Start processing the specified job in a new transaction. Return
+    whether the job is still owned by the given owner (``None`` for the
+    request that recorded it), in which case its lease is renewed and its
+    token cleared.
+    """
+    def _start():
+        journal = get_purchase_journal(False)
+        job = journal.get(purchase_id) if journal is not None else None
+        if job is None or job.owner != owner:
+            return False
+        job.claimedTime = time.time()
+        job.token = None
+        return True
+    result = _run(_start)
+    if not result:
+        logger.info("Purchase job %s is owned by another worker", purchase_id)
+    return result
+
+
+def complete_purchase_job(purchase_id):
+    """
+    Remove the specified job from the journal in a new transaction.
+    """
+    def _remove():
+        journal = get_purchase_journal(False)
+        if journal is not None:
+            journal.remove(purchase_id)
+    try:
+        _run(_remove)
+    except Exception:  # pylint: disable=broad-except
+        # it will be removed when the journal is drained
+        logger.exception("Cannot remove purchase job %s", purchase_id)
+
+
+def _claim_expired_jobs():
+    result = []
+    journal = get_purchase_journal(False)
+    for job in journal.expired() if journal is not None else ():
+        purchase = get_purchase_attempt(job.purchase_id, job.username)
+        # a started (or tokenless) purchase may have been charged, so it
+        # is never replayed but synchronized with its processor
+        if     purchase is None or purchase.State != PA_STATE_PENDING \
+            or not job.token:
+            journal.remove(job.purchase_id)
+            continue
+        job.owner = uuid.uuid4().hex
+        job.claimedTime = time.time()
+        result.append((job.purchase_id, job.owner, job.username,
+                       job.processor, job.site_name, job.provider,
+                       job.token, job.expected_amount))
+    return result
+
+
+def _replay_job(purchase_id, owner, username, processor, site_name, provider,
+                token, expected_amount):
+    def _api_key():
+        stripe_key = component.queryUtility(IStripeConnectKey, provider or u'')
+        return getattr(stripe_key, 'PrivateKey', None)
+    if not start_purchase_job(purchase_id, owner):
+        return
+    logger.info("Replaying purchase %s", purchase_id)
+    manager = component.getUtility(IPaymentProcessor, name=processor)
+    manager.process_purchase(token=token,
+                             request=make_site_request(site_name),
+                             username=username,
+                             site_name=site_name,
+                             purchase_id=purchase_id,
+                             api_key=_run(_api_key, site_name),
+                             expected_amount=expected_amount)
+    complete_purchase_job(purchase_id)
+
+
+def drain_purchase_journal():
+    """
+    Process the jobs of the purchases that were never attempted after
+    their lease expired. Return the number of jobs submitted.
+    """
+    jobs = _run(_claim_expired_jobs)
+    pool = get_processing_pool()
+    count = 0
+    for job in jobs:
+        try:
+            pool.submit(lambda job=job: _replay_job(*job))
+        except ProcessingPoolFull:
+            # the others are replayed once their lease expires again
+            logger.warn("Purchase processing pool is full. %s job(s) deferred",
+                        len(jobs) - count)
+            break
+        count += 1
+    if count:
+        logger.info("%s purchase job(s) replayed", count)
+    return count
+
+
+def _drain_loop():
+    while True:
+        try:
+            # only the worker holding the lease drains the journal
+            if _run(lambda: acquire_lease(DRAINER_LEASE_KEY, DRAINER_LEASE)):
+                drain_purchase_journal()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Cannot drain purchase journal")
+        gevent.sleep(DRAIN_INTERVAL)
+
+
+def _on_application_created(unused_event=None):
+    gevent.spawn_later(STARTUP_DELAY, _drain_loop)
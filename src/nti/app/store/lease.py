@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Leases electing the single worker that runs a periodic task.
+
+A lease is stored in the dataserver folder. Every worker tries to
+acquire it before running the task; only its holder succeeds, and it
+renews the lease each time. Another worker takes over once the lease
+expires.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+import socket
+
+from persistent import Persistent
+
+from zope import component
+
+from zope.container.contained import Contained
+
+from nti.app.store.utils import get_site_annotation
+
+from nti.dataserver.interfaces import IDataserver
+from nti.dataserver.interfaces import IShardLayout
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class Lease(Persistent, Contained):
+
+    owner = None
+    expires = 0
+
+    def acquire(self, owner, duration, now=None):
+        """
+        Acquire or renew this lease for the specified owner. Return
+        ``False`` if it is held by another owner.
+        """
+        now = time.time() if now is None else now
+        if self.owner != owner and self.expires > now:
+            return False
+        if self.owner != owner:
+            logger.info("Lease %s acquired by %s", self.__name__, owner)
+        self.owner = owner
+        self.expires = now + duration
+        return True
+
+
+def worker_id():
+    """
+    Return the identifier of the current worker process.
+    """
+    return u'%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def acquire_lease(key, duration, owner=None):
+    """
+    Acquire or renew the lease stored under the specified key of the
+    dataserver folder for the given (or current) worker, in the current
+    transaction. Return whether the lease is held.
+    """
+    dataserver = component.getUtility(IDataserver)
+    folder = IShardLayout(dataserver).dataserver_folder
+    lease = get_site_annotation(key, Lease, folder)
+    return lease.acquire(owner or worker_id(), duration)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pricing result cache.
+
+Prices only change when a purchasable is modified, so pricing results are
+cached by the priced entries, the processor and the site. Results of
+entries with coupons, whose validity is decided by the payment processor,
+are only kept for a short time. Callers get their own copy of the cached
+results.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import six
+import copy
+
+from nti.app.store.cache import LRUCache
+
+from nti.app.store.utils import get_request_cache
+
+from nti.site.site import getSite
+
+from nti.store.store import get_purchasable
+
+#: Time-to-live (in secs) of pricing results
+DEFAULT_PRICING_TTL = 3600
+
+#: Time-to-live (in secs) of pricing results with coupons
+COUPON_PRICING_TTL = 60
+
+logger = __import__('logging').getLogger(__name__)
+
+#: Pricing results by (site, processor, coupon, entries)
+_pricing_cache = LRUCache(maxsize=5000, ttl=DEFAULT_PRICING_TTL)
+
+
+def invalidate_pricing(ntiid):
+    """
+    Drop the cached pricing results of the specified purchasable.
+    """
+    _pricing_cache.invalidate(lambda x: any(e[0] == ntiid for e in x[3]))
+
+
+def resolve_purchasable(ntiid, request=None):
+    """
+    Return the purchasable with the specified NTIID. Each NTIID is resolved
+    once per request.
+    """
+    cache = get_request_cache('payment_purchasables', request)
+    try:
+        result = cache[ntiid]
+    except KeyError:
+        result = cache[ntiid] = get_purchasable(ntiid)
+    return result
+
+
+def _is_cacheable_coupon(coupon):
+    return coupon is None or isinstance(coupon, six.string_types)
+
+
+def pricing_key(processor, entries, coupon=None):
+    """
+    Return the cache key for pricing the specified ``(ntiid, quantity,
+    coupon)`` entries or ``None`` if they cannot be cached.
+    """
+    if not _is_cacheable_coupon(coupon):
+        return None
+    items = []
+    for ntiid, quantity, item_coupon in entries:
+        purchasable = resolve_purchasable(ntiid)
+        if purchasable is None or not _is_cacheable_coupon(item_coupon):
+            return None
+        items.append((ntiid,
+                      getattr(purchasable, 'lastModified', 0),
+                      quantity,
+                      item_coupon or None))
+    return (getattr(getSite(), '__name__', None),
+            processor or u'',
+            coupon or None,
+            tuple(items))
+
+
+def cached_pricing(func, processor, entries, coupon=None):
+    """
+    Return the (cached) result of calling the specified pricing function
+    for the given ``(ntiid, quantity, coupon)`` entries. Pricing errors are
+    never cached.
+    """
+    key = pricing_key(processor, entries, coupon)
+    if key is None:
+        return func()
+    result = _pricing_cache.get(key)
+    if result is None:
+        result = func()
+        has_coupon = key[2] or any(x[3] for x in key[3])
+        _pricing_cache.set(key, copy.deepcopy(result),
+                           ttl=COUPON_PRICING_TTL if has_coupon else None)
+        return result
+    # callers may change the pricing results
+    return copy.deepcopy(result)
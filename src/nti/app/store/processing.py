@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bounded processing of purchases.
+
+Submitted purchases wait in a bounded queue and are processed by at most
+``size`` worker greenlets. A worker may run purchases submitted by other
+requests, so each purchase is queued with the request and site it was
+submitted from and runs with them.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import deque
+
+import gevent
+
+from pyramid.threadlocal import manager
+
+from zope import component
+from zope import interface
+
+from zope.component.hooks import getSite
+from zope.component.hooks import site as current_site
+
+from nti.app.store.interfaces import IPurchaseProcessingPool
+
+#: Default max number of purchases processed at once
+DEFAULT_POOL_SIZE = 10
+
+#: Default max number of purchases waiting to be processed
+DEFAULT_MAX_QUEUE = 200
+
+#: Seconds a client is asked to wait when the pool is full
+DEFAULT_RETRY_AFTER = 30
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _bind_context(func):
+    # the (pyramid) request and the site of the submitter
+    context = dict(manager.get())
+    site = getSite()
+
+    def run():
+        manager.push(context)
+        try:
+            with current_site(site):
+                return func()
+        finally:
+            manager.pop()
+    return run
+
+
+class ProcessingPoolFull(Exception):
+    """
+    Raised when a purchase is submitted to a pool whose queue is full.
+    """
+
+
+@interface.implementer(IPurchaseProcessingPool)
+class PurchaseProcessingPool(object):
+
+    retry_after = DEFAULT_RETRY_AFTER
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, max_queue=DEFAULT_MAX_QUEUE):
+        self.size = size
+        self.max_queue = max_queue
+        self.queued = 0
+        self.workers = 0
+        self.in_flight = 0
+        self._queue = deque()
+
+    def accepting(self):
+        return self.queued < self.max_queue
+
+    def _work(self):
+        try:
+            while self._queue:
+                func = self._queue.popleft()
+                self.queued -= 1
+                self.in_flight += 1
+                try:
+                    func()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Cannot process purchase")
+                finally:
+                    self.in_flight -= 1
+        finally:
+            self.workers -= 1
+
+    def submit(self, func, spawn=None):
+        if not self.accepting():
+            raise ProcessingPoolFull()
+        self._queue.append(_bind_context(func))
+        self.queued += 1
+        if self.workers >= self.size:
+            # picked up by a running worker
+            return None
+        spawn = gevent.spawn if spawn is None else spawn
+        self.workers += 1
+        try:
+            return spawn(self._work)
+        except Exception:
+            self.workers -= 1
+            self._queue.pop()
+            self.queued -= 1
+            raise
+
+
+def get_processing_pool():
+    return component.getUtility(IPurchaseProcessingPool)
@@ -15,12 +15,33 @@ import isodate
 from zope import component
 from zope import interface
 
+from zope.interface.interfaces import IObjectEvent
+
+from zope.lifecycleevent.interfaces import IObjectAddedEvent
+from zope.lifecycleevent.interfaces import IObjectCreatedEvent
+from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+
 from zope.traversing.interfaces import IPathAdapter
 
 from pyramid.threadlocal import get_current_request
 
 from nti.app.store import MessageFactory as _
 
+from nti.app.store.catalog import queue_purchase_reindex
+
+from nti.app.store.connect_keys import invalidate_connect_keys
+
+from nti.app.store.decorators import invalidate_item_summary
+
+from nti.app.store.externalization import invalidate_external_purchasable
+
+from nti.app.store.index import index_purchasable
+from nti.app.store.index import bump_purchasable_index
+from nti.app.store.index import unindex_purchasable
+
+from nti.app.store.pricing import invalidate_pricing
+
 from nti.appserver.brand.utils import get_site_brand_name
 
 from nti.appserver.policies.interfaces import ISitePolicyUserEventListener
@@ -33,8 +54,12 @@ from nti.mailer.interfaces import ITemplatedMailer
 
 from nti.site.site import getSite
 
+from nti.store.interfaces import IPurchasable
+from nti.store.interfaces import IPurchaseAttempt
 from nti.store.interfaces import IStorePurchaseMetadataProvider
 
+from nti.store.payments.stripe.interfaces import IStripeConnectKey
+
 from nti.store.store import get_transaction_code
 
 DEFAULT_EMAIL_SUBJECT = _(u"Purchase Confirmation")
@@ -174,3 +199,63 @@ class SitePurchaseMetadataProvider(object):
             site_display = site_alias
         data['SiteName'] = site_display
         return data
+
+
+# purchasable index
+
+
+@component.adapter(IPurchasable, IObjectCreatedEvent)
+def _on_purchasable_created(purchasable, unused_event=None):
+    # purchasables are registered in the current site after creation
+    index_purchasable(purchasable, getSite())
+
+
+@component.adapter(IPurchasable, IObjectAddedEvent)
+def _on_purchasable_added(purchasable, unused_event=None):
+    index_purchasable(purchasable)
+
+
+@component.adapter(IPurchasable, IObjectModifiedEvent)
+def _on_purchasable_modified(purchasable, unused_event=None):
+    invalidate_pricing(purchasable.NTIID)
+    invalidate_external_purchasable(purchasable.NTIID)
+    index_purchasable(purchasable)
+
+
+@component.adapter(IPurchasable, IObjectRemovedEvent)
+def _on_purchasable_removed(purchasable, unused_event=None):
+    invalidate_pricing(purchasable.NTIID)
+    invalidate_external_purchasable(purchasable.NTIID)
+    unindex_purchasable(purchasable)
+
+
+# registered in ZCML for the content that can be purchased
+def _on_content_modified(obj, unused_event=None):
+    ntiid = getattr(obj, 'ntiid', None) or getattr(obj, 'NTIID', None)
+    if ntiid:
+        invalidate_item_summary(ntiid)
+
+
+# purchase state and charge indexes
+
+
+@component.adapter(IPurchaseAttempt, IObjectEvent)
+def _on_purchase_attempt_event(purchase, unused_event=None):
+    # state transitions are notified as purchase attempt events
+    queue_purchase_reindex(purchase)
+
+
+# connect keys
+
+
+@component.adapter(IStripeConnectKey, IObjectAddedEvent)
+def _on_connect_key_added(unused_key, unused_event=None):
+    invalidate_connect_keys()
+    # purchasable listings include the connect key
+    bump_purchasable_index()
+
+
+@component.adapter(IStripeConnectKey, IObjectRemovedEvent)
+def _on_connect_key_removed(unused_key, unused_event=None):
+    invalidate_connect_keys()
+    bump_purchasable_index()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Background synchronization of stale pending purchases.
+
+Pending purchases older than :data:`SYNC_TIME` are synchronized with their
+payment processor by a sweeper greenlet per worker. Reading a stale
+purchase only enqueues it; the worker holding the sweeper lease also
+finds stale purchases through the purchase state index. Queued purchases
+are synchronized in their own site and transaction, and a purchase is
+never queued twice while it is waiting, being synchronized or cooling
+down in the sync registry.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import threading
+
+from collections import OrderedDict
+
+from functools import partial
+
+import gevent
+
+from gevent.event import Event
+
+from zope import component
+
+from zope.component.hooks import site as current_site
+
+from nti.app.store import SITE_CONTEXT_KEY
+
+from nti.app.store.catalog import find_all_pending_purchases
+
+from nti.app.store.lease import acquire_lease
+
+from nti.app.store.sync_registry import get_sync_registry
+
+from nti.app.store.utils import make_site_request
+
+from nti.dataserver.interfaces import IDataserverTransactionRunner
+
+from nti.site.hostpolicy import get_all_host_sites
+
+from nti.site.site import getSite
+
+from nti.store.interfaces import IPurchasable
+from nti.store.interfaces import IPaymentProcessor
+
+from nti.store.store import get_purchase_attempt
+
+#: Max time in seconds after a purchase is made before a sync process is launched
+SYNC_TIME = 100
+
+#: Seconds between sweeps
+SWEEP_INTERVAL = 60
+
+#: Seconds after startup before the first sweep
+STARTUP_DELAY = 45
+
+#: Max number of purchases taken at once per site and provider
+MAX_BATCH_SIZE = 25
+
+#: Annotation key of the sweeper lease
+SWEEPER_LEASE_KEY = 'nti.app.store.sync.SweeperLease'
+
+#: Seconds the sweeper lease is held without being renewed
+SWEEPER_LEASE = 3 * SWEEP_INTERVAL
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def should_sync(purchase, now=None):
+    now = now or time.time()
+    start_time = purchase.StartTime
+    # CS: SYNC_TIME is the [magic] number of seconds elapsed since the purchase
+    # attempt was started. After this time, we try to get the purchase
+    # status by asking its payment processor
+    result = now - start_time >= SYNC_TIME and not purchase.is_synced()
+    return result
+
+
+class PurchaseSyncQueue(object):
+    """
+    The purchases waiting to be synchronized and those being synchronized.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # purchase id -> (username, processor, site name, provider)
+        self._queued = OrderedDict()
+        self._in_flight = set()
+        self._wakeup = Event()
+
+    def __len__(self):
+        return len(self._queued)
+
+    def __contains__(self, purchase_id):
+        return purchase_id in self._queued or purchase_id in self._in_flight
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def enqueue(self, purchase_id, username, processor, site_name=None,
+                provider=None):
+        """
+        Queue the specified purchase. Return ``False`` if it is already
+        queued or being synchronized.
+        """
+        with self._lock:
+            if purchase_id in self:
+                return False
+            self._queued[purchase_id] = (username, processor,
+                                         site_name, provider)
+        self._wakeup.set()
+        return True
+
+    def take(self):
+        """
+        Return the queued purchases as ``(site name, provider, processor)``
+        batches of ``(purchase id, username)`` entries and mark them in
+        flight.
+        """
+        batches = OrderedDict()
+        with self._lock:
+            self._wakeup.clear()
+            while self._queued:
+                purchase_id, entry = self._queued.popitem(last=False)
+                username, processor, site_name, provider = entry
+                key = (site_name, provider, processor)
+                batches.setdefault(key, []).append((purchase_id, username))
+                self._in_flight.add(purchase_id)
+        result = []
+        for key, entries in batches.items():
+            for idx in range(0, len(entries), MAX_BATCH_SIZE):
+                result.append((key, entries[idx:idx + MAX_BATCH_SIZE]))
+        return result
+
+    def done(self, purchase_ids):
+        with self._lock:
+            self._in_flight.difference_update(purchase_ids)
+
+    def wait(self, timeout=None):
+        return self._wakeup.wait(timeout)
+
+    def clear(self):
+        with self._lock:
+            self._queued.clear()
+            self._in_flight.clear()
+
+
+_sync_queue = PurchaseSyncQueue()
+
+
+def get_sync_queue():
+    return _sync_queue
+
+
+def _purchase_provider(purchase):
+    for item in purchase.Items or ():
+        purchasable = component.queryUtility(IPurchasable, item)
+        if purchasable is not None:
+            return purchasable.Provider
+    return None
+
+
+def enqueue_sync(purchase, site_name=None):
+    """
+    Queue the specified purchase to be synchronized by the sweeper.
+    Return ``False`` if it is already queued or being synchronized.
+    """
+    if get_sync_registry().is_claimed(purchase.id):
+        return False
+    creator = purchase.creator
+    site_name = site_name or getattr(getSite(), '__name__', None)
+    return get_sync_queue().enqueue(purchase.id,
+                                    getattr(creator, 'username', creator),
+                                    purchase.Processor,
+                                    site_name,
+                                    _purchase_provider(purchase))
+
+
+def _run(func, site_name=None):
+    runner = component.getUtility(IDataserverTransactionRunner)
+    return runner(func, site_names=(site_name,) if site_name else ())
+
+
+def _find_purchase_site(purchase, seen):
+    context = getattr(purchase, 'Context', None) or {}
+    site_name = context.get(SITE_CONTEXT_KEY)
+    if site_name:
+        return site_name
+    # purchases made before their site was recorded
+    for item in purchase.Items or ():
+        if item in seen:
+            return seen[item]
+    for site in get_all_host_sites():
+        with current_site(site):
+            for item in purchase.Items or ():
+                if component.queryUtility(IPurchasable, item) is not None:
+                    seen[item] = site.__name__
+                    return seen[item]
+    return None
+
+
+def _enqueue_stale_purchases():
+    # only the worker holding the lease sweeps
+    if not acquire_lease(SWEEPER_LEASE_KEY, SWEEPER_LEASE):
+        return 0
+    now = time.time()
+    count, seen = 0, {}
+    registry = get_sync_registry()
+    for purchase in find_all_pending_purchases() or ():
+        if     purchase.id in _sync_queue \
+            or not should_sync(purchase, now) \
+            or registry.is_claimed(purchase.id):
+            continue
+        creator = purchase.creator
+        count += _sync_queue.enqueue(purchase.id,
+                                     getattr(creator, 'username', creator),
+                                     purchase.Processor,
+                                     _find_purchase_site(purchase, seen))
+    return count
+
+
+def _sync_purchase(processor, purchase_id, username, site_name=None):
+    registry = get_sync_registry()
+    purchase = get_purchase_attempt(purchase_id, username)
+    if     purchase is None or not purchase.is_pending() \
+        or not registry.claim(purchase_id):
+        return
+    try:
+        manager = component.getUtility(IPaymentProcessor, name=processor)
+        # a request for the confirmation email of completed purchases
+        manager.sync_purchase(purchase_id=purchase_id,
+                              username=username,
+                              request=make_site_request(site_name))
+    finally:
+        registry.release(purchase_id)
+
+
+def sync_queued_purchases():
+    """
+    Synchronize each queued purchase in its own site and transaction.
+    Return the number of purchases processed.
+    """
+    result = 0
+    for (site_name, unused_provider, processor), entries in _sync_queue.take():
+        for purchase_id, username in entries:
+            try:
+                _run(partial(_sync_purchase, processor, purchase_id,
+                             username, site_name),
+                     site_name)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Cannot sync purchase %s", purchase_id)
+            finally:
+                _sync_queue.done((purchase_id,))
+            result += 1
+    return result
+
+
+def sweep():
+    """
+    Queue the stale pending purchases and synchronize the queued ones.
+    """
+    try:
+        _run(_enqueue_stale_purchases)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Cannot find stale pending purchases")
+    result = sync_queued_purchases()
+    if result:
+        logger.info("%s pending purchase(s) synchronized", result)
+    return result
+
+
+def _sweep_loop():
+    last_sweep = 0
+    while True:
+        try:
+            if time.time() - last_sweep >= SWEEP_INTERVAL:
+                last_sweep = time.time()
+                sweep()
+            else:
+                # purchases queued by readers
+                sync_queued_purchases()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Cannot sync pending purchases")
+        _sync_queue.wait(SWEEP_INTERVAL)
+
+
+def _on_application_created(unused_event=None):
+    gevent.spawn_later(STARTUP_DELAY, _sweep_loop)
+
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(_sync_queue.clear)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Registries of in-flight purchase syncs.
+
+A sync of a purchase is claimed before it starts and released when it
+ends. A released purchase cools down before it can be claimed again, so
+repeated reads of a stale purchase piggyback on the running (or just
+finished) sync instead of starting new ones. The default registry is
+per process; :class:`FileSyncRegistry` shares claims between the
+processes of a host through a local directory and can be registered as
+the :class:`~nti.app.store.interfaces.IPurchaseSyncRegistry` utility
+instead.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+
+from zope import component
+from zope import interface
+
+from nti.app.store.interfaces import IPurchaseSyncRegistry
+
+#: Seconds a claim is kept if it is never released
+DEFAULT_SYNC_LEASE = 300
+
+#: Seconds a purchase cannot be claimed after its sync ended
+DEFAULT_SYNC_COOLDOWN = 30
+
+#: Max number of entries before expired ones are purged
+MAX_ENTRIES = 1000
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(IPurchaseSyncRegistry)
+class InMemorySyncRegistry(object):
+
+    def __init__(self, lease=DEFAULT_SYNC_LEASE, cooldown=DEFAULT_SYNC_COOLDOWN):
+        self.lease = lease
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        # purchase id -> expiration
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _purge(self, now):
+        if len(self._entries) >= MAX_ENTRIES:
+            expired = [k for k, v in self._entries.items() if v <= now]
+            for purchase_id in expired:
+                del self._entries[purchase_id]
+
+    def is_claimed(self, purchase_id):
+        return self._entries.get(purchase_id, 0) > time.time()
+
+    def claim(self, purchase_id):
+        now = time.time()
+        with self._lock:
+            if self._entries.get(purchase_id, 0) > now:
+                return False
+            self._purge(now)
+            self._entries[purchase_id] = now + self.lease
+        return True
+
+    def release(self, purchase_id):
+        with self._lock:
+            self._entries[purchase_id] = time.time() + self.cooldown
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+@interface.implementer(IPurchaseSyncRegistry)
+class FileSyncRegistry(object):
+    """
+    A registry whose entries are files, named after the purchase ids and
+    holding their expiration, in a directory shared by the processes of
+    a host.
+    """
+
+    def __init__(self, path=None, lease=DEFAULT_SYNC_LEASE,
+                 cooldown=DEFAULT_SYNC_COOLDOWN):
+        self.path = path or os.path.join(tempfile.gettempdir(),
+                                         'nti.app.store.sync')
+        self.lease = lease
+        self.cooldown = cooldown
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _entry(self, purchase_id):
+        name = hashlib.sha1(purchase_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name)
+
+    def _expiration(self, path):
+        try:
+            with open(path, 'r') as fp:
+                return float(fp.read() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def _write(self, path, expiration):
+        tmp = '%s.%s' % (path, os.getpid())
+        with open(tmp, 'w') as fp:
+            fp.write(repr(expiration))
+        os.rename(tmp, path)
+
+    def is_claimed(self, purchase_id):
+        return self._expiration(self._entry(purchase_id)) > time.time()
+
+    def claim(self, purchase_id):
+        path = self._entry(purchase_id)
+        for unused in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if self._expiration(path) > time.time():
+                    return False
+                # expired entry
+                try:
+                    os.remove(path)
+                except OSError:  # pragma: no cover
+                    pass
+                continue
+            try:
+                os.write(fd, repr(time.time() + self.lease).encode('ascii'))
+            finally:
+                os.close(fd)
+            return True
+        return False
+
+    def release(self, purchase_id):
+        self._write(self._entry(purchase_id), time.time() + self.cooldown)
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:  # pragma: no cover
+                pass
+
+
+def get_sync_registry():
+    return component.getUtility(IPurchaseSyncRegistry)
@@ -11,8 +11,10 @@ from __future__ import absolute_import
 from hamcrest import is_
 from hamcrest import none
 from hamcrest import is_not
+from hamcrest import has_item
 from hamcrest import has_entry
 from hamcrest import has_length
+from hamcrest import has_entries
 from hamcrest import assert_that
 does_not = is_not
 
@@ -20,8 +22,38 @@ import csv
 import fudge
 from six import StringIO
 
+import transaction
+
 import simplejson as json
 
+from pyramid.threadlocal import manager
+from pyramid.threadlocal import get_current_request
+
+from zope import component
+
+from nti.app.store.breaker import REFUND
+from nti.app.store.breaker import CREATE_TOKEN
+
+from nti.app.store.breaker import CircuitBreaker
+
+from nti.app.store.breaker import get_breaker
+
+from nti.app.store.catalog import queue_purchase_reindex
+
+from nti.app.store.journal import PurchaseJob
+from nti.app.store.journal import PurchaseJobJournal
+
+from nti.app.store.lease import Lease
+
+from nti.app.store.processing import ProcessingPoolFull
+from nti.app.store.processing import PurchaseProcessingPool
+
+from nti.app.store.processing import get_processing_pool
+
+from nti.app.store import sync
+
+from nti.app.store.views import admin_views
+
 from nti.app.store.views.stripe_views import process_purchase
 
 from nti.app.store.tests import ApplicationStoreTestLayer
@@ -32,6 +64,8 @@ from nti.app.testing.decorators import WithSharedApplicationMockDS
 
 from nti.dataserver.tests import mock_dataserver
 
+from nti.store.payments.stripe.interfaces import IStripeConnectKey
+
 
 class MockRunner(object):
 
@@ -110,6 +144,17 @@ class TestAdminViews(ApplicationLayerTest):
         lines = list(reader)
         assert_that(lines, has_length(2))
 
+        # rows are streamed in chunks
+        chunk_size = admin_views.CSV_CHUNK_SIZE
+        admin_views.CSV_CHUNK_SIZE = 1
+        try:
+            res = self.testapp.get(url, status=200)
+        finally:
+            admin_views.CSV_CHUNK_SIZE = chunk_size
+        lines = list(csv.reader(StringIO(res.text)))
+        assert_that(lines, has_length(2))
+        assert_that(lines[0], has_item('transaction'))
+
     @WithSharedApplicationMockDS(users=True, testapp=True)
     @fudge.patch('nti.app.store.views.stripe_views.addAfterCommitHook')
     @fudge.patch('nti.store.payments.stripe.processor.purchase.create_charge')
@@ -233,3 +278,162 @@ class TestAdminViews(ApplicationLayerTest):
         url = '/dataserver2/store/@@rebuild_purchase_catalog'
         res = self.testapp.post(url, status=200)
         assert_that(res.json_body['Total'], is_(1))
+
+        # pending purchases are found with the state index
+        url = '/dataserver2/store/@@get_pending_purchases'
+        res = self.testapp.get(url, status=200)
+        assert_that(res.json_body, has_entry('Items', has_length(0)))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_purchase_processing_pool(self):
+        url = '/dataserver2/store/@@purchase_processing_pool'
+        res = self.testapp.get(url, status=200)
+        assert_that(res.json_body, has_entry('Queued', 0))
+        assert_that(res.json_body, has_entry('InFlight', 0))
+        assert_that(res.json_body, has_entry('Accepting', True))
+
+        pool = get_processing_pool()
+        pool.queued = pool.max_queue
+        try:
+            url = '/dataserver2/store/@@post_stripe_payment'
+            body = {
+                'purchasableID': self.purchasable_id,
+                'amount': 300,
+                'token': u"tok_1053"
+            }
+            res = self.testapp.post(url, json.dumps(body), status=503)
+            assert_that(res.headers.get('Retry-After'), is_not(none()))
+        finally:
+            pool.queued = 0
+
+    def test_processing_pool_queue(self):
+        workers = []
+        processed = []
+        pool = PurchaseProcessingPool(size=1, max_queue=2)
+        pool.submit(lambda: processed.append(1), spawn=workers.append)
+        pool.submit(lambda: processed.append(2), spawn=workers.append)
+        with self.assertRaises(ProcessingPoolFull):
+            pool.submit(lambda: processed.append(3), spawn=workers.append)
+        # one worker processes the queue
+        assert_that(workers, has_length(1))
+        assert_that(pool.queued, is_(2))
+        assert_that(pool.workers, is_(1))
+        assert_that(pool.in_flight, is_(0))
+        workers[0]()
+        assert_that(processed, is_([1, 2]))
+        assert_that(pool.queued, is_(0))
+        assert_that(pool.workers, is_(0))
+
+    def test_processing_pool_context(self):
+        workers = []
+        requests = []
+        pool = PurchaseProcessingPool(size=1, max_queue=2)
+        for name in ('first', 'second'):
+            manager.push({'request': name, 'registry': None})
+            try:
+                pool.submit(lambda: requests.append(get_current_request()),
+                            spawn=workers.append)
+            finally:
+                manager.pop()
+        # a worker runs each job with the request it was submitted from
+        assert_that(workers, has_length(1))
+        workers[0]()
+        assert_that(requests, is_(['first', 'second']))
+
+    @fudge.patch('nti.app.store.views.admin_views._run')
+    def test_stream_csv_error(self, mock_run):
+        mock_run.is_callable().calls(lambda func, unused_site=None: func())
+
+        def rows(keys):
+            if u'aizen' in keys:
+                raise ValueError()
+            return [(x,) for x in keys]
+        keys = [u'ichigo', u'aizen', u'rukia']
+        chunks = admin_views._stream_csv((u'username',), keys, rows,
+                                         chunk_size=1)
+        lines = list(csv.reader(StringIO(b''.join(chunks).decode('utf-8'))))
+        # a failed chunk ends the export with a marker row
+        assert_that(lines, is_([[u'username'], [u'ichigo'],
+                                [admin_views.CSV_ERROR_MARKER]]))
+
+    def test_circuit_breaker_probe(self):
+        # mutations are not interrupted
+        assert_that(CircuitBreaker(REFUND).budget, is_(none()))
+
+        breaker = CircuitBreaker(CREATE_TOKEN, reset_timeout=0)
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        assert_that(breaker.state, is_('half-open'))
+
+        def card_error():
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            breaker.call(card_error)
+        # a failed probe does not close the breaker
+        assert_that(breaker.state, is_('half-open'))
+        assert_that(breaker.call(lambda: 1), is_(1))
+        assert_that(breaker.state, is_('closed'))
+
+    def test_queue_purchase_reindex(self):
+        txn = transaction.begin()
+        try:
+            queue_purchase_reindex(object())
+            queue_purchase_reindex(object())
+            # a single hook per transaction
+            assert_that(list(txn.getBeforeCommitHooks()), has_length(1))
+        finally:
+            transaction.abort()
+
+    def test_find_purchase_site(self):
+        purchase = fudge.Fake('purchase')
+        purchase.has_attr(Context={'Site': u'bleach.org'}, Items=())
+        assert_that(sync._find_purchase_site(purchase, {}),
+                    is_(u'bleach.org'))
+
+    def test_purchase_job_journal(self):
+        journal = PurchaseJobJournal()
+        job = PurchaseJob(u'purchase-1053', u'ichigo', u'stripe',
+                          token=u'tok_1053')
+        journal.add(job)
+        assert_that(journal, has_length(1))
+        assert_that(journal.get(u'purchase-1053'), is_(job))
+        assert_that(journal.expired(), has_length(0))
+        # tokens are not kept with finished jobs
+        journal.remove(u'purchase-1053')
+        assert_that(journal, has_length(0))
+        assert_that(job.token, is_(none()))
+
+    def test_lease(self):
+        lease = Lease()
+        assert_that(lease.acquire(u'ichigo', 60, now=0), is_(True))
+        assert_that(lease.acquire(u'rukia', 60, now=30), is_(False))
+        assert_that(lease.acquire(u'ichigo', 60, now=30), is_(True))
+        # taken over once expired
+        assert_that(lease.acquire(u'rukia', 60, now=100), is_(True))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_stripe_circuit_breakers(self):
+        with mock_dataserver.mock_db_trans(self.ds):
+            stripe_key = component.getUtility(IStripeConnectKey, 'CMU')
+            breaker = get_breaker(CREATE_TOKEN, stripe_key.PrivateKey)
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        try:
+            url = '/dataserver2/store/stripe/@@create_token'
+            body = {
+                'provider': 'CMU',
+                'cvc': '019',
+                'expiry': '0930',
+                'number': '4012000033330026',
+            }
+            res = self.testapp.post(url, json.dumps(body), status=503)
+            assert_that(res.headers.get('Retry-After'), is_not(none()))
+
+            url = '/dataserver2/store/@@stripe_circuit_breakers'
+            res = self.testapp.get(url, status=200)
+            assert_that(res.json_body,
+                        has_entry('Items',
+                                  has_item(has_entries('Operation', CREATE_TOKEN,
+                                                       'State', 'open'))))
+        finally:
+            breaker.record_success()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import has_length
+from hamcrest import assert_that
+does_not = is_not
+
+from zope import component
+from zope import interface
+
+from zope.annotation.interfaces import IAnnotations
+
+from zope.component.interfaces import ISite
+
+from zope.interface.registry import Components
+
+from nti.app.store.index import PURCHASABLE_INDEX_KEY
+
+from nti.app.store.index import query_purchasables
+from nti.app.store.index import get_purchasable_index
+from nti.app.store.index import get_purchasable_indexes
+from nti.app.store.index import install_purchasable_index
+
+from nti.app.store.tests import ApplicationStoreTestLayer
+
+from nti.app.testing.application_webtest import ApplicationLayerTest
+
+from nti.app.testing.decorators import WithSharedApplicationMockDS
+
+from nti.dataserver.tests import mock_dataserver
+
+from nti.site.hostpolicy import get_host_site
+
+from nti.store.interfaces import IPurchasable
+
+from nti.store.purchasable import Purchasable
+
+NTIID = u'tag:nextthought.com,2011-10:NTI-purchasable-bleach'
+
+
+@interface.implementer(ISite)
+class _Site(object):
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def getSiteManager(self):
+        return self.registry
+
+
+class TestIndex(ApplicationLayerTest):
+
+    layer = ApplicationStoreTestLayer
+
+    def test_base_components(self):
+        purchasable = Purchasable(NTIID=NTIID,
+                                  Provider=u'NTI',
+                                  Amount=100.0,
+                                  Currency=u'USD',
+                                  Public=True,
+                                  Title=u'Bleach')
+        # purchasables registered in ZCML site base components
+        base = Components('bleach', bases=(component.getGlobalSiteManager(),))
+        base.registerUtility(purchasable, IPurchasable, NTIID)
+        site = _Site(Components('karakura', bases=(base,)))
+
+        indexes = get_purchasable_indexes(site)
+        assert_that(indexes, has_length(3))
+        assert_that(indexes[1].get(NTIID), is_(purchasable))
+
+    @WithSharedApplicationMockDS(users=True)
+    def test_read_does_not_create(self):
+        site_name = "mathcounts.nextthought.com"
+        with mock_dataserver.mock_db_trans(self.ds, site_name=site_name):
+            site = get_host_site(site_name)
+            IAnnotations(site).pop(PURCHASABLE_INDEX_KEY, None)
+            query_purchasables()
+            assert_that(get_purchasable_index(site), none())
+
+            install_purchasable_index(site)
+            assert_that(get_purchasable_index(site), is_not(none()))
@@ -11,6 +11,7 @@ from __future__ import absolute_import
 from hamcrest import is_
 from hamcrest import none
 from hamcrest import is_not
+from hamcrest import has_key
 from hamcrest import has_length
 from hamcrest import assert_that
 from hamcrest import has_entries
@@ -20,8 +21,19 @@ does_not = is_not
 
 import fudge
 
+from pyramid.interfaces import IRequest
+
+from pyramid.testing import DummyRequest
+
 from six.moves.urllib_parse import quote
 
+from zope import component
+from zope import interface
+
+from nti.app.store import externalization
+
+from nti.app.store.externalization import externalize_purchasable
+
 from nti.app.store.tests import ApplicationStoreTestLayer
 
 from nti.app.testing.application_webtest import ApplicationLayerTest
@@ -29,6 +41,9 @@ from nti.app.testing.application_webtest import ApplicationLayerTest
 from nti.app.testing.decorators import WithSharedApplicationMockDS
 
 from nti.externalization.interfaces import StandardExternalFields
+from nti.externalization.interfaces import IExternalMappingDecorator
+
+from nti.store.interfaces import IPurchasable
 
 from nti.store.purchasable import get_purchasable
 
@@ -38,6 +53,16 @@ ITEMS = StandardExternalFields.ITEMS
 NTIID = StandardExternalFields.NTIID
 
 
+@interface.implementer(IExternalMappingDecorator)
+class _RequestDecorator(object):
+
+    def __init__(self, unused_context, request):
+        self.request = request
+
+    def decorateExternalMapping(self, unused_original, external):
+        external['Marker'] = self.request.marker
+
+
 class TestStoreViews(ApplicationLayerTest):
 
     layer = ApplicationStoreTestLayer
@@ -63,6 +88,32 @@ class TestStoreViews(ApplicationLayerTest):
         'Redeemable': False
     }
 
+    @WithSharedApplicationMockDS(users=True)
+    def test_externalize_purchasable(self):
+        ntiid = "tag:nextthought.com,2011-10:CMU-HTML-04630_main.04_630:_computer_science_for_practicing_engineers"
+        gsm = component.getGlobalSiteManager()
+        gsm.registerSubscriptionAdapter(_RequestDecorator,
+                                        (IPurchasable, IRequest),
+                                        IExternalMappingDecorator)
+        try:
+            with mock_dataserver.mock_db_trans(self.ds):
+                purchasable = get_purchasable(ntiid)
+                for marker in (u'ichigo', u'aizen'):
+                    request = DummyRequest()
+                    request.marker = marker
+                    ext_obj = externalize_purchasable(purchasable, request)
+                    assert_that(ext_obj, has_entries('NTIID', ntiid,
+                                                     'Marker', marker))
+            # request specific data is never cached
+            cached = [x[1] for x in externalization._purchasable_cache._data.values()]
+            assert_that(cached, has_length(greater_than_or_equal_to(1)))
+            for ext_obj in cached:
+                assert_that(ext_obj, does_not(has_key('Marker')))
+        finally:
+            gsm.unregisterSubscriptionAdapter(_RequestDecorator,
+                                              (IPurchasable, IRequest),
+                                              IExternalMappingDecorator)
+
     @WithSharedApplicationMockDS(users=True, testapp=True)
     def test_get_legacy_purchasable(self):
         ntiid = "tag:nextthought.com,2011-10:CMU-HTML-04630_main.04_630:_computer_science_for_practicing_engineers"
@@ -186,6 +237,10 @@ class TestStoreViews(ApplicationLayerTest):
         url = '/dataserver2/store/purchasables'
         self.testapp.post_json(url, ext_obj, status=201)
 
+        listing = '/dataserver2/store/@@get_purchasables?purchasables=%s' % quote(ntiid)
+        res = self.testapp.get(listing, status=200)
+        assert_that(res.json_body, has_entries('Items', has_length(1)))
+
         # disable
         url = '/dataserver2/store/purchasables/%s/disable' % quote(ntiid)
         self.testapp.post(url, status=200)
@@ -193,9 +248,15 @@ class TestStoreViews(ApplicationLayerTest):
             p = get_purchasable(ntiid)
             assert_that(p, has_property('Public', is_(False)))
 
-        # disable
+        res = self.testapp.get(listing, status=200)
+        assert_that(res.json_body, has_entries('Items', has_length(0)))
+
+        # enable
         url = '/dataserver2/store/purchasables/%s/enable' % quote(ntiid)
         self.testapp.post(url, status=200)
         with mock_dataserver.mock_db_trans(self.ds):
             p = get_purchasable(ntiid)
             assert_that(p, has_property('Public', is_(True)))
+
+        res = self.testapp.get(listing, status=200)
+        assert_that(res.json_body, has_entries('Items', has_length(1)))
@@ -9,9 +9,11 @@ from __future__ import absolute_import
 # pylint: disable=W0212,R0904
 
 from hamcrest import is_
+from hamcrest import none
 from hamcrest import is_not
 from hamcrest import has_key
 from hamcrest import has_entry
+from hamcrest import has_entries
 from hamcrest import has_length
 from hamcrest import assert_that
 from hamcrest import greater_than_or_equal_to
@@ -19,14 +21,40 @@ does_not = is_not
 
 from six.moves.urllib_parse import quote
 
+import fudge
+
+from pyramid.testing import DummyRequest
+
 import stripe
 
+from nti.app.store.acl import _purchasable_aces
+
+from nti.app.store.acl import PurchasableACLProvider
+
+from nti.app.store.decorators import get_item_summary
+from nti.app.store.decorators import invalidate_item_summary
+from nti.app.store.decorators import get_user_purchase_state
+
+from nti.app.store.pricing import cached_pricing
+
 from nti.app.store.tests import ApplicationStoreTestLayer
 
+from nti.app.store.utils import get_fieldset
+from nti.app.store.utils import enable_fieldset
+from nti.app.store.utils import is_field_requested
+
 from nti.app.testing.application_webtest import ApplicationLayerTest
 
 from nti.app.testing.decorators import WithSharedApplicationMockDS
 
+from nti.dataserver.tests import mock_dataserver
+
+from nti.store.payments.stripe.model import PersistentStripeConnectKey
+
+from nti.store.payments.stripe.storage import get_stripe_key_container
+
+NTIID = u"tag:nextthought.com,2011-10:CMU-HTML-04630_main.04_630:_computer_science_for_practicing_engineers"
+
 
 class TestStoreViews(ApplicationLayerTest):
 
@@ -67,6 +95,7 @@ class TestStoreViews(ApplicationLayerTest):
         json_body = res.json_body
         assert_that(json_body, has_entry('Items', has_length(1)))
         item_body = json_body['Items'][0]
+        assert_that(item_body, has_entry('Activated', is_(False)))
         self.require_link_href_with_rel(item_body, 'price')
         self.require_link_href_with_rel(item_body, 'post_stripe_payment')
         self.require_link_href_with_rel(item_body, 'create_stripe_token')
@@ -75,6 +104,205 @@ class TestStoreViews(ApplicationLayerTest):
         self.require_link_href_with_rel(item_body, 
 										'price_purchasable_with_stripe_coupon')
 
+    def test_item_summary(self):
+        ntiid = u'tag:nextthought.com,2011-10:BLEACH-HTML-bleach'
+
+        class Item(object):
+            mimeType = u'application/vnd.nextthought.contentpackage'
+
+            def __init__(self, title, lastModified=1):
+                self.title = title
+                self.lastModified = lastModified
+
+        request = fudge.Fake('request').provides('path_info_peek').returns('dataserver2')
+        summary = get_item_summary(ntiid, Item(u'Bleach'), request)
+        assert_that(summary,
+                    has_entries('NTIID', ntiid,
+                                'Title', u'Bleach',
+                                'MimeType', Item.mimeType,
+                                'href', '/dataserver2/Objects/%s' % quote(ntiid)))
+
+        # cached until the item is modified
+        summary = get_item_summary(ntiid, Item(u'Naruto'), request)
+        assert_that(summary, has_entry('Title', u'Bleach'))
+        summary = get_item_summary(ntiid, Item(u'Naruto', 2), request)
+        assert_that(summary, has_entry('Title', u'Naruto'))
+
+        # the href is computed per request
+        other = fudge.Fake('other').provides('path_info_peek').returns('ds')
+        summary = get_item_summary(ntiid, Item(u'Onepiece', 2), other)
+        assert_that(summary,
+                    has_entries('Title', u'Naruto',
+                                'href', '/ds/Objects/%s' % quote(ntiid)))
+
+        invalidate_item_summary(ntiid)
+        summary = get_item_summary(ntiid, Item(u'Onepiece', 2), other)
+        assert_that(summary, has_entry('Title', u'Onepiece'))
+
+    @fudge.patch('nti.app.store.decorators.get_purchase_history')
+    def test_user_purchase_state(self, mock_gph):
+        succeeded = fudge.Fake('succeeded').has_attr(Items=(u'bleach', u'naruto'))
+        succeeded.provides('has_succeeded').returns(True)
+        refunded = fudge.Fake('refunded').has_attr(Items=(u'onepiece',))
+        refunded.provides('has_succeeded').returns(False)
+        # the history is read once
+        mock_gph.expects_call().times_called(1).returns([succeeded, refunded])
+
+        activated, history = get_user_purchase_state(u'ichigo', request=None)
+        assert_that(activated, is_({u'bleach', u'naruto'}))
+        assert_that(history, is_({u'bleach', u'naruto', u'onepiece'}))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_get_purchasables_batch_and_filter(self):
+        url = '/dataserver2/store/@@get_purchasables'
+        res = self.testapp.get(url,
+                               params={'batchSize': 1,
+                                       'batchStart': 0,
+                                       'sortOn': 'title'},
+                               status=200)
+        assert_that(res.json_body,
+                    has_entries('Items', has_length(1),
+                                'ItemCount', 1,
+                                'Total', greater_than_or_equal_to(1)))
+
+        res = self.testapp.get(url, params={'provider': 'CMU'}, status=200)
+        assert_that(res.json_body,
+                    has_entry('Items', has_length(greater_than_or_equal_to(1))))
+
+        res = self.testapp.get(url, params={'provider': 'NOT_A_PROVIDER'},
+                               status=200)
+        assert_that(res.json_body, has_entry('Items', has_length(0)))
+
+        res = self.testapp.get(url, params={'currency': 'EUR'}, status=200)
+        assert_that(res.json_body, has_entry('Items', has_length(0)))
+
+        self.testapp.get(url, params={'sortOn': 'foo'}, status=422)
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_get_purchasables_sparse_fields(self):
+        url = '/dataserver2/store/@@get_purchasables'
+        res = self.testapp.get(url,
+                               params={'fields': 'NTIID,Title,Amount,Currency'},
+                               status=200)
+        items = res.json_body['Items']
+        assert_that(items, has_length(greater_than_or_equal_to(1)))
+        assert_that(items[0], has_key('Amount'))
+        assert_that(items[0], is_not(has_key('Links')))
+        assert_that(items[0], is_not(has_key('StripeConnectKey')))
+
+        res = self.testapp.get(url, params={'exclude': 'Links'}, status=200)
+        items = res.json_body['Items']
+        assert_that(items[0], is_not(has_key('Links')))
+        assert_that(items[0], has_key('NTIID'))
+
+        res = self.testapp.get('/dataserver2/store/@@get_purchase_history',
+                               params={'fields': 'State'},
+                               status=200)
+        assert_that(res.json_body, has_key('Items'))
+
+    @fudge.patch('nti.app.store.pricing.get_purchasable')
+    def test_cached_pricing(self, mock_gp):
+        mock_gp.is_callable().returns(fudge.Fake('purchasable').has_attr(lastModified=1))
+
+        class Pricing(object):
+            def __init__(self):
+                self.Items = [u'bleach']
+        func = fudge.Fake('price').expects_call().times_called(1).returns(Pricing())
+
+        entries = ((u'tag:nextthought.com,2011-10:NTI-purchasable-bleach', 1, None),)
+        first = cached_pricing(func, u'', entries)
+        first.Items.append(u'naruto')
+        # callers get their own copy of the cached result
+        second = cached_pricing(func, u'', entries)
+        assert_that(second.Items, is_([u'bleach']))
+        second.Items.append(u'onepiece')
+        assert_that(cached_pricing(func, u'', entries).Items, is_([u'bleach']))
+
+    def test_purchasable_acl(self):
+        purchasable = fudge.Fake('purchasable')
+        purchasable.provides('isPublic').returns(True)
+
+        class _Provider(PurchasableACLProvider):
+            pass
+
+        acl = PurchasableACLProvider(purchasable).__acl__
+        size = len(acl)
+        acl.append(None)
+        # the shared ACL cannot be changed by callers
+        assert_that(PurchasableACLProvider(purchasable).__acl__,
+                    has_length(size))
+        # subclasses get ACEs for their own class
+        _Provider(purchasable).__acl__
+        assert_that(_purchasable_aces, has_key((_Provider, True)))
+        assert_that(_purchasable_aces, has_key((PurchasableACLProvider, True)))
+
+    def test_fieldset_scope(self):
+        request = DummyRequest(params={'fields': 'NTIID,Title',
+                                       'exclude': 'Links'})
+        # other views may use these parameters
+        assert_that(get_fieldset(request), is_((None, None)))
+        assert_that(is_field_requested('Links', request), is_(True))
+
+        enable_fieldset(request)
+        assert_that(get_fieldset(request),
+                    is_((frozenset(('NTIID', 'Title')), frozenset(('Links',)))))
+        assert_that(is_field_requested('Links', request), is_(False))
+        assert_that(is_field_requested('Title', request), is_(True))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_get_purchasables_not_modified(self):
+        url = '/dataserver2/store/@@get_purchasables'
+        res = self.testapp.get(url, status=200)
+        etag = res.headers.get('ETag')
+        assert_that(etag, is_not(none()))
+
+        res = self.testapp.get(url,
+                               headers={'If-None-Match': etag},
+                               status=304)
+        assert_that(res.headers.get('ETag'), is_(etag))
+
+        # different params give a different representation
+        self.testapp.get(url + '?purchasables=foo',
+                         headers={'If-None-Match': etag},
+                         status=200)
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_get_purchasables_connect_key_modified(self):
+        url = '/dataserver2/store/@@get_purchasables'
+        etag = self.testapp.get(url, status=200).headers.get('ETag')
+
+        # listings include the connect keys
+        with mock_dataserver.mock_db_trans(self.ds):
+            connect_key = PersistentStripeConnectKey(Alias=u'bleach',
+                                                     StripeUserID=u'user_id_1',
+                                                     LiveMode=False,
+                                                     PrivateKey=u'private_key_1',
+                                                     PublicKey=u'public_key_1',
+                                                     TokenType=u'bearer')
+            get_stripe_key_container().add_key(connect_key)
+        try:
+            res = self.testapp.get(url,
+                                   headers={'If-None-Match': etag},
+                                   status=200)
+            assert_that(res.headers.get('ETag'), is_not(etag))
+        finally:
+            with mock_dataserver.mock_db_trans(self.ds):
+                get_stripe_key_container().remove_key(u'bleach')
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.app.store.views.view_mixin.get_user_purchase_state')
+    def test_get_purchasables_purchase_state_modified(self, mock_gups):
+        state = [(set(), {NTIID})]
+        mock_gups.is_callable().calls(lambda *unused_args: state[0])
+
+        url = '/dataserver2/store/@@get_purchasables'
+        etag = self.testapp.get(url, status=200).headers.get('ETag')
+        self.testapp.get(url, headers={'If-None-Match': etag}, status=304)
+
+        # a pending purchase succeeds
+        state[0] = ({NTIID}, {NTIID})
+        self.testapp.get(url, headers={'If-None-Match': etag}, status=200)
+
     @WithSharedApplicationMockDS(users=True, testapp=True)
     def test_get_purchase_history(self):
         url = '/dataserver2/store/@@get_purchase_history'
@@ -86,6 +314,9 @@ class TestStoreViews(ApplicationLayerTest):
         items = json_body['Items']
         assert_that(items, has_length(greater_than_or_equal_to(0)))
 
+        res = self.testapp.get(url, params={'expand': 'shallow'}, status=200)
+        assert_that(res.json_body, has_key('Items'))
+
     def _get_pending_purchases(self):
         url = '/dataserver2/store/@@get_pending_purchases'
         res = self.testapp.get(url, status=200)
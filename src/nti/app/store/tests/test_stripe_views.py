@@ -46,7 +46,10 @@ from nti.store.payments.stripe.model import PersistentStripeConnectKey
 
 does_not = is_not
 
+import hmac
+import time
 import uuid
+import hashlib
 
 import fudge
 
@@ -58,9 +61,26 @@ from six.moves import urllib_parse
 
 from zope import interface
 
+from nti.app.store.breaker import DEFAULT_FAILURE_THRESHOLD
+
+from nti.app.store.breaker import CircuitOpen
+
+from nti.app.store.breaker import reset_breakers
+
+from nti.app.store.coupons import CouponMirror
+
+from nti.app.store.coupons import validate_coupon as validate_local_coupon
+
+from nti.app.store.idempotency import IdempotencyKeyStore
+
+from nti.app.store.interfaces import IStripeWebhookSecret
+
+from nti.app.store.views.stripe_views import perform_pricing
 from nti.app.store.views.stripe_views import process_purchase
 from nti.app.store.views.stripe_views import url_with_params
 
+from nti.app.store.webhooks import StripeWebhookSecret
+
 from nti.app.store.tests import ApplicationStoreTestLayer
 
 from nti.app.testing.application_webtest import ApplicationLayerTest
@@ -85,6 +105,8 @@ from nti.store.payments.stripe.storage import get_stripe_key_container
 from nti.store.payments.stripe.stripe_purchase import create_stripe_purchase_item
 from nti.store.payments.stripe.stripe_purchase import create_stripe_purchase_order
 
+from nti.store.store import get_purchasable
+
 
 class MockRunner(object):
 
@@ -229,6 +251,104 @@ class TestStripeViews(ApplicationLayerTest):
         assert_that(json_body, has_entry('Type', 'PricingError'))
         assert_that(json_body, has_entry('Message', 'Aizen'))
 
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    def test_price_purchasables(self):
+        url = '/dataserver2/store/@@price_purchasables_with_stripe_coupon'
+        params = {'Items': [{'ntiid': self.purchasable_id, 'quantity': 2},
+                            {'ntiid': self.purchasable_id, 'quantity': 2},
+                            {'ntiid': u'tag:nextthought.com,2011-10:NTI-not_found'},
+                            {'ntiid': self.purchasable_id, 'quantity': -1}]}
+        res = self.testapp.post_json(url, params, status=200)
+        json_body = res.json_body
+        assert_that(json_body, has_entry('ItemCount', 4))
+        items = json_body['Items']
+        assert_that(items[0], has_entry('PurchasePrice', 600.0))
+        assert_that(items[1], has_entry('PurchasePrice', 600.0))
+        assert_that(items[2], has_entries('Type', 'PricingError',
+                                          'Message', 'Invalid purchasable.'))
+        assert_that(items[3], has_entries('Type', 'PricingError',
+                                          'Message', 'Invalid quantity.'))
+
+        self.testapp.post_json(url, {'Items': []}, status=422)
+
+        url = '/dataserver2/store/@@price_purchasables'
+        res = self.testapp.post_json(url,
+                                     {'Items': [self.purchasable_id]},
+                                     status=200)
+        assert_that(res.json_body,
+                    has_entry('Items', contains(has_entry('Amount', 300.0))))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.app.store.views.stripe_views.perform_pricing')
+    def test_price_purchasables_invalid_coupon(self, mock_pr):
+        # the coupon is only resolved once
+        mock_pr.expects_call().times_called(1).raises(InvalidStripeCoupon())
+
+        url = '/dataserver2/store/@@price_purchasables_with_stripe_coupon'
+        params = {'Items': [{'ntiid': self.purchasable_id, 'coupon': '123'},
+                            {'ntiid': self.purchasable_id, 'coupon': '123',
+                             'quantity': 2}]}
+        res = self.testapp.post_json(url, params, status=200)
+        assert_that(res.json_body,
+                    has_entry('Items',
+                              contains(has_entry('Message', 'Invalid coupon.'),
+                                       has_entry('Message', 'Invalid coupon.'))))
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.app.store.views.stripe_views.perform_pricing',
+                 'nti.app.store.views.stripe_views.get_purchasable')
+    def test_price_purchasables_coupon_per_provider(self, mock_pr, mock_gp):
+        bleach = u'tag:nextthought.com,2011-10:NTI-purchasable-bleach'
+        other = fudge.Fake('purchasable').has_attr(Provider=u'NTI')
+
+        def _get_purchasable(ntiid):
+            return other if ntiid == bleach else get_purchasable(ntiid)
+        mock_gp.is_callable().calls(_get_purchasable)
+
+        def _pricing(ntiid, quantity=None, coupon=None, pricer=None):
+            # the coupon is only valid for the CMU connect key
+            if ntiid == bleach:
+                raise InvalidStripeCoupon()
+            return perform_pricing(ntiid, quantity=quantity, pricer=pricer)
+        mock_pr.is_callable().calls(_pricing)
+
+        url = '/dataserver2/store/@@price_purchasables_with_stripe_coupon'
+        params = {'Items': [{'ntiid': bleach, 'coupon': '123'},
+                            {'ntiid': self.purchasable_id, 'coupon': '123'}]}
+        res = self.testapp.post_json(url, params, status=200)
+        assert_that(res.json_body,
+                    has_entry('Items',
+                              contains(has_entry('Message', 'Invalid coupon.'),
+                                       has_entry('PurchasePrice', 300.0))))
+
+    @fudge.patch('nti.app.store.coupons.get_coupon_mirror')
+    def test_validate_coupon_remote_answers(self, mock_gcm):
+        api_key = u'sk_test_bleach'
+        mirror = CouponMirror(api_key)
+        mock_gcm.is_callable().returns(mirror)
+        remote = fudge.Fake('remote').expects_call().times_called(2).returns(False)
+
+        # invalid answers are kept too
+        assert_that(validate_local_coupon(u'BANKAI', api_key, remote), is_(False))
+        assert_that(validate_local_coupon(u'BANKAI', api_key, remote), is_(False))
+
+        # until they expire
+        mirror.record(u'BANKAI', valid=False, ttl=-1)
+        assert_that(mirror.lookup(u'BANKAI'), is_(none()))
+        assert_that(validate_local_coupon(u'BANKAI', api_key, remote), is_(False))
+
+    @fudge.patch('nti.app.store.coupons.stripe.Coupon.list')
+    def test_coupon_mirror_refresh_breaker(self, mock_list):
+        reset_breakers()
+        mock_list.is_callable().raises(stripe.error.APIConnectionError('down'))
+        mirror = CouponMirror(u'sk_test_bleach')
+        for unused in range(DEFAULT_FAILURE_THRESHOLD):
+            with self.assertRaises(stripe.error.APIConnectionError):
+                mirror.refresh()
+        # the bulk refresh fails fast once Stripe is known to be down
+        with self.assertRaises(CircuitOpen):
+            mirror.refresh()
+
     def _get_pending_purchases(self):
         url = '/dataserver2/store/@@get_pending_purchases'
         res = self.testapp.get(url, status=200)
@@ -319,6 +439,109 @@ class TestStripeViews(ApplicationLayerTest):
         url = '/dataserver2/store/@@get_purchase_attempt/foo'
         res = self.testapp.get(url, status=404)
 
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.app.store.views.stripe_views.addAfterCommitHook')
+    @fudge.patch('nti.store.payments.stripe.processor.purchase.create_charge')
+    @fudge.patch('nti.store.payments.stripe.processor.purchase.get_transaction_runner')
+    def test_post_stripe_payment_idempotency_key(self, mock_aach, mock_cc, mock_gtr):
+        mock_aach.is_callable().with_args().calls(do_purchase)
+        mock_gtr.is_callable().with_args().returns(MockRunner())
+
+        self._create_fake_charge(300, mock_cc)
+        url = '/dataserver2/store/@@post_stripe_payment'
+        params = {'purchasableId': self.purchasable_id,
+                  'amount': 300,
+                  'token': "tok_1053"}
+        headers = {'Idempotency-Key': 'a1b2c3'}
+        res = self.testapp.post_json(url, params, headers=headers, status=200)
+        pid = res.json_body['Items'][0]['ID']
+
+        # retried requests return the original attempt
+        res = self.testapp.post_json(url, params, headers=headers, status=200)
+        assert_that(res.json_body['Items'], has_length(1))
+        assert_that(res.json_body['Items'][0], has_entry('ID', pid))
+
+        # the key cannot be reused with a different payload
+        params['amount'] = 200
+        self.testapp.post_json(url, params, headers=headers, status=422)
+
+    def test_idempotency_key_store(self):
+        store = IdempotencyKeyStore()
+        store.add(u'ichigo\na1b2c3', u'purchase-1', u'digest')
+        store.add(u'rukia\na1b2c3', u'purchase-2', u'digest', ttl=-1)
+        assert_that(store, has_length(2))
+        assert_that(store.get(u'ichigo\na1b2c3'),
+                    is_((u'purchase-1', u'digest')))
+        assert_that(store.get(u'rukia\na1b2c3'), is_(none()))
+        # only the shard of the given key is purged
+        assert_that(store.purge(key=u'rukia\na1b2c3'), is_(1))
+        assert_that(store, has_length(1))
+
+    def _sign_event(self, payload, secret):
+        timestamp = int(time.time())
+        signed = ('%d.%s' % (timestamp, payload)).encode('utf-8')
+        signature = hmac.new(secret.encode('utf-8'), signed,
+                             hashlib.sha256).hexdigest()
+        return 't=%d,v1=%s' % (timestamp, signature)
+
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.app.store.views.stripe_views.addAfterCommitHook')
+    @fudge.patch('nti.store.payments.stripe.processor.purchase.create_charge')
+    @fudge.patch('nti.store.payments.stripe.processor.purchase.get_transaction_runner')
+    def test_stripe_webhook(self, mock_aach, mock_cc, mock_gtr):
+        mock_aach.is_callable().with_args().calls(do_purchase)
+        mock_gtr.is_callable().with_args().returns(MockRunner())
+
+        self._create_fake_charge(300, mock_cc)
+        url = '/dataserver2/store/@@post_stripe_payment'
+        params = {'purchasableId': self.purchasable_id,
+                  'amount': 300,
+                  'token': "tok_1053"}
+        res = self.testapp.post_json(url, params, status=200)
+        pid = res.json_body['Items'][0]['ID']
+
+        # purchases are found through the charge metadata
+        payload = json.dumps({
+            'id': 'evt_1061',
+            'object': 'event',
+            'type': 'charge.refunded',
+            'data': {
+                'object': {
+                    'id': 'charge_1046',
+                    'object': 'charge',
+                    'refunded': True,
+                    'metadata': {
+                        'PurchaseID': pid,
+                        'Username': self.default_username
+                    }
+                }
+            }
+        })
+        url = '/dataserver2/store/stripe/@@webhook'
+        # not configured
+        self.testapp.post(url, payload, status=404)
+
+        secret = StripeWebhookSecret('whsec_1061')
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(secret, IStripeWebhookSecret)
+        try:
+            headers = {'Stripe-Signature': 'invalid'}
+            self.testapp.post(url, payload, headers=headers, status=400)
+
+            headers = {
+                'Stripe-Signature': self._sign_event(payload, 'whsec_1061')
+            }
+            res = self.testapp.post(url, payload, headers=headers, status=200)
+            assert_that(res.json_body, has_entry('Items', [pid]))
+        finally:
+            gsm.unregisterUtility(secret, IStripeWebhookSecret)
+
+        url = '/dataserver2/store/@@get_purchase_attempt'
+        res = self.testapp.get(url, params={'purchase': pid}, status=200)
+        assert_that(res.json_body,
+                    has_entry('Items',
+                              has_item(has_entry('State', 'Refunded'))))
+
     @WithSharedApplicationMockDS(users=True, testapp=True)
     @fudge.patch('nti.app.store.views.stripe_views.addAfterCommitHook')
     @fudge.patch('nti.store.payments.stripe.processor.purchase.create_charge')
@@ -506,6 +729,41 @@ class TestStripeViews(ApplicationLayerTest):
         assert_that(json_body,
                     has_entry('ID', is_not(none())))
 
+    @WithSharedApplicationMockDS(users=True, testapp=True)
+    @fudge.patch('nti.app.store.views.stripe_views.call_stripe')
+    def test_create_token_invalid_card(self, mock_cs):
+        # invalid cards never reach stripe
+        mock_cs.is_callable().raises(AssertionError("Stripe called"))
+
+        url = '/dataserver2/store/stripe/@@create_token'
+        params = {
+            'provider': 'CMU',
+            'cvc': '019',
+            'expiry': '0930',
+            'number': '4012000033330027',
+        }
+        res = self.testapp.post(url, json.dumps(params), status=422)
+        assert_that(res.json_body,
+                    has_entries('field', 'cc',
+                                'code', 'IncorrectNumber'))
+
+        # amex cards have four digit security codes
+        params.update(number='378282246310005', expiry='13/30')
+        res = self.testapp.post(url, json.dumps(params), status=422)
+        assert_that(res.json_body,
+                    has_entries('field', 'cvv',
+                                'code', 'InvalidCVC',
+                                'errors', has_length(2)))
+        assert_that(res.json_body['errors'][1],
+                    has_entries('field', 'card_expiry',
+                                'code', 'InvalidExpiry'))
+
+        params.update(cvc='0191', expiry='0120')
+        res = self.testapp.post(url, json.dumps(params), status=422)
+        assert_that(res.json_body,
+                    has_entries('field', 'card_expiry',
+                                'code', 'ExpiredCard'))
+
 
 class MessageCapturingLogger(object):
     msg = None
@@ -604,13 +862,10 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
             class MockResponse(object):
 
                 def __init__(self, code):
-                    self.code = code
-
-                def getcode(self):
-                    return self.code
+                    self.status_code = code
 
-                def read(self):
-                    return json.dumps({
+                def json(self):
+                    return {
                         "token_type": "bearer",
                         "stripe_publishable_key": "PUB_KEY_111",
                         "scope": "read_write",
@@ -618,7 +873,7 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
                         "stripe_user_id": "ACCOUNT_ABC",
                         "refresh_token": "REFRESH_TOKEN_222",
                         "access_token": "ACCESS_TOKEN_333"
-                    })
+                    }
 
             mock_open.is_callable().returns(MockResponse(token_response_status))
 
@@ -708,12 +963,12 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
                 token_response_status=token_response_status)
 
     @WithSharedApplicationMockDS(users=True, testapp=True)
-    @fudge.patch('nti.app.store.views.stripe_views.urllib2.urlopen')
+    @fudge.patch('nti.app.store.views.stripe_views.http_request')
     def test_connect_stripe_account_success(self, mock_open):
         self._test_connect_stripe_account(mock_open, None)
 
     @WithSharedApplicationMockDS(users=True, testapp=True)
-    @fudge.patch('nti.app.store.views.stripe_views.urllib2.urlopen')
+    @fudge.patch('nti.app.store.views.stripe_views.http_request')
     def test_connect_stripe_account_no_params(self, mock_open):
         self._test_connect_stripe_account(mock_open,
                                           {
@@ -723,7 +978,7 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
                                           code=None)
 
     @WithSharedApplicationMockDS(users=True, testapp=True)
-    @fudge.patch('nti.app.store.views.stripe_views.urllib2.urlopen')
+    @fudge.patch('nti.app.store.views.stripe_views.http_request')
     def test_connect_stripe_account_no_state(self, mock_open):
         self._test_connect_stripe_account(mock_open,
                                           {
@@ -733,7 +988,7 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
                                           state_for_redirect=None)
 
     @WithSharedApplicationMockDS(users=True, testapp=True)
-    @fudge.patch('nti.app.store.views.stripe_views.urllib2.urlopen')
+    @fudge.patch('nti.app.store.views.stripe_views.http_request')
     def test_connect_stripe_account_invalid_state(self, mock_open):
         self._test_connect_stripe_account(mock_open,
                                           {
@@ -743,7 +998,7 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
                                           state_for_redirect='invalid')
 
     @WithSharedApplicationMockDS(users=True, testapp=True)
-    @fudge.patch('nti.app.store.views.stripe_views.urllib2.urlopen')
+    @fudge.patch('nti.app.store.views.stripe_views.http_request')
     def test_connect_stripe_account_stripe_error(self, mock_open):
         self._test_connect_stripe_account(mock_open,
                                           {
@@ -754,7 +1009,7 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
                                           error_description="user declined auth")
 
     @WithSharedApplicationMockDS(users=True, testapp=True)
-    @fudge.patch('nti.app.store.views.stripe_views.urllib2.urlopen')
+    @fudge.patch('nti.app.store.views.stripe_views.http_request')
     def test_connect_stripe_account_stripe_http_error(self, mock_open):
         self._test_connect_stripe_account(mock_open,
                                           {
@@ -764,15 +1019,15 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
                                           token_response_status=400)
 
     @WithSharedApplicationMockDS(users=True, testapp=True)
-    @fudge.patch('nti.app.store.views.stripe_views.urllib2.urlopen',
+    @fudge.patch('nti.app.store.views.stripe_views.http_request',
                  'nti.app.store.views.stripe_views.logger')
     def test_connect_stripe_account_stripe_http_exception(self,
                                                           mock_open,
                                                           logger):
-        def urlopen(*args, **kwargs):
+        def http_request(*args, **kwargs):
             raise ValueError('SSL support not available')
 
-        mock_open.is_callable().calls(urlopen)
+        mock_open.is_callable().calls(http_request)
 
         # Capture the exception log that should be called to verify later
         capturing_logger = MessageCapturingLogger()
@@ -788,7 +1043,7 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
                     starts_with("Exception making token request"))
 
     @WithSharedApplicationMockDS(users=True, testapp=True)
-    @fudge.patch('nti.app.store.views.stripe_views.urllib2.urlopen',
+    @fudge.patch('nti.app.store.views.stripe_views.http_request',
                  'nti.app.store.views.stripe_views.ConnectStripeAccount._add_key',
                  'nti.app.store.views.stripe_views.logger')
     def test_connect_stripe_account_persist_exception(self,
@@ -812,7 +1067,7 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
                     starts_with("Exception persisting data"))
 
     @WithSharedApplicationMockDS(users=True, testapp=True)
-    @fudge.patch('nti.app.store.views.stripe_views.urllib2.urlopen')
+    @fudge.patch('nti.app.store.views.stripe_views.http_request')
     def test_connect_stripe_account_already_linked(self, mock_open):
         with mock_dataserver.mock_db_trans():
             self._assign_role(ROLE_SITE_ADMIN, username='sjohnson@nextthought.com')
@@ -845,17 +1100,16 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
         role_manager.assignRoleToPrincipal(role_name, username)
 
     @WithSharedApplicationMockDS(users=True, testapp=True)
-    @fudge.patch('nti.app.store.views.stripe_views.urllib2.urlopen')
-    @fudge.patch('nti.app.store.views.stripe_views.requests.post')
-    def test_disconnect_stripe_account_success(self, mock_open, requests_post):
+    @fudge.patch('nti.app.store.views.stripe_views.http_request')
+    def test_disconnect_stripe_account_success(self, mock_open):
         self._test_connect_stripe_account(mock_open, None)
         with mock_dataserver.mock_db_trans(site_name='mathcounts.nextthought.com'):
             self._assign_role(ROLE_SITE_ADMIN, username='sjohnson@nextthought.com')
 
-        def post(url, data=None, timeout=None, auth=None):
+        def post(method, url, data=None, timeout=None, auth=None):
             return fudge.Fake().expects('raise_for_status').returns(None)
 
-        requests_post.is_callable().calls(post)
+        mock_open.is_callable().calls(post)
         url = "/dataserver2/++etc++hostsites/mathcounts.nextthought.com/++etc++site/StripeConnectKeys/default"
         with self._oauth_registrations(site_name='mathcounts.nextthought.com'):
             self.testapp.delete(url, status=204)
@@ -907,7 +1161,7 @@ class TestStripeConnectViews(StripeTestMixin, ApplicationLayerTest):
         assert_that(params, not_(has_key("ignored")))
 
     @WithSharedApplicationMockDS(users=True, testapp=True)
-    @fudge.patch('nti.app.store.views.stripe_views.urllib2.urlopen')
+    @fudge.patch('nti.app.store.views.stripe_views.http_request')
     def test_stripe_connect_authorize_already_linked(self, mock_open):
         # Ensure one has already been linked
         self._test_connect_stripe_account(mock_open, None)
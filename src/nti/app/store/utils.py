@@ -18,11 +18,24 @@ from requests.structures import CaseInsensitiveDict
 
 from zope import interface
 
+from zope.annotation.interfaces import IAnnotations
+
+from zope.component.hooks import getSite
+
 from zope.interface.common.idatetime import IDate
 from zope.interface.common.idatetime import IDateTime
 
+from pyramid import httpexceptions as hexc
+
+from pyramid.request import Request
+
+from pyramid.threadlocal import get_current_request
+from pyramid.threadlocal import get_current_registry
+
 from nti.app.base.abstract_views import AbstractAuthenticatedView
 
+from nti.app.externalization.error import raise_json_error as raise_error
+
 from nti.app.externalization.view_mixins import ModeledContentUploadRequestUtilsMixin
 
 from nti.app.store import DEFAULT_STRIPE_KEY_ALIAS
@@ -44,6 +57,20 @@ class AbstractPostView(AbstractAuthenticatedView,
         return result
 
 
+def raise_retry_later(request, message, retry_after, **kwargs):
+    """
+    Raise a 503 (service unavailable) error asking the client to retry
+    after the specified number of seconds.
+    """
+    data = {'message': message}
+    data.update(kwargs)
+    try:
+        raise_error(request, hexc.HTTPServiceUnavailable, data, None)
+    except hexc.HTTPServiceUnavailable as e:
+        e.retry_after = int(retry_after)
+        raise
+
+
 def is_valid_timestamp(ts):
     try:
         ts = float(ts)
@@ -110,6 +137,123 @@ def parse_datetime(t, safe=False):
         raise e
 
 
+def get_site_annotation(key, factory=None, site=None):
+    """
+    Return the object stored under the specified annotation key of the
+    given (or current) site. If it does not exist and a factory is given,
+    it is created, located and stored.
+    """
+    site = getSite() if site is None else site
+    annotations = IAnnotations(site, None)
+    if annotations is None:
+        return None
+    result = annotations.get(key)
+    if result is None and factory is not None:
+        result = annotations[key] = factory()
+        result.__parent__ = site
+        result.__name__ = key
+    return result
+
+
+def get_request_cache(name, request=None):
+    """
+    Return the named dictionary cache that lives as long as the given
+    (or current) request. Without a request a new (throwaway) dictionary
+    is returned.
+    """
+    request = get_current_request() if request is None else request
+    if request is None:
+        return {}
+    caches = getattr(request, '_v_store_caches', None)
+    if caches is None:
+        caches = request._v_store_caches = {}
+    return caches.setdefault(name, {})
+
+
+def make_site_request(site_name=None):
+    """
+    Return a request standing in for the user's own in work done outside
+    of it (e.g. a replayed purchase), so that emails can still be
+    rendered and sent. Its URLs point to the specified site.
+    """
+    base_url = 'https://%s' % site_name if site_name else None
+    result = Request.blank('/', base_url=base_url)
+    result.registry = get_current_registry()
+    result.possible_site_names = (site_name,) if site_name else ()
+    return result
+
+
+#: Fields always kept in sparse external objects
+REQUIRED_FIELDS = ('Class', 'MimeType')
+
+
+def _parse_field_names(value):
+    if not value:
+        return None
+    return frozenset(x for x in value.replace(',', ' ').split() if x)
+
+
+def enable_fieldset(request=None):
+    """
+    Honor the ``fields`` and ``exclude`` parameters of the given (or
+    current) request. Only the store views that support sparse fieldsets
+    enable them; other views may give those parameters other meanings.
+    """
+    request = get_current_request() if request is None else request
+    if request is not None:
+        request._v_store_fieldset_enabled = True
+
+
+def get_fieldset(request=None):
+    """
+    Return a tuple with the sets of field names requested (``fields``) and
+    excluded (``exclude``) by the client. Either may be ``None``, and both
+    are unless a store view enabled sparse fieldsets (see
+    :func:`enable_fieldset`).
+    """
+    request = get_current_request() if request is None else request
+    if not getattr(request, '_v_store_fieldset_enabled', False):
+        return (None, None)
+    cache = get_request_cache('fieldset', request)
+    if 'fieldset' not in cache:
+        params = CaseInsensitiveDict(getattr(request, 'params', None) or {})
+        cache['fieldset'] = (_parse_field_names(params.get('fields')),
+                             _parse_field_names(params.get('exclude')))
+    return cache['fieldset']
+
+
+def is_field_requested(names, request=None):
+    """
+    Return whether any of the specified field names is to be included in
+    the external objects returned to the client.
+    """
+    fields, exclude = get_fieldset(request)
+    if isinstance(names, six.string_types):
+        names = (names,)
+    for name in names:
+        if      (fields is None or name in fields) \
+            and (exclude is None or name not in exclude):
+            return True
+    return False
+
+
+def filter_fields(external, request=None):
+    """
+    Drop from the specified external object the fields not requested by
+    the client.
+    """
+    fields, exclude = get_fieldset(request)
+    if fields is None and exclude is None:
+        return external
+    for name in list(external.keys()):
+        if name in REQUIRED_FIELDS:
+            continue
+        if     (fields is not None and name not in fields) \
+            or (exclude is not None and name in exclude):
+            del external[name]
+    return external
+
+
 @interface.implementer(IPurchasableDefaultFieldProvider)
 class PurchasableDefaultFieldProvider(object):
 
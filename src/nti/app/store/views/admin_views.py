@@ -25,6 +25,7 @@ import six
 
 from zope import component
 
+from zope.component.hooks import getSite
 from zope.component.hooks import site as current_site
 
 from zope.intid.interfaces import IIntIds
@@ -35,11 +36,21 @@ from nti.app.externalization.error import raise_json_error as raise_error
 
 from nti.app.store import MessageFactory as _
 
+from nti.app.store.breaker import get_breakers
+
+from nti.app.store.catalog import install_purchase_state_index
+from nti.app.store.catalog import install_purchase_charge_index
+
+from nti.app.store.index import rebuild_purchasable_index
+
+from nti.app.store.processing import get_processing_pool
+
 from nti.app.store.utils import to_boolean
 from nti.app.store.utils import parse_datetime
 from nti.app.store.utils import AbstractPostView
 from nti.app.store.utils import is_valid_pve_int
 
+from nti.app.store.views import get_current_site
 from nti.app.store.views import StorePathAdapter
 
 from nti.app.store.views.view_mixin import GeneratePurchaseInvoiceViewMixin
@@ -48,6 +59,7 @@ from nti.dataserver import authorization as nauth
 
 from nti.dataserver.interfaces import IDataserver
 from nti.dataserver.interfaces import IShardLayout
+from nti.dataserver.interfaces import IDataserverTransactionRunner
 
 from nti.externalization.interfaces import LocatedExternalDict
 from nti.externalization.interfaces import StandardExternalFields
@@ -86,9 +98,16 @@ from nti.store.utils import PURCHASE_ATTEMPT_MIME_TYPES
 
 from nti.zodb import is_broken
 
+ITEMS = StandardExternalFields.ITEMS
 TOTAL = StandardExternalFields.TOTAL
 ITEM_COUNT = StandardExternalFields.ITEM_COUNT
 
+#: Rows of keys rendered per streamed CSV chunk
+CSV_CHUNK_SIZE = 500
+
+#: Last row of a CSV export that failed after it started
+CSV_ERROR_MARKER = u'#ERROR: export incomplete'
+
 logger = __import__('logging').getLogger(__name__)
 
 
@@ -98,6 +117,56 @@ def _tx_string(s):
     return s
 
 
+def _csv_chunk(rows):
+    stream = BytesIO()
+    writer = csv.writer(stream)
+    for row in rows:
+        writer.writerow([_tx_string(x) for x in row])
+    return stream.getvalue()
+
+
+def _run(func, site_name=None):
+    runner = component.getUtility(IDataserverTransactionRunner)
+    return runner(func, site_names=(site_name,) if site_name else ())
+
+
+def _stream_csv(header, keys, rows, site_name=None, chunk_size=None):
+    """
+    Return a generator of the CSV chunks of the rows of the specified keys.
+
+    The generator is iterated after the request transaction has ended, so
+    the rows of each chunk of keys are rendered in their own transaction.
+    As the response has already started, a chunk that fails ends the
+    export with an error marker row.
+    """
+    chunk_size = chunk_size or CSV_CHUNK_SIZE
+    yield _csv_chunk((header,))
+    for idx in range(0, len(keys), chunk_size):
+        chunk = keys[idx:idx + chunk_size]
+        try:
+            data = _run(lambda chunk=chunk: _csv_chunk(rows(chunk)), site_name)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Cannot export CSV rows %s to %s",
+                             idx, idx + len(chunk))
+            yield _csv_chunk(((CSV_ERROR_MARKER,),))
+            return
+        yield data
+
+
+class CSVExportViewMixin(object):
+
+    filename = None
+
+    def stream_response(self, header, keys, rows):
+        response = self.request.response
+        response.content_encoding = 'identity'
+        response.content_type = 'text/csv; charset=UTF-8'
+        response.content_disposition = \
+            'attachment; filename="%s"' % self.filename
+        response.app_iter = _stream_csv(header, keys, rows, get_current_site())
+        return response
+
+
 @view_config(name="GetUsersPurchaseHistory")
 @view_config(name="get_users_purchase_history")
 @view_defaults(route_name='objects.generic.traversal',
@@ -105,60 +174,29 @@ def _tx_string(s):
                permission=nauth.ACT_NTI_ADMIN,
                context=StorePathAdapter,
                request_method='GET')
-class GetUsersPurchaseHistoryView(AbstractAuthenticatedView):
-
-    def __call__(self):
-        request = self.request
-        params = CaseInsensitiveDict(request.params)
-        purchasable = params.get('ntiid') \
-                   or params.get('purchasable') \
-                   or params.get('purchasableId')
-        if purchasable and get_purchasable(purchasable) is None:
-            raise_error(self.request,
-                        hexc.HTTPUnprocessableEntity,
-                        {
-                            'message': _(u"Purchasable not found."),
-                            'field': 'purchasable'
-                        },
-                        None)
-
-        all_failed = to_boolean(params.get('failed'))
-        all_succeeded = to_boolean(params.get('succeeded'))
-
-        catalog = get_purchase_catalog()
-        mime_types = PURCHASE_ATTEMPT_MIME_TYPES
-        intids_purchases = catalog[IX_MIMETYPE].apply({'any_of': mime_types})
+class GetUsersPurchaseHistoryView(AbstractAuthenticatedView,
+                                  CSVExportViewMixin):
 
-        usernames = params.get('usernames') or params.get('username')
-        if usernames:
-            usernames = [x.lower() for x in usernames.split(",")]
-            creator_intids = catalog[IX_CREATOR].apply({'any_of': usernames})
-            intids_purchases = catalog.family.IF.intersection(intids_purchases,
-                                                              creator_intids)
+    filename = 'purchases.csv'
 
-        stream = BytesIO()
-        writer = csv.writer(stream)
-        response = request.response
-        response.content_encoding = 'identity'
-        response.content_type = 'text/csv; charset=UTF-8'
-        response.content_disposition = 'attachment; filename="purchases.csv"'
+    header = ["username", 'name', 'email', 'transaction',
+              'date', 'amount', 'status']
 
-        header = ["username", 'name', 'email', 'transaction',
-                  'date', 'amount', 'status']
-        writer.writerow(header)
+    purchasable = all_failed = all_succeeded = None
 
+    def rows(self, uids):
         intids = component.getUtility(IIntIds)
-        for uid in intids_purchases or ():
+        for uid in uids:
             purchase = intids.queryObject(uid)
             if not IPurchaseAttempt.providedBy(purchase) \
                     or is_broken(purchase, uid):
                 continue
 
-            if purchasable and purchasable not in purchase.Items:
+            if self.purchasable and self.purchasable not in purchase.Items:
                 continue
 
-            if     (all_succeeded and not purchase.has_succeeded()) \
-                or (all_failed and not purchase.has_failed()):
+            if     (self.all_succeeded and not purchase.has_succeeded()) \
+                or (self.all_failed and not purchase.has_failed()):
                 continue
 
             status = purchase.State
@@ -174,13 +212,40 @@ class GetUsersPurchaseHistoryView(AbstractAuthenticatedView):
             email = getattr(profile, 'email', None) or u''
             name = getattr(profile, 'realname', None) or username
 
-            row_data = [username, name, email, code, date, amount, status]
-            writer.writerow([_tx_string(x) for x in row_data])
+            yield [username, name, email, code, date, amount, status]
 
-        stream.flush()
-        stream.seek(0)
-        response.body_file = stream
-        return response
+    def __call__(self):
+        request = self.request
+        params = CaseInsensitiveDict(request.params)
+        purchasable = params.get('ntiid') \
+                   or params.get('purchasable') \
+                   or params.get('purchasableId')
+        if purchasable and get_purchasable(purchasable) is None:
+            raise_error(self.request,
+                        hexc.HTTPUnprocessableEntity,
+                        {
+                            'message': _(u"Purchasable not found."),
+                            'field': 'purchasable'
+                        },
+                        None)
+        self.purchasable = purchasable
+        self.all_failed = to_boolean(params.get('failed'))
+        self.all_succeeded = to_boolean(params.get('succeeded'))
+
+        catalog = get_purchase_catalog()
+        mime_types = PURCHASE_ATTEMPT_MIME_TYPES
+        intids_purchases = catalog[IX_MIMETYPE].apply({'any_of': mime_types})
+
+        usernames = params.get('usernames') or params.get('username')
+        if usernames:
+            usernames = [x.lower() for x in usernames.split(",")]
+            creator_intids = catalog[IX_CREATOR].apply({'any_of': usernames})
+            intids_purchases = catalog.family.IF.intersection(intids_purchases,
+                                                              creator_intids)
+
+        return self.stream_response(self.header,
+                                    list(intids_purchases or ()),
+                                    self.rows)
 
 
 @view_config(name="GetUsersGiftHistory")
@@ -190,7 +255,38 @@ class GetUsersPurchaseHistoryView(AbstractAuthenticatedView):
                permission=nauth.ACT_NTI_ADMIN,
                context=StorePathAdapter,
                request_method='GET')
-class GetUsersGiftHistoryView(AbstractAuthenticatedView):
+class GetUsersGiftHistoryView(AbstractAuthenticatedView,
+                              CSVExportViewMixin):
+
+    filename = 'gifts.csv'
+
+    header = ["transaction", "from", 'sender', 'to',
+              'receiver', 'date', 'amount', 'status']
+
+    end_time = start_time = all_failed = all_succeeded = None
+
+    def rows(self, usernames):
+        for username in usernames:
+            purchases = get_gift_purchase_history(username,
+                                                  end_time=self.end_time,
+                                                  start_time=self.start_time)
+            if self.all_succeeded:
+                purchases = (p for p in purchases if p.has_succeeded())
+            elif self.all_failed:
+                purchases = (p for p in purchases if p.has_failed())
+
+            for p in purchases:
+                started = datetime.fromtimestamp(p.StartTime)
+                started = isodate.date_isoformat(started)
+                amount = getattr(p.Pricing, 'TotalPurchasePrice', None) or u''
+                yield [get_gift_code(p),
+                       username,
+                       p.SenderName,
+                       p.Receiver,
+                       p.ReceiverName,
+                       started,
+                       amount,
+                       p.State]
 
     def __call__(self):
         request = self.request
@@ -199,53 +295,17 @@ class GetUsersGiftHistoryView(AbstractAuthenticatedView):
         if usernames:
             usernames = set(usernames.split(","))
 
-        all_failed = to_boolean(params.get('failed'))
-        all_succeeded = to_boolean(params.get('succeeded'))
-
-        end_time = parse_datetime(params.get('endTime', None))
-        start_time = parse_datetime(params.get('startTime', None))
-
-        stream = BytesIO()
-        writer = csv.writer(stream)
-        response = request.response
-        response.content_encoding = 'identity'
-        response.content_type = 'text/csv; charset=UTF-8'
-        response.content_disposition = 'attachment; filename="gifts.csv"'
+        self.all_failed = to_boolean(params.get('failed'))
+        self.all_succeeded = to_boolean(params.get('succeeded'))
 
-        header = ["transaction", "from", 'sender', 'to',
-                  'receiver', 'date', 'amount', 'status']
-        writer.writerow(header)
+        self.end_time = parse_datetime(params.get('endTime', None))
+        self.start_time = parse_datetime(params.get('startTime', None))
 
         registry = get_gift_registry()
-        for username in registry.keys():
-            if usernames and username not in usernames:
-                continue
-            purchases = get_gift_purchase_history(username,
-                                                  end_time=end_time,
-                                                  start_time=start_time)
-            if all_succeeded:
-                purchases = (p for p in purchases if p.has_succeeded())
-            elif all_failed:
-                purchases = (p for p in purchases if p.has_failed())
-
-            for p in purchases:
-                start_time = datetime.fromtimestamp(p.StartTime)
-                started = isodate.date_isoformat(start_time)
-                amount = getattr(p.Pricing, 'TotalPurchasePrice', None) or u''
-                row_data = [get_gift_code(p),
-                            username,
-                            p.SenderName,
-                            p.Receiver,
-                            p.ReceiverName,
-                            started,
-                            amount,
-                            p.State]
-                writer.writerow([_tx_string(x) for x in row_data])
-
-        stream.flush()
-        stream.seek(0)
-        response.body_file = stream
-        return response
+        keys = [
+            x for x in registry.keys() if not usernames or x in usernames
+        ]
+        return self.stream_response(self.header, keys, self.rows)
 
 
 # post views
@@ -401,6 +461,8 @@ class RebuildPurchaseCatalogView(AbstractAuthenticatedView):
         intids = component.getUtility(IIntIds)
         # clear indexes
         catalog = get_purchase_catalog()
+        install_purchase_state_index(catalog)
+        install_purchase_charge_index(catalog)
         for index in list(catalog.values()):
             index.clear()
         # reindex user purchase history
@@ -427,3 +489,71 @@ class RebuildPurchaseCatalogView(AbstractAuthenticatedView):
         result = LocatedExternalDict()
         result[ITEM_COUNT] = result[TOTAL] = count
         return result
+
+
+@view_config(name='RebuildPurchasableIndex')
+@view_config(name='rebuild_purchasable_index')
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               request_method='POST',
+               context=StorePathAdapter,
+               permission=nauth.ACT_NTI_ADMIN)
+class RebuildPurchasableIndexView(AbstractAuthenticatedView):
+
+    def __call__(self):
+        result = LocatedExternalDict()
+        items = result[ITEMS] = {}
+        for site in [getSite()] + list(get_all_host_sites()):
+            with current_site(site):
+                index = rebuild_purchasable_index(site)
+                items[site.__name__] = len(index)
+        result[ITEM_COUNT] = result[TOTAL] = sum(items.values())
+        return result
+
+
+@view_config(name='PurchaseProcessingPool')
+@view_config(name='purchase_processing_pool')
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               request_method='GET',
+               context=StorePathAdapter,
+               permission=nauth.ACT_NTI_ADMIN)
+class PurchaseProcessingPoolView(AbstractAuthenticatedView):
+
+    def __call__(self):
+        pool = get_processing_pool()
+        result = LocatedExternalDict()
+        result['Size'] = pool.size
+        result['MaxQueue'] = pool.max_queue
+        result['Queued'] = pool.queued
+        result['Workers'] = pool.workers
+        result['InFlight'] = pool.in_flight
+        result['Accepting'] = pool.accepting()
+        return result
+
+
+@view_config(name='StripeCircuitBreakers')
+@view_config(name='stripe_circuit_breakers')
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               request_method='GET',
+               context=StorePathAdapter,
+               permission=nauth.ACT_NTI_ADMIN)
+class StripeCircuitBreakersView(AbstractAuthenticatedView):
+
+    def __call__(self):
+        result = LocatedExternalDict()
+        items = result[ITEMS] = []
+        for breaker in get_breakers():
+            items.append({
+                'Operation': breaker.operation,
+                'Key': breaker.key,
+                'State': breaker.state,
+                'Failures': breaker.failures,
+                'LatencyBudget': breaker.budget,
+                'RetryAfter': breaker.retry_after,
+                'LastFailure': breaker.lastFailure,
+            })
+        items.sort(key=lambda x: (x['Operation'], x['Key'] or ''))
+        result[ITEM_COUNT] = result[TOTAL] = len(items)
+        return result
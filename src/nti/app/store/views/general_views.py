@@ -8,17 +8,16 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
-import time
 from functools import partial
 from six.moves.urllib_parse import unquote
 
-import gevent
-
 from requests.structures import CaseInsensitiveDict
 
 from zope import component
 from zope import interface
 
+from zope.cachedescriptors.property import Lazy
+
 from pyramid import httpexceptions as hexc
 
 from pyramid.view import view_config
@@ -35,7 +34,18 @@ from nti.app.renderers.interfaces import IUncacheableInResponse
 
 from nti.app.store import MessageFactory as _
 
+from nti.app.store.catalog import get_pending_purchases
+from nti.app.store.catalog import get_gift_pending_purchases
+
+from nti.app.store.pricing import cached_pricing
+
+from nti.app.store.sync import should_sync
+from nti.app.store.sync import enqueue_sync
+
+from nti.app.store.utils import get_fieldset
+from nti.app.store.utils import filter_fields
 from nti.app.store.utils import parse_datetime
+from nti.app.store.utils import enable_fieldset
 from nti.app.store.utils import is_valid_pve_int
 from nti.app.store.utils import AbstractPostView
 
@@ -44,12 +54,15 @@ from nti.app.store.views import StorePathAdapter
 
 from nti.app.store.views.view_mixin import price_order
 from nti.app.store.views.view_mixin import PriceOrderViewMixin
+from nti.app.store.views.view_mixin import BatchPricingViewMixin
+from nti.app.store.views.view_mixin import PurchasableListingViewMixin
+from nti.app.store.views.view_mixin import PurchasableCatalogCachingMixin
 
 from nti.appserver.dataserver_pyramid_views import GenericGetView
 
 from nti.dataserver import authorization as nauth
 
-from nti.dataserver.interfaces import IDataserverTransactionRunner
+from nti.externalization.externalization import to_external_object
 
 from nti.externalization.interfaces import LocatedExternalDict
 from nti.externalization.interfaces import StandardExternalFields
@@ -61,20 +74,15 @@ from nti.store import PricingException
 from nti.store.interfaces import IPurchasable
 from nti.store.interfaces import IPricingError
 from nti.store.interfaces import IPurchaseAttempt
-from nti.store.interfaces import IPaymentProcessor
 from nti.store.interfaces import IPurchasablePricer
 
 from nti.store.priceable import create_priceable
 
-from nti.store.purchasable import get_all_purchasables
-
 from nti.store.purchase_history import get_purchase_history
-from nti.store.purchase_history import get_pending_purchases
 from nti.store.purchase_history import get_purchase_history_by_item
 
 from nti.store.store import get_purchase_by_code
 from nti.store.store import get_purchase_attempt
-from nti.store.store import get_gift_pending_purchases
 
 ITEMS = StandardExternalFields.ITEMS
 TOTAL = StandardExternalFields.TOTAL
@@ -87,6 +95,16 @@ logger = __import__('logging').getLogger(__name__)
 # get views
 
 
+def externalize_sparse(objects, request):
+    """
+    Return the specified objects, externalized with only the requested
+    fields when the client asked for a sparse fieldset.
+    """
+    if get_fieldset(request) == (None, None):
+        return objects
+    return [filter_fields(to_external_object(x), request) for x in objects]
+
+
 def _last_modified(purchases=()):
     result = 0
     if purchases:
@@ -165,47 +183,13 @@ class GetPurchaseHistoryView(AbstractAuthenticatedView):
         else:
             purchases = get_purchase_history_by_item(username, purchasable_id)
         result = LocatedExternalDict()
-        result[ITEMS] = purchases
+        enable_fieldset(request)
+        result[ITEMS] = externalize_sparse(purchases, request)
         result[LAST_MODIFIED] = _last_modified(purchases)
         result[TOTAL] = result[ITEM_COUNT] = len(purchases)
         return result
 
 
-def _sync_purchase(purchase, request):
-    purchase_id = purchase.id
-    creator = purchase.creator
-    processor = purchase.Processor
-    site_name = get_current_site()
-    username = getattr(creator, 'username', creator)
-
-    def sync_purchase():
-        manager = component.getUtility(IPaymentProcessor, name=processor)
-        manager.sync_purchase(purchase_id=purchase_id,
-                              username=username,
-                              request=request)
-
-    def process_sync():
-        runner = component.getUtility(IDataserverTransactionRunner)
-        runner(sync_purchase,
-               site_names = (site_name,) if site_name else ())
-
-    gevent.spawn(process_sync)
-
-
-#: Max time in seconds after a purchase is made before a sync process is launched
-SYNC_TIME = 100
-
-
-def _should_sync(purchase, now=None):
-    now = now or time.time()
-    start_time = purchase.StartTime
-    # CS: SYNC_TIME is the [magic] number of seconds elapsed since the purchase
-    # attempt was started. After this time, we try to get the purchase
-    # status by asking its payment processor
-    result = now - start_time >= SYNC_TIME and not purchase.is_synced()
-    return result
-
-
 class BaseGetPurchaseAttemptView(object):
 
     def _do_get(self, purchase_id, username=None):
@@ -243,8 +227,9 @@ class BaseGetPurchaseAttemptView(object):
                             'value': purchase_id
                         },
                         None)
-        elif purchase.is_pending() and _should_sync(purchase):
-            _sync_purchase(purchase, self.request)
+        elif purchase.is_pending() and should_sync(purchase):
+            # synced in the background
+            enqueue_sync(purchase, get_current_site())
 
         # CS: we return the purchase attempt inside a ITEMS collection
         # due to legacy code
@@ -312,27 +297,26 @@ def check_purchasable_access(purchasable, remoteUser=None):
                renderer='rest',
                context=StorePathAdapter,
                request_method='GET')
-class GetPurchasablesView(AbstractAuthenticatedView):
-
-    def _check_access(self, purchasable):
-        result = purchasable.isPublic \
-            and check_purchasable_access(purchasable, self.remoteUser)
-        return result
+class GetPurchasablesView(AbstractAuthenticatedView,
+                          PurchasableListingViewMixin,
+                          PurchasableCatalogCachingMixin):
 
     def __call__(self):
+        not_modified = self.check_not_modified()
+        if not_modified is not None:
+            return not_modified
         values = CaseInsensitiveDict(self.request.params)
         ntiids = values.get("purchasable") or values.get('purchasables')
         if ntiids:
             ntiids = {unquote(x) for x in ntiids.split()}
-
-        purchasables = []
-        for p in get_all_purchasables():
-            if      self._check_access(p) \
-                and (not ntiids or p.NTIID in ntiids):
-                purchasables.append(p)
+        # disabled (non-public) purchasables are not listed
+        criteria = {'public': True}
+        # anonymous users can only see giftable purchasables
+        if self.remoteUser is None:
+            criteria['giftable'] = True
         result = LocatedExternalDict()
-        result[ITEMS] = purchasables
-        result[TOTAL] = result[ITEM_COUNT] = len(purchasables)
+        result.lastModified = result[LAST_MODIFIED] = self.catalog_last_modified
+        self.do_listing(result, ntiids or None, **criteria)
         return result
 
 
@@ -369,8 +353,9 @@ class PurchaseAttemptGetView(GenericGetView):
         purchase = super(PurchaseAttemptGetView, self).__call__()
         if not check_purchase_attempt_access(purchase, username):
             raise hexc.HTTPForbidden()
-        if purchase.is_pending() and _should_sync(purchase):
-            _sync_purchase(purchase, self.request)
+        if purchase.is_pending() and should_sync(purchase):
+            # synced in the background
+            enqueue_sync(purchase, get_current_site())
         return purchase
 
 
@@ -389,11 +374,14 @@ def _call_pricing_func(func):
     return result
 
 
-def perform_pricing(purchasable, quantity):
-    pricer = component.getUtility(IPurchasablePricer)
-    priceable = create_priceable(ntiid=purchasable, quantity=quantity)
-    result = pricer.price(priceable)
-    return result
+def perform_pricing(purchasable, quantity, pricer=None):
+    def _price():
+        the_pricer = pricer
+        if the_pricer is None:
+            the_pricer = component.getUtility(IPurchasablePricer)
+        priceable = create_priceable(ntiid=purchasable, quantity=quantity)
+        return the_pricer.price(priceable)
+    return cached_pricing(_price, u'', ((purchasable, quantity, None),))
 
 
 @view_config(name="PricePurchasable")
@@ -444,6 +432,26 @@ class PricePurchasableView(AbstractPostView):
         return result
 
 
+@view_config(name="PricePurchasables")
+@view_config(name="price_purchasables")
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               context=StorePathAdapter,
+               request_method='POST')
+class PricePurchasablesView(AbstractAuthenticatedView, BatchPricingViewMixin):
+
+    @Lazy
+    def pricer(self):
+        return component.getUtility(IPurchasablePricer)
+
+    def price_entry(self, ntiid, quantity, unused_coupon=None):
+        pricing_func = partial(perform_pricing,
+                               pricer=self.pricer,
+                               quantity=quantity,
+                               purchasable=ntiid)
+        return _call_pricing_func(pricing_func)
+
+
 @view_config(name="PriceOrder")
 @view_config(name="price_order")
 @view_defaults(route_name='objects.generic.traversal',
@@ -41,6 +41,9 @@ from nti.app.store import MessageFactory as _
 
 from nti.app.store.views import PurchasablesPathAdapter
 
+from nti.app.store.views.view_mixin import PurchasableListingViewMixin
+from nti.app.store.views.view_mixin import PurchasableCatalogCachingMixin
+
 from nti.appserver.policies.interfaces import ISitePolicyUserEventListener
 
 from nti.base.interfaces import DEFAULT_CONTENT_TYPE
@@ -74,7 +77,6 @@ from nti.store.interfaces import IPurchasable
 from nti.store.interfaces import IPurchaseAttempt
 
 from nti.store.store import get_purchasable
-from nti.store.store import get_purchasables
 from nti.store.store import remove_purchasable
 from nti.store.store import register_purchasable
 
@@ -84,9 +86,9 @@ from nti.zodb.containers import time_to_64bit_int
 
 ITEMS = StandardExternalFields.ITEMS
 NTIID = StandardExternalFields.NTIID
-TOTAL = StandardExternalFields.TOTAL
 MIMETYPE = StandardExternalFields.MIMETYPE
 ITEM_COUNT = StandardExternalFields.ITEM_COUNT
+LAST_MODIFIED = StandardExternalFields.LAST_MODIFIED
 
 logger = __import__('logging').getLogger(__name__)
 
@@ -352,10 +354,15 @@ class PurchasablePurchasesView(AbstractAuthenticatedView,
                request_method='GET',
                permission=nauth.ACT_CONTENT_EDIT,
                renderer='rest')
-class AllPurchasablesView(AbstractAuthenticatedView):
+class AllPurchasablesView(AbstractAuthenticatedView,
+                          PurchasableListingViewMixin,
+                          PurchasableCatalogCachingMixin):
 
     def __call__(self):
+        not_modified = self.check_not_modified()
+        if not_modified is not None:
+            return not_modified
         result = LocatedExternalDict()
-        items = result[ITEMS] = get_purchasables()
-        result[ITEM_COUNT] = result[TOTAL] = len(items)
+        result.lastModified = result[LAST_MODIFIED] = self.catalog_last_modified
+        self.do_listing(result)
         return result
@@ -8,10 +8,6 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
-import json
-import urllib
-import urllib2
-
 from uuid import uuid4
 
 import requests
@@ -36,6 +32,7 @@ from zope import component
 
 from zope.cachedescriptors.property import Lazy
 
+from nti.app.base.abstract_views import AbstractView
 from nti.app.base.abstract_views import AbstractAuthenticatedView
 
 from nti.app.externalization.error import raise_json_error as raise_error
@@ -45,12 +42,50 @@ from nti.app.store import STRIPE_CONNECT_AUTH
 from nti.app.store import STRIPE_CONNECT_REDIRECT
 from nti.app.store import DEFAULT_STRIPE_KEY_ALIAS
 
+from nti.app.store.breaker import REFUND
+from nti.app.store.breaker import ACCOUNT
+from nti.app.store.breaker import CREATE_TOKEN
+from nti.app.store.breaker import VALIDATE_COUPON
+
+from nti.app.store.breaker import CircuitOpen
+from nti.app.store.breaker import LatencyBudgetExceeded
+
+from nti.app.store.breaker import call_with_breaker
+
+from nti.app.store.cards import InvalidCard
+
+from nti.app.store.cards import validate_card
+
+from nti.app.store.catalog import get_gift_pending_purchases
+
+from nti.app.store.connect_keys import resolve_connect_key
+from nti.app.store.connect_keys import invalidate_connect_keys
+
+from nti.app.store.coupons import is_missing_coupon
+from nti.app.store.coupons import record_missing_coupon
+from nti.app.store.coupons import validate_coupon as validate_local_coupon
+
+from nti.app.store.http_client import http_request
+
+from nti.app.store.journal import start_purchase_job
+from nti.app.store.journal import record_purchase_job
+from nti.app.store.journal import complete_purchase_job
+
 from nti.app.store.license_utils import can_integrate
 
+from nti.app.store.pricing import cached_pricing
+
+from nti.app.store.processing import DEFAULT_RETRY_AFTER
+
+from nti.app.store.processing import ProcessingPoolFull
+
+from nti.app.store.processing import get_processing_pool
+
 from nti.app.store.utils import to_boolean
 from nti.app.store.utils import is_valid_pve_int
 from nti.app.store.utils import is_valid_boolean
 from nti.app.store.utils import AbstractPostView
+from nti.app.store.utils import raise_retry_later
 
 from nti.app.store.views import get_current_site
 from nti.app.store.views import StorePathAdapter
@@ -58,6 +93,7 @@ from nti.app.store.views import StripePathAdapter
 
 from nti.app.store.views.view_mixin import PriceOrderViewMixin
 from nti.app.store.views.view_mixin import BasePaymentViewMixin
+from nti.app.store.views.view_mixin import BatchPricingViewMixin
 from nti.app.store.views.view_mixin import BaseProcessorViewMixin
 from nti.app.store.views.view_mixin import GiftPreflightViewMixin
 from nti.app.store.views.view_mixin import RefundPaymentViewMixin
@@ -66,6 +102,10 @@ from nti.app.store.views.view_mixin import GeneratePurchaseInvoiceViewMixin
 
 from nti.app.store.views.view_mixin import price_order
 
+from nti.app.store.webhooks import construct_event
+from nti.app.store.webhooks import get_webhook_secret
+from nti.app.store.webhooks import handle_stripe_event
+
 from nti.base._compat import text_
 
 from nti.common.interfaces import IOAuthKeys
@@ -108,7 +148,7 @@ from nti.store.payments.stripe.stripe_purchase import create_stripe_purchase_ord
 
 from nti.store.payments.stripe.utils import replace_items_coupon
 
-from nti.store.store import get_gift_pending_purchases
+from nti.store.store import get_purchasable
 from nti.store.store import create_gift_purchase_attempt
 from nti.store.store import register_gift_purchase_attempt
 
@@ -116,6 +156,7 @@ from nti.traversal.traversal import find_interface
 from nti.traversal.traversal import normal_resource_path
 
 ITEMS = StandardExternalFields.ITEMS
+ITEM_COUNT = StandardExternalFields.ITEM_COUNT
 LAST_MODIFIED = StandardExternalFields.LAST_MODIFIED
 _REQUEST_TIMEOUT = 1.0
 
@@ -206,13 +247,52 @@ class PriceOrderView(PriceStripeOrderView):
     pass
 
 
-def perform_pricing(purchasable_id, quantity=None, coupon=None):
-    pricer = component.getUtility(IPurchasablePricer, name=STRIPE)
-    priceable = create_stripe_priceable(ntiid=purchasable_id,
-                                        quantity=quantity,
-                                        coupon=coupon)
-    result = pricer.price(priceable)
-    return result
+def call_stripe(request, operation, api_key, func, *args, **kwargs):
+    """
+    Call Stripe through the circuit breaker of the specified operation and
+    connect key. Calls rejected by an open breaker or that exceed the
+    operation latency budget fail fast with a 503 and a retry hint.
+    """
+    try:
+        return call_with_breaker(operation, api_key, func, *args, **kwargs)
+    except CircuitOpen as e:
+        raise_retry_later(request,
+                          _(u"The payment service is unavailable. Please try again later."),
+                          e.retry_after,
+                          code=e.__class__.__name__)
+    except LatencyBudgetExceeded as e:
+        logger.warn("Stripe %s call exceeded its latency budget", operation)
+        raise_retry_later(request,
+                          _(u"The payment service is not responding. Please try again later."),
+                          DEFAULT_RETRY_AFTER,
+                          code=e.__class__.__name__)
+
+
+def _get_private_key(purchasable_id):
+    purchasable = get_purchasable(purchasable_id)
+    provider = getattr(purchasable, 'Provider', None)
+    stripe_key = resolve_connect_key(provider)
+    return getattr(stripe_key, 'PrivateKey', None)
+
+
+def perform_pricing(purchasable_id, quantity=None, coupon=None, pricer=None):
+    def _price():
+        api_key = _get_private_key(purchasable_id) if coupon else None
+        if api_key and is_missing_coupon(coupon, api_key):
+            raise NoSuchStripeCoupon()
+        the_pricer = pricer
+        if the_pricer is None:
+            the_pricer = component.getUtility(IPurchasablePricer, name=STRIPE)
+        priceable = create_stripe_priceable(ntiid=purchasable_id,
+                                            quantity=quantity,
+                                            coupon=coupon)
+        try:
+            return the_pricer.price(priceable)
+        except NoSuchStripeCoupon:
+            if api_key:
+                record_missing_coupon(coupon, api_key)
+            raise
+    return cached_pricing(_price, STRIPE, ((purchasable_id, quantity, coupon),))
 
 
 @view_config(name="PricePurchasableWithStripeCoupon")
@@ -270,9 +350,63 @@ class PricePurchasableView(PricePurchasableWithStripeCouponView):
     pass
 
 
+@view_config(name="PricePurchasablesWithStripeCoupon")
+@view_config(name="price_purchasables_with_stripe_coupon")
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               context=StorePathAdapter,
+               request_method='POST')
+class PricePurchasablesWithStripeCouponView(AbstractAuthenticatedView,
+                                            BaseStripeViewMixin,
+                                            BatchPricingViewMixin):
+
+    @Lazy
+    def pricer(self):
+        return component.getUtility(IPurchasablePricer, name=STRIPE)
+
+    @Lazy
+    def _invalid_coupons(self):
+        return set()
+
+    def _coupon_key(self, ntiid, coupon):
+        # coupons belong to the connect key of the purchasable provider
+        purchasable = get_purchasable(ntiid)
+        return (getattr(purchasable, 'Provider', None), coupon)
+
+    def _price(self, ntiid, quantity, coupon):
+        try:
+            return perform_pricing(ntiid,
+                                   quantity=quantity,
+                                   coupon=coupon,
+                                   pricer=self.pricer)
+        except (NoSuchStripeCoupon, InvalidStripeCoupon):
+            # don't try to resolve the same coupon again
+            self._invalid_coupons.add(self._coupon_key(ntiid, coupon))
+            raise
+
+    def price_entry(self, ntiid, quantity, coupon):
+        if self._coupon_key(ntiid, coupon) in self._invalid_coupons:
+            return IPricingError(_(u"Invalid coupon."))
+        return _call_pricing_func(partial(self._price, ntiid, quantity, coupon))
+
+
+@view_config(name="PricePurchasables")
+@view_config(name="price_purchasables")
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               context=StripePathAdapter,
+               request_method='POST')
+class PricePurchasablesView(PricePurchasablesWithStripeCouponView):
+    pass
+
+
 # token views
 
 
+#: Request fields of the card fields
+_CARD_FIELDS = {'number': 'cc', 'cvc': 'cvv', 'expiry': 'card_expiry'}
+
+
 @view_config(name="CreateStripeToken")
 @view_config(name="create_stripe_token")
 @view_defaults(route_name='objects.generic.traversal',
@@ -310,10 +444,27 @@ class CreateStripeTokenView(AbstractPostView, BaseStripeViewMixin):
                                 },
                                 None)
                 params[k] = text_(value)
-            expiry = params.pop('card_expiry', u'')
-            index = 2 if len(expiry) >= 4 else 1
-            params['exp_year'] = expiry[index:]
-            params['exp_month'] = expiry[0:index]
+            # fail malformed cards without a Stripe round trip
+            try:
+                card = validate_card(params.pop('number'),
+                                     params.pop('cvc'),
+                                     params.pop('card_expiry'))
+            except InvalidCard as e:
+                errors = [
+                    {'field': _CARD_FIELDS[f], 'message': m, 'code': c}
+                    for f, m, c in e.errors
+                ]
+                raise_error(self.request,
+                            hexc.HTTPUnprocessableEntity,
+                            {
+                                'message': errors[0]['message'],
+                                'field': errors[0]['field'],
+                                'code': errors[0]['code'],
+                                'errors': errors
+                            },
+                            None)
+            card.pop('brand', None)
+            params.update(card)
         else:
             params['customer_id'] = customer_id
 
@@ -329,7 +480,11 @@ class CreateStripeTokenView(AbstractPostView, BaseStripeViewMixin):
             if value:
                 params[k] = text_(value)
 
-        token = manager.create_token(**params)
+        token = call_stripe(self.request,
+                            CREATE_TOKEN,
+                            stripe_key.PrivateKey,
+                            manager.create_token,
+                            **params)
         result = StripeToken(Value=token.id,
                              Type=token.card.brand,
                              CardID=token.card.id)
@@ -362,10 +517,19 @@ def process_purchase(manager, purchase_id, username, token, expected_amount,
                              expected_amount=expected_amount,)
 
 
+def process_journaled_purchase(purchase_id, **kwargs):
+    # a replay may have claimed the job while it was queued
+    if not start_purchase_job(purchase_id):
+        return
+    process_purchase(purchase_id=purchase_id, **kwargs)
+    # processed, otherwise it is replayed if still pending
+    complete_purchase_job(purchase_id)
+
+
 def addAfterCommitHook(manager, purchase_id, username, token, expected_amount,
                        stripe_key, request, site_name=None):
 
-    processor = partial(process_purchase,
+    processor = partial(process_journaled_purchase,
                         token=token,
                         request=request,
                         manager=manager,
@@ -375,15 +539,41 @@ def addAfterCommitHook(manager, purchase_id, username, token, expected_amount,
                         purchase_id=purchase_id,
                         expected_amount=expected_amount)
 
-    def hook(s): return s and request.nti_gevent_spawn(processor)
+    def hook(s):
+        if s:
+            pool = get_processing_pool()
+            try:
+                pool.submit(processor, spawn=request.nti_gevent_spawn)
+            except ProcessingPoolFull:
+                # the journal replays it once its lease expires
+                logger.warn("Purchase processing pool is full. Purchase %s deferred",
+                            purchase_id)
     transaction.get().addAfterCommitHook(hook)
 
 
+def check_processing_pool(request):
+    """
+    Reject new purchases while the processing pool is full.
+    """
+    pool = get_processing_pool()
+    if not pool.accepting():
+        logger.warn("Purchase processing pool is full "
+                    "(%s queued, %s in flight, %s workers)",
+                    pool.queued, pool.in_flight, pool.workers)
+        raise_retry_later(request,
+                          _(u"Too many purchases are being processed. Please try again later."),
+                          getattr(pool, 'retry_after', DEFAULT_RETRY_AFTER))
+
+
 def validate_coupon(request, coupon, api_key):
     if coupon:
         manager = component.getUtility(IPaymentProcessor, name=STRIPE)
+        remote = partial(call_with_breaker,
+                         VALIDATE_COUPON,
+                         api_key,
+                         manager.validate_coupon)
         try:
-            if not manager.validate_coupon(coupon, api_key):
+            if not validate_local_coupon(coupon, api_key, remote):
                 raise_error(request,
                             hexc.HTTPUnprocessableEntity,
                             {
@@ -391,8 +581,22 @@ def validate_coupon(request, coupon, api_key):
                                 'field': u'coupon'
                             },
                             None)
+        except CircuitOpen as e:
+            raise_retry_later(request,
+                              _(u"Cannot validate coupon. Please try again later."),
+                              e.retry_after,
+                              field=u'coupon',
+                              code=e.__class__.__name__)
+        except LatencyBudgetExceeded as e:
+            raise_retry_later(request,
+                              _(u"Cannot validate coupon. Please try again later."),
+                              DEFAULT_RETRY_AFTER,
+                              field=u'coupon',
+                              code=e.__class__.__name__)
         except StandardError as e:
             exc_info = sys.exc_info()
+            if isinstance(e, NoSuchStripeCoupon):
+                record_missing_coupon(coupon, api_key)
             raise_error(request,
                         hexc.HTTPUnprocessableEntity,
                         {
@@ -408,7 +612,7 @@ def validate_stripe_key(request, purchasables=()):
     result = None
     for purchasable in purchasables or ():
         provider = purchasable.Provider
-        stripe_key = component.queryUtility(IStripeConnectKey, provider)
+        stripe_key = resolve_connect_key(provider, request=request)
         if stripe_key is None:
             raise_error(request,
                         hexc.HTTPUnprocessableEntity,
@@ -465,6 +669,7 @@ class BasePaymentWithStripeView(BasePaymentViewMixin):
         return result
 
     def processPurchase(self, purchase_attempt, record):
+        check_processing_pool(self.request)
         purchase_id = self.registerPurchaseAttempt(purchase_attempt, record)
         logger.info("Purchase attempt (%s) created", purchase_id)
 
@@ -477,6 +682,14 @@ class BasePaymentWithStripeView(BasePaymentViewMixin):
         site_name = get_current_site()
         manager = component.getUtility(IPaymentProcessor, name=self.processor)
 
+        # journal the purchase in this transaction in case it's not
+        # processed after commit
+        record_purchase_job(purchase_id, username, self.processor,
+                            site_name=site_name,
+                            provider=getattr(stripe_key, 'Alias', None),
+                            token=token,
+                            expected_amount=expected_amount)
+
         # process purchase after commit
         addAfterCommitHook(token=token,
                            request=request,
@@ -617,8 +830,17 @@ class GiftWithStripeView(GiftWithStripePreflightView,
     def username(self):
         return None
 
+    def idempotencyOwner(self, values):
+        return self.request.authenticated_userid \
+            or values.get('from') \
+            or values.get('sender') \
+            or values.get('creator')
+
     def __call__(self):
         values = self.readInput()
+        result = self.checkIdempotencyKey(values)
+        if result is not None:
+            return result
         record = self.getPaymentRecord(self.request, values)
         purchase_attempt = self.createPurchaseAttempt(record)
 
@@ -634,6 +856,7 @@ class GiftWithStripeView(GiftWithStripePreflightView,
                 LAST_MODIFIED: lastModified
             })
         result = self.processPurchase(purchase_attempt, record)
+        self.recordIdempotencyKey(values, purchase_attempt)
         return result
 
 
@@ -718,11 +941,18 @@ class RefundPaymentWithStripeView(AbstractPostView,
     def __call__(self):
         request = self.request
         purchase, amount, refund_application_fee = self.processInput()
+        api_key = _get_private_key(next(iter(purchase.Items or ()), None))
         try:
-            refund_purchase(purchase,
-                            amount=amount,
-                            refund_application_fee=refund_application_fee,
-                            request=request)
+            call_stripe(request,
+                        REFUND,
+                        api_key,
+                        refund_purchase,
+                        purchase,
+                        amount=amount,
+                        refund_application_fee=refund_application_fee,
+                        request=request)
+        except hexc.HTTPServiceUnavailable:
+            raise
         except Exception as e:
             logger.exception("Error while refunding transaction")
             exc_info = sys.exc_info()
@@ -752,6 +982,47 @@ class RefundPaymentView(RefundPaymentWithStripeView):
     pass
 
 
+# webhook
+
+
+@view_config(name="Webhook")
+@view_config(name="webhook")
+@view_defaults(route_name='objects.generic.traversal',
+               renderer='rest',
+               context=StripePathAdapter,
+               request_method='POST')
+class StripeWebhookView(AbstractView):
+    """
+    Receives the signed Stripe (connect) events and applies the charge
+    events to their purchase attempts.
+    """
+
+    def __call__(self):
+        secret = get_webhook_secret()
+        if secret is None:
+            raise hexc.HTTPNotFound()
+        signature = self.request.headers.get('Stripe-Signature')
+        try:
+            event = construct_event(text_(self.request.body),
+                                    signature,
+                                    secret)
+        except (ValueError, stripe.error.SignatureVerificationError) as e:
+            logger.warning("Invalid stripe event (%s)", e)
+            raise_error(self.request,
+                        hexc.HTTPBadRequest,
+                        {
+                            'message': _(u"Invalid event."),
+                            'code': e.__class__.__name__
+                        },
+                        None)
+        purchases = handle_stripe_event(event, self.request)
+        result = LocatedExternalDict()
+        result['Type'] = event.type
+        result[ITEMS] = [x.id for x in purchases]
+        result[ITEM_COUNT] = len(purchases)
+        return result
+
+
 def url_with_params(url, params):
     url_parts = list(urllib_parse.urlparse(url))
     query = dict(urllib_parse.parse_qsl(url_parts[4]))
@@ -817,7 +1088,8 @@ class StripeConnectAuthorization(StripeConnectViewMixin, AbstractAuthenticatedVi
 
     @Lazy
     def _stripe_connect_key(self):
-        return component.queryUtility(IStripeConnectKey, name=DEFAULT_STRIPE_KEY_ALIAS)
+        return resolve_connect_key(DEFAULT_STRIPE_KEY_ALIAS,
+                                   request=self.request)
 
     def _stripe_redirect_uri(self):
         path = normal_resource_path(get_stripe_key_container())
@@ -887,15 +1159,15 @@ class ConnectStripeAccount(StripeConnectViewMixin, AbstractAuthenticatedView):
 
     def retrieve_keys(self, code):
         try:
-            data = urllib.urlencode({'client_secret': self.nti_client_secret})
+            data = {'client_secret': self.nti_client_secret}
             url = url_with_params(self.stripe_conf.TokenEndpoint,
                                   {
                                       'grant_type': 'authorization_code',
                                       'code': code
                                   })
-            response = urllib2.urlopen(url, data)
+            response = http_request('POST', url, data=data)
 
-            response_code = response.getcode()
+            response_code = response.status_code
 
             if response_code < 200 or response_code >= 300:
                 return self.error_response()
@@ -909,10 +1181,11 @@ class ConnectStripeAccount(StripeConnectViewMixin, AbstractAuthenticatedView):
 
     def _add_key(self, connect_key):
         self.context.add_key(connect_key)
+        invalidate_connect_keys(self.request)
 
     def persist_data(self, response):
         try:
-            result = json.load(response)
+            result = response.json()
             connect_key = PersistentStripeConnectKey(
                 Alias=DEFAULT_STRIPE_KEY_ALIAS,
                 StripeUserID=self._text(result['stripe_user_id']),
@@ -985,8 +1258,12 @@ class DisconnectStripeAccount(StripeConnectViewMixin, AbstractAuthenticatedView)
         # the account has already been deauthorized
         try:
             client_user_id = client_user_id or self.nti_client_secret
-            stripe.Account.retrieve(stripe_user_id,
-                                    api_key=client_user_id)
+            call_stripe(self.request,
+                        ACCOUNT,
+                        client_user_id,
+                        stripe.Account.retrieve,
+                        stripe_user_id,
+                        api_key=client_user_id)
             return True
         except stripe.error.PermissionError as e:
             return False
@@ -996,10 +1273,11 @@ class DisconnectStripeAccount(StripeConnectViewMixin, AbstractAuthenticatedView)
             'client_id': self.nti_client_id,
             'stripe_user_id': user_key.StripeUserID
         }
-        deauth = requests.post(self._deauth_uri,
-                               data=data,
-                               timeout=_REQUEST_TIMEOUT,
-                               auth=(self.nti_client_secret,''))
+        deauth = http_request('POST',
+                              self._deauth_uri,
+                              data=data,
+                              timeout=_REQUEST_TIMEOUT,
+                              auth=(self.nti_client_secret, ''))
 
         try:
             deauth.raise_for_status()
@@ -1019,6 +1297,7 @@ class DisconnectStripeAccount(StripeConnectViewMixin, AbstractAuthenticatedView)
         if not is_true(self.request.params.get('skip_deauth')):
             self._deauth_stripe(self.context)
         container.remove_key(DEFAULT_STRIPE_KEY_ALIAS)
+        invalidate_connect_keys(self.request)
         return hexc.HTTPNoContent()
 
 
@@ -1033,4 +1312,8 @@ class ViewAccount(AbstractAuthenticatedView,
 
     def __call__(self):
         connect_key = super(ViewAccount, self).__call__()
-        return IStripeAccountInfo(connect_key)
+        return call_stripe(self.request,
+                           ACCOUNT,
+                           connect_key.PrivateKey,
+                           IStripeAccountInfo,
+                           connect_key)
@@ -10,6 +10,7 @@ from __future__ import absolute_import
 
 import six
 import sys
+import hashlib
 from datetime import date
 from datetime import datetime
 
@@ -17,48 +18,82 @@ from requests.structures import CaseInsensitiveDict
 
 from zope import component
 
+from zope.cachedescriptors.property import Lazy
+
+from zope.component.hooks import getSite
+
 from zope.event import notify
 
 from pyramid import httpexceptions as hexc
 
 from nti.app.externalization.error import raise_json_error as raise_error
 
+from nti.app.externalization.view_mixins import BatchingUtilsMixin
 from nti.app.externalization.view_mixins import ModeledContentUploadRequestUtilsMixin
 
 from nti.app.store import MessageFactory as _
 
+from nti.app.store import SITE_CONTEXT_KEY
+
+from nti.app.store.catalog import get_pending_purchases
+from nti.app.store.catalog import get_gift_pending_purchases
+
+from nti.app.store.connect_keys import resolve_connect_key
+
+from nti.app.store.decorators import get_user_purchase_state
+
+from nti.app.store.externalization import externalize_purchasable
+from nti.app.store.externalization import externalize_vendor_info
+
+from nti.app.store.idempotency import MAX_KEY_LENGTH
+from nti.app.store.idempotency import IDEMPOTENCY_KEY_HEADER
+
+from nti.app.store.idempotency import scoped_key
+from nti.app.store.idempotency import fingerprint
+from nti.app.store.idempotency import get_idempotency_key
+from nti.app.store.idempotency import get_idempotency_store
+from nti.app.store.idempotency import queue_idempotency_purge
+
+from nti.app.store.index import SORT_KEYS
+
+from nti.app.store.index import query_purchasables
+from nti.app.store.index import get_catalog_generation
+
+from nti.app.store.pricing import cached_pricing
+from nti.app.store.pricing import resolve_purchasable
+
+from nti.app.store.utils import to_boolean
 from nti.app.store.utils import is_valid_amount
+from nti.app.store.utils import enable_fieldset
 from nti.app.store.utils import is_valid_pve_int
 
 from nti.common.string import is_true
 
 from nti.dataserver.users.interfaces import checkEmailAddress
 
-from nti.externalization.externalization import to_external_object
-
 from nti.externalization.interfaces import LocatedExternalDict
 from nti.externalization.interfaces import StandardExternalFields
 
 from nti.externalization.internalization import find_factory_for
 from nti.externalization.internalization import update_from_external_object
 
+from nti.store.interfaces import IPricingError
 from nti.store.interfaces import IPurchaseOrder
 from nti.store.interfaces import IPaymentProcessor
 from nti.store.interfaces import IPurchasablePricer
 from nti.store.interfaces import IPurchasableChoiceBundle
 from nti.store.interfaces import PurchaseAttemptSuccessful
 
-from nti.store.store import get_purchasable
 from nti.store.store import get_purchase_attempt
 from nti.store.store import get_purchase_by_code
-from nti.store.store import get_pending_purchases
 from nti.store.store import create_purchase_attempt
 from nti.store.store import register_purchase_attempt
-from nti.store.store import get_gift_pending_purchases
 from nti.store.store import create_gift_purchase_attempt
 from nti.store.store import register_gift_purchase_attempt
 
 ITEMS = StandardExternalFields.ITEMS
+TOTAL = StandardExternalFields.TOTAL
+ITEM_COUNT = StandardExternalFields.ITEM_COUNT
 LAST_MODIFIED = StandardExternalFields.LAST_MODIFIED
 
 logger = __import__('logging').getLogger(__name__)
@@ -73,7 +108,9 @@ class BaseProcessorViewMixin(object):
         params = params or self.request.params
         keyname = CaseInsensitiveDict(params).get('provider')
         if keyname: # check key
-            return component.queryUtility(self.key_interface, keyname)
+            return resolve_connect_key(keyname,
+                                       self.key_interface,
+                                       self.request)
         return None
 
 
@@ -86,13 +123,137 @@ class GetProcesorConnectKeyViewMixin(BaseProcessorViewMixin):
         return result
 
 
+class PurchasableCatalogCachingMixin(object):
+    """
+    Emits strong ETag and Last-Modified headers for purchasable listings
+    from the site catalog generation, and answers 304 when the client copy
+    is current without externalizing anything.
+    """
+
+    @Lazy
+    def _catalog_generation(self):
+        return get_catalog_generation()
+
+    @property
+    def catalog_last_modified(self):
+        return self._catalog_generation[1]
+
+    def _catalog_etag(self):
+        request = self.request
+        remote_user = getattr(self, 'remoteUser', None)
+        username = getattr(remote_user, 'username', None)
+        # activation flags and history links depend on the state of the
+        # user purchases, which does not change the history lastModified
+        activated, history = (), ()
+        if username:
+            activated, history = get_user_purchase_state(username, request)
+        parts = (getattr(getSite(), '__name__', None),
+                 request.view_name,
+                 self._catalog_generation[0],
+                 username,
+                 sorted(activated),
+                 sorted(history),
+                 sorted(request.params.items()))
+        return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+
+    def check_not_modified(self):
+        """
+        Set the caching headers in the response. Return a 304 response if
+        the client copy is current, ``None`` otherwise.
+        """
+        etag = self._catalog_etag()
+        last_modified = self.catalog_last_modified
+        response = self.request.response
+        response.etag = etag
+        if last_modified:
+            response.last_modified = last_modified
+        if etag in self.request.if_none_match:
+            result = hexc.HTTPNotModified()
+            result.etag = etag
+            if last_modified:
+                result.last_modified = last_modified
+            return result
+        return None
+
+
+class PurchasableListingViewMixin(BatchingUtilsMixin):
+    """
+    Lists the indexed purchasables filtered by the request parameters
+    (provider, currency, giftable, redeemable and public), sorted on a
+    precomputed key (``sortOn`` / ``sortOrder``) and batched
+    (``batchStart`` / ``batchSize``). Only the purchasables in the
+    requested batch are resolved.
+    """
+
+    _DEFAULT_BATCH_SIZE = None
+    _DEFAULT_BATCH_START = None
+
+    #: Boolean listing filters
+    BOOLEAN_FILTERS = ('giftable', 'redeemable', 'public')
+
+    #: Value listing filters
+    VALUE_FILTERS = ('provider', 'currency')
+
+    def get_listing_criteria(self, values):
+        result = dict()
+        for name in self.BOOLEAN_FILTERS:
+            value = values.get(name)
+            if value is not None and to_boolean(value) is not None:
+                result[name] = to_boolean(value)
+        for name in self.VALUE_FILTERS:
+            value = values.get(name)
+            if value:
+                result[name] = value.replace(',', ' ').split()
+        return result
+
+    def get_listing_sort(self, values):
+        sort_on = values.get('sortOn')
+        if sort_on and sort_on not in SORT_KEYS:
+            raise_error(self.request,
+                        hexc.HTTPUnprocessableEntity,
+                        {
+                            'message': _(u"Invalid sort key."),
+                            'field': 'sortOn',
+                            'value': sort_on
+                        },
+                        None)
+        sort_order = values.get('sortOrder') or 'ascending'
+        return sort_on or None, sort_order.lower().startswith('desc')
+
+    def do_listing(self, result, ntiids=None, **criteria):
+        """
+        Fill the specified result with the requested batch. The given
+        criteria take precedence over the request filters.
+        """
+        enable_fieldset(self.request)
+        values = CaseInsensitiveDict(self.request.params)
+        query = self.get_listing_criteria(values)
+        query.update(criteria)
+        sort_on, reverse = self.get_listing_sort(values)
+        entries = query_purchasables(ntiids,
+                                     sort_on=sort_on,
+                                     reverse=reverse,
+                                     **query)
+        result[TOTAL] = result['TotalItemCount'] = len(entries)
+        request = self.request
+        self._batch_items_iterable(
+            result, entries,
+            selector=lambda x: externalize_purchasable(x[1].get(x[0]), request))
+        result[ITEM_COUNT] = len(result[ITEMS])
+        return result
+
+
 # pricing no-auth/permission views
 
 
 def price_order(order, processor):
-    pricer = component.getUtility(IPurchasablePricer, name=processor)
-    result = pricer.evaluate(order)
-    return result
+    def _price():
+        pricer = component.getUtility(IPurchasablePricer, name=processor)
+        return pricer.evaluate(order)
+    entries = [(item.NTIID, item.Quantity, getattr(item, 'Coupon', None))
+               for item in order.Items or ()]
+    return cached_pricing(_price, processor, entries,
+                          getattr(order, 'Coupon', None))
 
 
 class PriceOrderViewMixin(ModeledContentUploadRequestUtilsMixin):
@@ -109,6 +270,87 @@ class PriceOrderViewMixin(ModeledContentUploadRequestUtilsMixin):
         return result
 
 
+class BatchPricingViewMixin(ModeledContentUploadRequestUtilsMixin):
+    """
+    Mixin for views that price the list of ``{ntiid, quantity, coupon}``
+    entries posted in ``Items``. Each distinct entry is priced once and
+    the results (or pricing errors) are returned in input order.
+    """
+
+    #: Max number of entries that can be priced in one request
+    MAX_PRICING_ENTRIES = 100
+
+    def price_entry(self, ntiid, quantity, coupon):
+        raise NotImplementedError()
+
+    def read_pricing_entries(self):
+        values = CaseInsensitiveDict(self.readInput())
+        entries = values.get(ITEMS) or values.get('purchasables')
+        if not isinstance(entries, (list, tuple)) or not entries:
+            raise_error(self.request,
+                        hexc.HTTPUnprocessableEntity,
+                        {
+                            'message': _(u"Must provide a list of purchasables to price."),
+                            'field': ITEMS
+                        },
+                        None)
+        if len(entries) > self.MAX_PRICING_ENTRIES:
+            raise_error(self.request,
+                        hexc.HTTPUnprocessableEntity,
+                        {
+                            'message': _(u"Too many purchasables to price."),
+                            'field': ITEMS
+                        },
+                        None)
+        return entries
+
+    def parse_pricing_entry(self, entry):
+        """
+        Return the (ntiid, quantity, coupon) of the specified entry or a
+        pricing error if it is not valid.
+        """
+        if isinstance(entry, six.string_types):
+            entry = {'ntiid': entry}
+        if not isinstance(entry, dict):
+            return IPricingError(_(u"Invalid purchasable."))
+        entry = CaseInsensitiveDict(entry)
+        ntiid = entry.get('ntiid') \
+             or entry.get('purchasable') \
+             or entry.get('purchasableId')
+        if not ntiid or not isinstance(ntiid, six.string_types):
+            return IPricingError(_(u"Invalid purchasable."))
+        quantity = entry.get('quantity', 1)
+        if not is_valid_pve_int(quantity):
+            return IPricingError(_(u"Invalid quantity."))
+        coupon = entry.get('coupon') \
+              or entry.get('code') \
+              or entry.get('couponCode')
+        return ntiid, int(quantity), coupon or None
+
+    def price_entries(self, entries):
+        result = LocatedExternalDict()
+        result.__name__ = self.request.view_name
+        result.__parent__ = self.request.context
+        items = result[ITEMS] = []
+        priced = {}
+        for entry in entries:
+            key = self.parse_pricing_entry(entry)
+            if IPricingError.providedBy(key):
+                items.append(key)
+                continue
+            if key not in priced:
+                if resolve_purchasable(key[0], self.request) is None:
+                    priced[key] = IPricingError(_(u"Invalid purchasable."))
+                else:
+                    priced[key] = self.price_entry(*key)
+            items.append(priced[key])
+        result[ITEM_COUNT] = len(items)
+        return result
+
+    def __call__(self):
+        return self.price_entries(self.read_pricing_entries())
+
+
 # purchase views
 
 
@@ -126,8 +368,8 @@ class BasePaymentViewMixin(ModeledContentUploadRequestUtilsMixin):
         context = dict()
         for purchasable in purchasables:
             context['Purchasable'] = purchasable.NTIID  # pick last
-            if purchasable.VendorInfo:
-                vendor = to_external_object(purchasable.VendorInfo)
+            vendor = externalize_vendor_info(purchasable)
+            if vendor:
                 context.update(vendor)
 
         # capture user context data
@@ -137,10 +379,18 @@ class BasePaymentViewMixin(ModeledContentUploadRequestUtilsMixin):
             value = data.get(alias) if value is None else value
             if value is not None:
                 context[name] = klass(value)
+        context[SITE_CONTEXT_KEY] = getattr(getSite(), '__name__', None)
         return context
 
+    def getPurchasable(self, purchasable_id):
+        """
+        Return the purchasable with the specified NTIID. Each NTIID is
+        resolved once per request.
+        """
+        return resolve_purchasable(purchasable_id, self.request)
+
     def validatePurchasable(self, request, purchasable_id):
-        purchasable = get_purchasable(purchasable_id)
+        purchasable = self.getPurchasable(purchasable_id)
         if purchasable is None:
             raise_error(request,
                         hexc.HTTPUnprocessableEntity,
@@ -157,7 +407,7 @@ class BasePaymentViewMixin(ModeledContentUploadRequestUtilsMixin):
         return result
 
     def resolvePurchasables(self, purchasables=()):
-        result = [get_purchasable(p) for p in purchasables or ()]
+        result = [self.getPurchasable(p) for p in purchasables or ()]
         return result
 
     def getPaymentRecord(self, request, values=None):
@@ -248,9 +498,62 @@ class BasePaymentViewMixin(ModeledContentUploadRequestUtilsMixin):
     def processPurchase(self, purchase_attempt, record):
         raise NotImplementedError()
 
+    def idempotencyOwner(self, unused_values):
+        return self.username
+
+    def checkIdempotencyKey(self, values):
+        """
+        Return the purchase attempts created by an earlier request sent
+        with the same idempotency key and payload.
+        """
+        key = get_idempotency_key(self.request)
+        if not key:
+            return None
+        if len(key) > MAX_KEY_LENGTH:
+            raise_error(self.request,
+                        hexc.HTTPUnprocessableEntity,
+                        {
+                            'message': _(u"Invalid idempotency key."),
+                            'field': IDEMPOTENCY_KEY_HEADER
+                        },
+                        None)
+        store = get_idempotency_store(False)
+        key = scoped_key(self.idempotencyOwner(values), key)
+        entry = store.get(key) if store is not None else None
+        if entry is None:
+            return None
+        purchase_id, digest = entry
+        if digest != fingerprint(values):
+            raise_error(self.request,
+                        hexc.HTTPUnprocessableEntity,
+                        {
+                            'message': _(u"Idempotency key was used with a different request."),
+                            'field': IDEMPOTENCY_KEY_HEADER
+                        },
+                        None)
+        purchase = get_purchase_attempt(purchase_id)
+        if purchase is None:
+            return None
+        return LocatedExternalDict({
+            ITEMS: [purchase],
+            LAST_MODIFIED: purchase.lastModified
+        })
+
+    def recordIdempotencyKey(self, values, purchase_attempt):
+        key = get_idempotency_key(self.request)
+        if key:
+            key = scoped_key(self.idempotencyOwner(values), key)
+            get_idempotency_store().add(key,
+                                        purchase_attempt.id,
+                                        fingerprint(values))
+            queue_idempotency_purge(key)
+
     def __call__(self):
         username = self.username
         values = self.readInput()
+        result = self.checkIdempotencyKey(values)
+        if result is not None:
+            return result
         record = self.getPaymentRecord(self.request, values)
         purchase_attempt = self.createPurchaseAttempt(record)
         # check for any pending purchase for the items being bought
@@ -264,6 +567,7 @@ class BasePaymentViewMixin(ModeledContentUploadRequestUtilsMixin):
                 LAST_MODIFIED: lastModified
             })
         result = self.processPurchase(purchase_attempt, record)
+        self.recordIdempotencyKey(values, purchase_attempt)
         return result
 
 
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stripe webhook events.
+
+Charge events are mapped to their purchase attempts through the purchase
+id sent to Stripe in the charge metadata (or, for charges without one,
+through the purchase charge index) and the resulting state transition is
+applied (notified) directly in the site of the purchase, so purchases no
+longer wait for a client to poll them.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import stripe
+
+from zope import component
+from zope import interface
+
+from zope.component.hooks import getSite
+from zope.component.hooks import site as current_site
+
+from zope.event import notify
+
+from nti.app.store.catalog import find_purchases_by_charge
+
+from nti.app.store.interfaces import IStripeWebhookSecret
+
+from nti.site.hostpolicy import get_host_site
+
+from nti.store.interfaces import IPaymentProcessor
+
+from nti.store.interfaces import PurchaseAttemptFailed
+from nti.store.interfaces import PurchaseAttemptRefunded
+from nti.store.interfaces import PurchaseAttemptSuccessful
+
+from nti.store.purchase_error import PurchaseError
+
+from nti.store.store import get_purchase_attempt
+
+#: Charge events
+CHARGE_FAILED = u'charge.failed'
+CHARGE_REFUNDED = u'charge.refunded'
+CHARGE_SUCCEEDED = u'charge.succeeded'
+
+#: Charge metadata keys
+METADATA_SITE = 'Site'
+METADATA_USERNAME = 'Username'
+METADATA_PURCHASE_ID = 'PurchaseID'
+
+#: Default max age (in secs) of a signed event
+DEFAULT_TOLERANCE = 300
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(IStripeWebhookSecret)
+class StripeWebhookSecret(object):
+
+    def __init__(self, Secret, Tolerance=DEFAULT_TOLERANCE):
+        self.Secret = Secret
+        self.Tolerance = Tolerance
+
+
+def get_webhook_secret():
+    return component.queryUtility(IStripeWebhookSecret)
+
+
+def construct_event(payload, signature, secret):
+    """
+    Return the Stripe event of the specified payload after verifying its
+    signature. Raises a :class:`ValueError` for invalid payloads and a
+    :class:`stripe.error.SignatureVerificationError` for invalid
+    signatures.
+    """
+    return stripe.Webhook.construct_event(payload, signature,
+                                          secret.Secret,
+                                          tolerance=secret.Tolerance)
+
+
+def _charge_succeeded(purchase, unused_charge, request=None):
+    if not purchase.is_pending():
+        return False
+    manager = component.getUtility(IPaymentProcessor, name=purchase.Processor)
+    payment_charge = manager.get_payment_charge(purchase)
+    notify(PurchaseAttemptSuccessful(purchase, payment_charge, request=request))
+    return True
+
+
+def _charge_failed(purchase, charge, request=None):
+    if not purchase.is_pending():
+        return False
+    message = getattr(charge, 'failure_message', None) \
+           or u'Charge failed.'
+    error = PurchaseError(Type=u"PaymentError", Message=message,
+                          Code=getattr(charge, 'failure_code', None))
+    notify(PurchaseAttemptFailed(purchase, error, request=request))
+    return True
+
+
+def _charge_refunded(purchase, charge, request=None):
+    # partial refunds do not change the purchase state
+    if not purchase.has_succeeded() or not getattr(charge, 'refunded', False):
+        return False
+    notify(PurchaseAttemptRefunded(purchase, request=request))
+    return True
+
+
+#: Handlers of charge events
+CHARGE_HANDLERS = {
+    CHARGE_FAILED: _charge_failed,
+    CHARGE_REFUNDED: _charge_refunded,
+    CHARGE_SUCCEEDED: _charge_succeeded,
+}
+
+
+def _charge_metadata(charge):
+    return getattr(charge, 'metadata', None) or {}
+
+
+def find_charge_purchases(charge):
+    """
+    Return the purchase attempts of the specified charge, or ``None`` if
+    the charge has no purchase metadata and the purchase charge index is
+    not installed.
+    """
+    metadata = _charge_metadata(charge)
+    purchase_id = metadata.get(METADATA_PURCHASE_ID)
+    if not purchase_id:
+        return find_purchases_by_charge(charge.id)
+    purchase = get_purchase_attempt(purchase_id,
+                                    metadata.get(METADATA_USERNAME))
+    return [purchase] if purchase is not None else []
+
+
+def find_charge_site(charge):
+    """
+    Return the site of the purchase of the specified charge, if known.
+    """
+    site_name = _charge_metadata(charge).get(METADATA_SITE)
+    return get_host_site(site_name, True) if site_name else None
+
+
+def handle_stripe_event(event, request=None):
+    """
+    Apply the specified Stripe event to the purchase attempts of its
+    charge. Return the purchase attempts whose state changed.
+    """
+    handler = CHARGE_HANDLERS.get(event.type)
+    if handler is None:
+        return ()
+    charge = event.data.object
+    with current_site(find_charge_site(charge) or getSite()):
+        purchases = find_charge_purchases(charge)
+        if purchases is None:
+            logger.warning("Purchase charge index is not installed. "
+                           "Cannot handle event %s", event.id)
+            return ()
+        result = []
+        for purchase in purchases:
+            if handler(purchase, charge, request):
+                logger.info("Purchase %s updated by event %s (%s)",
+                            purchase.id, event.id, event.type)
+                result.append(purchase)
+    return result